@@ -13,10 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import json
 import logging
 import os
+import sys
 
 import deepspeed
+import torch
+from deepspeed.launcher import launch
 from deepspeed.launcher.runner import main
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
@@ -34,5 +39,29 @@ if wandb_token is not None:
     deepspeed.launcher.runner.EXPORT_ENVS.append("WANDB_API_KEY")
     os.environ["WANDB_API_KEY"] = wandb_token
 
+
+def main_cpu():
+    """
+    Launches cpu inference on a host without gpus, where the deepspeed runner finds no resources: starts one local
+    process per model parallel rank (or num_gpus processes) with deepspeed's per-node launcher directly.
+    """
+    world_info = base64.urlsafe_b64encode(
+        json.dumps({"localhost": list(range(neox_args.global_num_gpus))}).encode(
+            "utf-8"
+        )
+    ).decode("utf-8")
+    user_script_idx = deepspeed_main_args.index(neox_args.user_script)
+    sys.argv = [
+        sys.argv[0],
+        f"--world_info={world_info}",
+        "--master_addr=127.0.0.1",
+        f"--master_port={neox_args.master_port}",
+    ] + deepspeed_main_args[user_script_idx:]
+    launch.main()
+
+
 if __name__ == "__main__":
-    main(deepspeed_main_args)
+    if neox_args.inference_device == "cpu" and torch.cuda.device_count() == 0:
+        main_cpu()
+    else:
+        main(deepspeed_main_args)
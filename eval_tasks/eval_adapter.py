@@ -127,7 +127,9 @@ class EvalHarnessAdapter(GPT2LM):
         :param requests: Dictionary of requests containing the context (prompt) and 'until' - a token or
                          list of stop tokens.
         """
-        self.model.module.inference_mode(use_cache=True)  # tell model to cache kv pairs
+        self.model.module.inference_mode(
+            use_cache=True, last_position_only=True
+        )  # tell model to cache kv pairs, and only compute logits for the token being generated
         res = []
 
         def _collate(x):
@@ -15,7 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from megatron.utils import print_rank_0, setup_for_inference_or_eval
+from megatron.utils import print_rank_0, setup_for_inference_or_eval, setup_draft_model
 
 from megatron.text_generation_utils import (
     generate_samples_input_from_file,
@@ -23,6 +23,8 @@ from megatron.text_generation_utils import (
     generate_samples_unconditional,
     generate_samples_interactive,
 )
+from megatron.text_generation_server import GenerationServer
+from megatron.text_generation_speculative import get_speculative_proposer
 
 
 def main():
@@ -30,10 +32,16 @@ def main():
     Generate text/sample model
     """
     model, neox_args = setup_for_inference_or_eval(use_cache=True)
-    if neox_args.recompute:
-        model.module.inference_mode(
-            use_cache=False
-        )  # don't use kv cache if recomputing
+    model.module.inference_mode(
+        use_cache=not neox_args.recompute,  # don't use kv cache if recomputing
+        last_position_only=True,  # only the last position is sampled from
+        # keep the logits split along the vocab if sampling from them directly
+        parallel_output=neox_args.vocab_parallel_sampling,
+    )
+    draft_model = None
+    if neox_args.speculative_decoding == "draft":
+        draft_model = setup_draft_model(neox_args)
+    proposer = get_speculative_proposer(neox_args, draft_model)
     if neox_args.text_gen_type == "unconditional":
         print_rank_0(
             f"Generating samples unconditionally and saving results to {neox_args.sample_output_file}"
@@ -48,6 +56,14 @@ def main():
             temperature=neox_args.temperature,
             top_k=neox_args.top_k,
             top_p=neox_args.top_p,
+            batch_size=neox_args.generation_batch_size,
+            repetition_penalty=neox_args.repetition_penalty,
+            presence_penalty=neox_args.presence_penalty,
+            proposer=proposer,
+            num_speculative_tokens=neox_args.speculative_tokens,
+            num_beams=neox_args.num_beams,
+            length_penalty=neox_args.beam_length_penalty,
+            early_stopping=neox_args.beam_early_stopping,
         )
 
     elif neox_args.text_gen_type == "input-file":
@@ -65,6 +81,15 @@ def main():
             temperature=neox_args.temperature,
             top_k=neox_args.top_k,
             top_p=neox_args.top_p,
+            batch_size=neox_args.generation_batch_size,
+            repetition_penalty=neox_args.repetition_penalty,
+            presence_penalty=neox_args.presence_penalty,
+            proposer=proposer,
+            num_speculative_tokens=neox_args.speculative_tokens,
+            num_beams=neox_args.num_beams,
+            length_penalty=neox_args.beam_length_penalty,
+            early_stopping=neox_args.beam_early_stopping,
+            shard_across_data_parallel=neox_args.shard_sample_input,
         )
 
     elif neox_args.text_gen_type == "interactive":
@@ -76,8 +101,24 @@ def main():
             maximum_tokens=neox_args.maximum_tokens,
             top_k=neox_args.top_k,
             top_p=neox_args.top_p,
+            repetition_penalty=neox_args.repetition_penalty,
+            presence_penalty=neox_args.presence_penalty,
+            proposer=proposer,
+            num_speculative_tokens=neox_args.speculative_tokens,
         )
 
+    elif neox_args.text_gen_type == "server":
+        server = GenerationServer(
+            neox_args=neox_args,
+            model=model,
+            host=neox_args.server_host,
+            port=neox_args.server_port,
+            max_batch_size=neox_args.generation_batch_size,
+            batch_wait_ms=neox_args.server_batch_wait_ms,
+        )
+        server.start()
+        server.run()
+
     else:
         raise ValueError(
             f"`text-gen-type` either not specified or not recognised: {neox_args.text_gen_type}"
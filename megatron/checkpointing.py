@@ -17,11 +17,14 @@
 
 """Input/output checkpointing."""
 
+import json
 import os
 import re
 import shutil
 import random
+import struct
 import sys
+import warnings
 import numpy as np
 
 import torch
@@ -159,20 +162,25 @@ def delete_old_checkpoints(save_dir, n_to_keep):
                     pass
 
 
+def get_checkpoint_args(neox_args):
+    """The arguments saved with a checkpoint, which a loaded checkpoint must match (see check_checkpoint_args)."""
+    return {
+        "num_layers": neox_args.num_layers,
+        "hidden_size": neox_args.hidden_size,
+        "num_attention_heads": neox_args.num_attention_heads,
+        "max_position_embeddings": neox_args.max_position_embeddings,
+        "make_vocab_size_divisible_by": neox_args.make_vocab_size_divisible_by,
+        "padded_vocab_size": neox_args.padded_vocab_size,
+        "tokenizer_type": neox_args.tokenizer_type,
+        "model_parallel_size": neox_args.model_parallel_size,
+    }
+
+
 def save_ds_checkpoint(iteration, model, neox_args):
     """Save a model checkpoint."""
     sd = {
         "iteration": iteration,
-        "args": {
-            "num_layers": neox_args.num_layers,
-            "hidden_size": neox_args.hidden_size,
-            "num_attention_heads": neox_args.num_attention_heads,
-            "max_position_embeddings": neox_args.max_position_embeddings,
-            "make_vocab_size_divisible_by": neox_args.make_vocab_size_divisible_by,
-            "padded_vocab_size": neox_args.padded_vocab_size,
-            "tokenizer_type": neox_args.tokenizer_type,
-            "model_parallel_size": neox_args.model_parallel_size,
-        },
+        "args": get_checkpoint_args(neox_args),
     }
     # rng states.
     if not neox_args.no_save_rng:
@@ -321,3 +329,294 @@ def load_checkpoint(
         print("  successfully loaded {}".format(checkpoint_name))
 
     return iteration
+
+
+def _get_checkpoint_dir(neox_args, iteration=None):
+    """
+    Returns the directory of the checkpoint of `iteration` (or the latest one) in neox_args.load, or None if there is
+    no latest checkpoint.
+    """
+    if iteration is not None:
+        tag = f"global_step{iteration}"
+    else:
+        latest_path = os.path.join(neox_args.load, "latest")
+        if not os.path.isfile(latest_path):
+            if mpu.get_data_parallel_rank() == 0:
+                print("Unable to load checkpoint.")
+            return None
+        with open(latest_path, "r") as f:
+            tag = f.read().strip()
+    return os.path.join(neox_args.load, tag)
+
+
+def _read_checkpoint_client_state(neox_args, checkpoint_dir):
+    """
+    Returns the name and state dict of the mp_rank_XX_model_states.pt file of this model parallel rank in
+    checkpoint_dir.
+    """
+    tag = os.path.basename(checkpoint_dir)
+    mp_rank = mpu.get_model_parallel_rank()
+    # pipeline parallel checkpoints number their model states by pipe stage, all of which hold the same client state
+    checkpoint_names = [
+        os.path.join(checkpoint_dir, f"mp_rank_{mp_rank:02d}_model_states.pt")
+    ] + natural_sort(glob(os.path.join(checkpoint_dir, "mp_rank_*_model_states.pt")))
+    checkpoint_name = next((n for n in checkpoint_names if os.path.isfile(n)), None)
+    if checkpoint_name is None:
+        available_checkpoints = sorted(
+            [
+                int(i.name.replace("global_step", ""))
+                for i in Path(neox_args.load).glob("global_step*")
+            ]
+        )
+        raise ValueError(
+            f"Unable to load checkpoint {tag}. \nAvailable iterations: {pformat(available_checkpoints)}"
+        )
+    return checkpoint_name, torch.load(checkpoint_name, map_location="cpu")
+
+
+def _layer_checkpoint_name(checkpoint_dir, idx):
+    return os.path.join(
+        checkpoint_dir,
+        f"layer_{idx:02d}-model_{mpu.get_model_parallel_rank():02d}-model_states.pt",
+    )
+
+
+def _checkpoint_iteration(neox_args, checkpoint_name, state_dict):
+    """Returns the iteration of a loaded checkpoint after validating its args, like load_checkpoint."""
+    if neox_args.finetune:
+        iteration = 0
+    else:
+        iteration = state_dict.get("iteration") or state_dict.get("total_iters")
+        if iteration is None:
+            raise ValueError(
+                f"Unable to load iteration from checkpoint {checkpoint_name} with keys {state_dict.keys()}, exiting"
+            )
+    if "args" in state_dict:
+        check_checkpoint_args(neox_args=neox_args, checkpoint_args=state_dict["args"])
+        print_rank_0(
+            " > validated currently set args with arguments in the checkpoint ..."
+        )
+
+    torch.distributed.barrier()
+    if mpu.get_data_parallel_rank() == 0:
+        print("  successfully loaded {}".format(checkpoint_name))
+
+    return iteration
+
+
+def load_checkpoint_weights(neox_args, model, iteration=None):
+    """
+    Load the model weights of the deepspeed checkpoint in neox_args.load into model, a sequential model that is not
+    wrapped in a deepspeed engine (e.g. for cpu inference), and return the iteration.
+
+    Reads both the checkpoints of sequential models, whose mp_rank_XX_model_states.pt hold the module's state dict, and
+    those of pipeline parallel ones, which hold one layer_XX-model_YY-model_states.pt file per layer of the pipe
+    model. Layer XX is the XXth layer of the sequential model. The checkpoint must have the model's model parallel size.
+    If the checkpoint has the mp_rank_XX_model_weights.bin files of save_mmap_checkpoint_weights, the parameters are
+    memory mapped from them instead (see load_mmap_weights).
+    """
+    checkpoint_dir = _get_checkpoint_dir(neox_args, iteration)
+    if checkpoint_dir is None:
+        return 0
+    mmap_weights_name = get_mmap_weights_name(checkpoint_dir)
+    if os.path.isfile(mmap_weights_name):
+        tensors, metadata = load_mmap_weights(mmap_weights_name)
+        _map_weights(model, tensors)
+        return _checkpoint_iteration(neox_args, mmap_weights_name, metadata)
+
+    checkpoint_name, state_dict = _read_checkpoint_client_state(
+        neox_args, checkpoint_dir
+    )
+
+    if state_dict.get("module") is not None:
+        model.load_state_dict(state_dict["module"])
+    else:
+        for idx, layer in enumerate(model.sequential):
+            # functions and tied layers of the pipe model hold no weights, and have no layer files
+            if not layer.state_dict():
+                continue
+            layer.load_state_dict(
+                torch.load(
+                    _layer_checkpoint_name(checkpoint_dir, idx), map_location="cpu"
+                )
+            )
+
+    return _checkpoint_iteration(neox_args, checkpoint_name, state_dict)
+
+
+def stream_checkpoint_weights(neox_args, model, iteration=None):
+    """
+    Point model, a StreamingSequentialWrapper, at the layer_XX-model_YY-model_states.pt files of the pipeline parallel
+    checkpoint in neox_args.load, from which it loads every layer's weights when the layer runs, and return the
+    iteration. Checkpoints of sequential models, which hold all weights in one file, can't be streamed.
+    """
+    checkpoint_dir = _get_checkpoint_dir(neox_args, iteration)
+    if checkpoint_dir is None:
+        raise ValueError(
+            f"layer streaming needs a checkpoint, but there is none in {neox_args.load}"
+        )
+    checkpoint_name, state_dict = _read_checkpoint_client_state(
+        neox_args, checkpoint_dir
+    )
+    if state_dict.get("module") is not None:
+        raise ValueError(
+            f"layer streaming needs the per layer files of a pipeline parallel checkpoint, but {checkpoint_name} "
+            f"holds the weights of a sequential model"
+        )
+
+    layer_files = {}
+    for idx, layer in enumerate(model.sequential):
+        if not model.has_weights(idx):
+            continue
+        layer_name = _layer_checkpoint_name(checkpoint_dir, idx)
+        if not os.path.isfile(layer_name):
+            raise ValueError(f"Unable to find the weights of layer {idx}: {layer_name}")
+        layer_files[idx] = layer_name
+    model.set_layer_files(layer_files)
+
+    return _checkpoint_iteration(neox_args, checkpoint_name, state_dict)
+
+
+MMAP_WEIGHTS_ALIGNMENT = 64
+
+# the dtypes of mmap weights files, and the numpy dtypes their tensors are mapped as (numpy has no bfloat16)
+_MMAP_DTYPES = {
+    "float32": (torch.float32, np.float32),
+    "float16": (torch.float16, np.float16),
+    "bfloat16": (torch.bfloat16, np.int16),
+    "int64": (torch.int64, np.int64),
+    "int32": (torch.int32, np.int32),
+    "int8": (torch.int8, np.int8),
+    "uint8": (torch.uint8, np.uint8),
+    "bool": (torch.bool, np.bool_),
+}
+
+
+def get_mmap_weights_name(checkpoint_dir, mp_rank=None):
+    if mp_rank is None:
+        mp_rank = mpu.get_model_parallel_rank()
+    return os.path.join(checkpoint_dir, f"mp_rank_{mp_rank:02d}_model_weights.bin")
+
+
+def find_mmap_weights(neox_args, iteration=None):
+    """
+    Returns the mmap weights file of this model parallel rank in the checkpoint of `iteration` (or the latest one) in
+    neox_args.load, or None if it has none.
+    """
+    if iteration is None and not os.path.isfile(os.path.join(neox_args.load, "latest")):
+        return None
+    mmap_weights_name = get_mmap_weights_name(_get_checkpoint_dir(neox_args, iteration))
+    return mmap_weights_name if os.path.isfile(mmap_weights_name) else None
+
+
+def save_mmap_weights(filename, state_dict, metadata=None):
+    """
+    Writes the tensors of state_dict to filename in the read-only weights format of load_mmap_weights: the size of the
+    header (8 bytes, little endian), a json header holding the metadata and the dtype, shape and offset of every
+    tensor, and the tensors' bytes, each at an offset aligned to MMAP_WEIGHTS_ALIGNMENT bytes.
+    """
+    tensors, index, size = {}, {}, 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        dtype = str(tensor.dtype).replace("torch.", "")
+        if dtype not in _MMAP_DTYPES:
+            raise ValueError(f"Unable to save {name} of dtype {tensor.dtype}")
+        offset = -(-size // MMAP_WEIGHTS_ALIGNMENT) * MMAP_WEIGHTS_ALIGNMENT
+        index[name] = {"dtype": dtype, "shape": list(tensor.shape), "offset": offset}
+        tensors[name] = tensor
+        size = offset + tensor.numel() * tensor.element_size()
+    header = json.dumps({"metadata": metadata or {}, "tensors": index}).encode("utf-8")
+    # pad the header so that the tensors start at an aligned offset of the file
+    header += b" " * (-(len(header) + 8) % MMAP_WEIGHTS_ALIGNMENT)
+
+    # write to a temporary file first, so that no process maps a partially written file
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        data_start = f.tell()
+        for name, tensor in tensors.items():
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.seek(data_start + index[name]["offset"])
+            f.write(tensor.numpy().tobytes())
+        f.truncate(data_start + size)
+    os.replace(tmp_filename, filename)
+
+
+def load_mmap_weights(filename):
+    """
+    Maps the tensors of a weights file written by save_mmap_weights into memory, read-only, and returns them and the
+    file's metadata. The tensors are backed by the file's pages in the page cache, which every process mapping the
+    file shares, so loading doesn't read or copy them, and they must not be written to.
+    """
+    with open(filename, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    data_start = 8 + header_size
+    size = os.path.getsize(filename) - data_start
+    # (an empty file can't be mapped)
+    data = (
+        np.memmap(filename, dtype=np.uint8, mode="r", offset=data_start, shape=(size,))
+        if size > 0
+        else np.zeros(0, dtype=np.uint8)
+    )
+    tensors = {}
+    with warnings.catch_warnings():
+        # torch warns that the tensors of read-only arrays aren't writable
+        warnings.simplefilter("ignore", UserWarning)
+        for name, entry in header["tensors"].items():
+            dtype, np_dtype = _MMAP_DTYPES[entry["dtype"]]
+            nbytes = int(np.prod(entry["shape"])) * np.dtype(np_dtype).itemsize
+            array = data[entry["offset"] : entry["offset"] + nbytes].view(np_dtype)
+            tensors[name] = torch.from_numpy(array).view(dtype).view(entry["shape"])
+    return tensors, header["metadata"]
+
+
+def _map_weights(model, tensors):
+    """
+    Points the parameters of model at the tensors of its state dict in `tensors` (which keeps them memory mapped,
+    unless a parameter has another dtype) and copies its buffers.
+    """
+    expected = set(model.state_dict().keys())
+    if set(tensors.keys()) != expected:
+        raise RuntimeError(
+            f"Error mapping weights into {model.__class__.__name__}: missing keys "
+            f"{sorted(expected - set(tensors.keys()))}, unexpected keys "
+            f"{sorted(set(tensors.keys()) - expected)}"
+        )
+    params = dict(model.named_parameters())
+    buffers = dict(model.named_buffers())
+    for name, tensor in tensors.items():
+        target = params[name] if name in params else buffers[name]
+        # parameters freed while building the model are empty
+        if target.numel() > 0 and target.shape != tensor.shape:
+            raise RuntimeError(
+                f"Error mapping weights into {model.__class__.__name__}: {name} has shape {tuple(tensor.shape)} "
+                f"in the checkpoint, but {tuple(target.shape)} in the model"
+            )
+        if name in params:
+            target.data = tensor.to(target.dtype)
+        else:
+            target.copy_(tensor)
+
+
+def save_mmap_checkpoint_weights(neox_args, model, iteration):
+    """
+    Writes the weights of model, a sequential model loaded from the checkpoint of `iteration` in neox_args.load, to
+    the mp_rank_XX_model_weights.bin files of the checkpoint in the format of save_mmap_weights, from which
+    load_checkpoint_weights then memory maps them. The weights are saved in the model's dtypes, so they should be
+    those the model runs inference in (e.g. bfloat16 for fp16 models on cpu), or every process loading them copies
+    them into its own memory.
+    """
+    checkpoint_dir = _get_checkpoint_dir(neox_args, iteration)
+    mmap_weights_name = get_mmap_weights_name(checkpoint_dir)
+    if mpu.get_data_parallel_rank() == 0:
+        save_mmap_weights(
+            mmap_weights_name,
+            model.state_dict(),
+            metadata={"iteration": iteration, "args": get_checkpoint_args(neox_args)},
+        )
+        print("  successfully saved {}".format(mmap_weights_name))
+    torch.distributed.barrier()
+    return mmap_weights_name
@@ -138,7 +138,7 @@ def _initialize_distributed(neox_args):
         if neox_args.rank == 0:
             print("> initializing torch distributed ...", flush=True)
         # Manually set the device ids.
-        if device_count > 0:
+        if device_count > 0 and neox_args.inference_device != "cpu":
             device = neox_args.rank % device_count
             if neox_args.local_rank is not None:
                 assert (
@@ -177,7 +177,7 @@ def _initialize_distributed(neox_args):
         neox_args.seed = offset + (stage_id * mp)
 
     # Set the model-parallel / data-parallel communicators.
-    if device_count > 0:
+    if device_count > 0 or neox_args.inference_device == "cpu":
         if mpu.model_parallel_is_initialized():
             print(
                 "_initialize_distributed() model parallel is already initialized",
@@ -157,7 +157,12 @@ class FusedScaleMaskSoftmax(nn.Module):
                 batch_per_block = self.get_batch_per_block(sq, sk, b, np)
 
                 if self.upper_triang_mask_fusion:
-                    if attn_batches % batch_per_block == 0:
+                    # the causal kernel ignores `mask`, so it can't serve per-sample (e.g. left padding) masks
+                    if (
+                        attn_batches % batch_per_block == 0
+                        and sq == sk
+                        and mask.size(0) == 1
+                    ):
                         return True
                 else:
                     if sq % batch_per_block == 0:
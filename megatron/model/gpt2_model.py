@@ -21,9 +21,18 @@ import math
 import torch
 import torch.nn as nn
 from collections import defaultdict
+from contextlib import contextmanager
 
 from functools import partial
-from megatron.model.utils import Lambda, SequentialWrapper, recursive_setattr
+from megatron.model.utils import (
+    Lambda,
+    SequentialWrapper,
+    recursive_setattr,
+    _clear_cache,
+    _truncate_cache,
+    _select_cache_rows,
+    _evict_cache,
+)
 from megatron.model.norms import get_norm
 from megatron.model.init_functions import get_init_methods
 
@@ -60,6 +69,10 @@ def cross_entropy(output, labels, _fp16=False):
         return loss
     """
     labels, loss_mask = labels[0], labels[1]
+    if output.size(1) != labels.size(1):
+        # logits were only computed for the last positions (`inference_mode(last_position_only=True)`)
+        labels = labels[:, -output.size(1) :]
+        loss_mask = loss_mask[:, -output.size(1) :]
     if _fp16:
         assert output.dtype == torch.half and loss_mask.dtype == torch.half
         losses = mpu.vocab_parallel_cross_entropy(output.contiguous(), labels)
@@ -105,6 +118,24 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         parallel_output=True,
         topology=None,
         use_cache=False,
+    ):
+        self._setup_specs(
+            neox_args, num_tokentypes, parallel_output, topology, use_cache
+        )
+
+        super().__init__(
+            layers=self.specs,
+            loss_fn=partial(cross_entropy, _fp16=self.neox_args.fp16_lm_cross_entropy),
+            topology=topology,
+            activation_checkpoint_interval=self.neox_args.checkpoint_num_layers
+            if self.neox_args.checkpoint_activations
+            else 0,
+            partition_method=neox_args.pipe_partition_method,
+            checkpointable_layers=["GMLPBlock", "ParallelTransformerLayerPipe"],
+        )
+
+    def _setup_specs(
+        self, neox_args, num_tokentypes, parallel_output, topology, use_cache
     ):
         self.neox_args = neox_args
 
@@ -120,16 +151,17 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         self.specs = []
         self.init_specs()  # initializes the layer specs (basically a fancy nn.Sequential)
 
-        super().__init__(
-            layers=self.specs,
-            loss_fn=partial(cross_entropy, _fp16=self.neox_args.fp16_lm_cross_entropy),
-            topology=topology,
-            activation_checkpoint_interval=self.neox_args.checkpoint_num_layers
-            if self.neox_args.checkpoint_activations
-            else 0,
-            partition_method=neox_args.pipe_partition_method,
-            checkpointable_layers=["GMLPBlock", "ParallelTransformerLayerPipe"],
-        )
+    @classmethod
+    def layer_specs(
+        cls, neox_args, num_tokentypes=0, parallel_output=True, use_cache=False
+    ):
+        """
+        Returns the layer specs of the model without building the pipe model (which builds all of its layers), e.g.
+        to build the layers one at a time with build_sequential_layers.
+        """
+        model = cls.__new__(cls)
+        model._setup_specs(neox_args, num_tokentypes, parallel_output, None, use_cache)
+        return model.specs
 
     def insert_layers(
         self, layers: Union[nn.Module, nn.ModuleList, nn.Sequential, List], idx
@@ -220,6 +252,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
                 num_buckets=self.neox_args.rpe_num_buckets,
                 max_distance=self.neox_args.rpe_max_distance,
                 heads=self.neox_args.num_attention_heads,
+                max_seq_len=self.neox_args.max_position_embeddings,
             )
 
         # Transformer layers
@@ -264,6 +297,8 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
 
         def _logits_helper(embedding, lm_output):
             """Just a wrapper to massage inputs/outputs from pipeline."""
+            if embedding.last_position_only:
+                lm_output = lm_output[:, -1:]
             logits = parallel_lm_logits(
                 lm_output, embedding.word_embeddings_weight, self.parallel_output
             )
@@ -296,22 +331,40 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
             )
 
     def _set_parallel_output(self, value):
-        # sets the parallel output value of the final layer to value
+        # sets the parallel output value of the final layer to value (read by _logits_helper with weight tying)
+        self.parallel_output = value
         final_layer = list(self.forward_funcs)[-1]
         if isinstance(final_layer, (ParallelLinearPipe, ParallelLinear)):
             final_layer.final_linear.set_parallel_output(value)
 
-    def inference_mode(self, use_cache=True):
+    def inference_mode(
+        self, use_cache=True, last_position_only=False, parallel_output=False
+    ):
         """
         Sets up the model for inference by turning on k/v caching (if specified) and setting `parallel output` of the final layer to false,
         so logits are gathered across model parallel ranks.
 
         :param cache: (bool) True if you want to use caching during inference, False otherwise
+        :param last_position_only: (bool) True if the final layer should only compute logits for the last position, e.g. when
+                                   sampling the next token. False to return logits for every position.
+        :param parallel_output: (bool) True to keep the logits split across model parallel ranks along the vocab, e.g. for
+                                sample_tokens_vocab_parallel. Needs a column parallel (or weight tied) output layer.
         """
+        assert not (
+            parallel_output
+            and self.neox_args.output_layer_parallelism == "row"
+            and self.neox_args.no_weight_tying
+        ), "vocab-parallel logits need a column parallel output layer"
         # first set caching to true if specified
         recursive_setattr(self.forward_funcs, "use_cache", use_cache, assert_type=bool)
+        recursive_setattr(
+            self.forward_funcs,
+            "last_position_only",
+            last_position_only,
+            assert_type=bool,
+        )
         # then set parallel output of the final layer to false so we don't have to gather the output manually
-        self._set_parallel_output(False)
+        self._set_parallel_output(parallel_output)
 
     def train_mode(self):
         """
@@ -320,6 +373,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         """
         # set caching to false
         recursive_setattr(self.forward_funcs, "use_cache", False)
+        recursive_setattr(self.forward_funcs, "last_position_only", False)
         # then set parallel output to true (more efficient training)
         self._set_parallel_output(True)
 
@@ -327,34 +381,32 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         """
         Recursively clears the kv cache on all layers
         """
-        recursive_setattr(self.forward_funcs, "layer_past", None)
+        _clear_cache(self.forward_funcs)
+
+    def truncate_cache(self, seq_len):
+        """
+        Recursively truncates the kv cache on all layers to its first seq_len positions
+        """
+        _truncate_cache(self.forward_funcs, seq_len)
+
+    def select_cache_rows(self, index):
+        """
+        Recursively keeps only the batch rows in `index` of the kv cache on all layers
+        """
+        _select_cache_rows(self.forward_funcs, index)
+
+    def evict_cache(self, start, n):
+        """
+        Recursively drops the n cached positions from `start` on of the kv cache on all layers
+        """
+        _evict_cache(self.forward_funcs, start, n)
 
     def to_sequential(self):
         """
         Transforms the PipelineModule to a plain nn.Sequential module
         :return:
         """
-        layers = []
-        tied_layers = defaultdict(list)
-        for n, spec in enumerate(self.specs):
-            if isinstance(spec, TiedLayerSpec):
-                if spec.key in tied_layers:
-                    # receiver
-                    layers.append(
-                        Lambda(lambda x: spec.forward_fn(tied_layers[spec.key][0], x))
-                    )
-                else:
-                    # owner
-                    module = spec.build(log=False)
-                    layers.append(module)
-                    tied_layers[spec.key].append(module)
-            elif isinstance(spec, LayerSpec):
-                layers.append(spec.build(log=False))
-            elif hasattr(spec, "__call__"):
-                # check that it's a callable function
-                layers.append(Lambda(spec))
-            else:
-                raise ValueError(f"Layer number {n} ({spec}) Not recognized")
+        layers = build_sequential_layers(self.specs)
         model = SequentialWrapper(
             layers,
             self.activation_checkpoint_interval,
@@ -362,3 +414,59 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
             parent_class_name=self.__class__.__name__,
         )
         return model
+
+
+@contextmanager
+def pipe_models_on_cpu():
+    """
+    PipelineModule moves itself to `cuda:{local_rank}` on construction; pipe models constructed within this context
+    stay on cpu instead, for cpu inference (e.g. on hosts without gpus).
+    """
+    to = PipelineModule.__dict__.get("to")
+    PipelineModule.to = lambda module, *args, **kwargs: module
+    try:
+        yield
+    finally:
+        if to is None:
+            del PipelineModule.to
+        else:
+            PipelineModule.to = to
+
+
+def build_sequential_layers(specs, on_build=None):
+    """
+    Builds the layers of a sequential model from the layer specs of a pipe model. Tied layers are built once, by
+    their first spec, and the later ones apply their forward_fn to it.
+
+    :param specs: layer specs of a pipe model (see GPT2ModelPipe.layer_specs)
+    :param on_build: optional function called with the index, spec and module of every built layer before the next
+                     one is built, e.g. to release its weights
+    :return: list of layers
+    """
+    layers = []
+    tied_layers = defaultdict(list)
+    for n, spec in enumerate(specs):
+        if isinstance(spec, TiedLayerSpec):
+            if spec.key in tied_layers:
+                # receiver
+                layers.append(
+                    Lambda(lambda x: spec.forward_fn(tied_layers[spec.key][0], x))
+                )
+            else:
+                # owner
+                module = spec.build(log=False)
+                layers.append(module)
+                tied_layers[spec.key].append(module)
+                if on_build is not None:
+                    on_build(n, spec, module)
+        elif isinstance(spec, LayerSpec):
+            module = spec.build(log=False)
+            layers.append(module)
+            if on_build is not None:
+                on_build(n, spec, module)
+        elif hasattr(spec, "__call__"):
+            # check that it's a callable function
+            layers.append(Lambda(spec))
+        else:
+            raise ValueError(f"Layer number {n} ({spec}) Not recognized")
+    return layers
@@ -0,0 +1,663 @@
+"""Key / value caches used by ParallelSelfAttention for incremental decoding."""
+
+from collections import OrderedDict
+
+import torch
+
+
+class StaticKVCache:
+    """
+    Preallocated key / value cache for a single attention layer.
+
+    The cache owns a buffer of shape [2, max_seq_len, b, np, hn] that is allocated on the first forward pass and then
+    reused for every subsequent generation call. New keys / values are written in place at the fill pointer (`seq_len`)
+    rather than concatenated onto the history, so a decode step never copies the already cached positions.
+
+    :param max_seq_len: number of positions to allocate (usually neox_args.seq_length)
+    """
+
+    def __init__(self, max_seq_len):
+        self.max_seq_len = max_seq_len
+        self.buffer = None
+        self.seq_len = 0
+        # position of the first cached entry, used as the rotary offset once leading positions have been dropped
+        self.position_offset = 0
+
+    def _allocate(self, key_layer):
+        # [sq, b, np, hn] -> [2, max_seq_len, b, np, hn]
+        shape = (2, self.max_seq_len) + tuple(key_layer.shape[1:])
+        if (
+            self.buffer is None
+            or self.buffer.shape != shape
+            or self.buffer.dtype != key_layer.dtype
+            or self.buffer.device != key_layer.device
+        ):
+            self.buffer = torch.empty(
+                shape, dtype=key_layer.dtype, device=key_layer.device
+            )
+
+    def update(self, key_layer, value_layer):
+        """
+        Writes key_layer / value_layer ([sq, b, np, hn]) at the fill pointer, advances it, and returns views of all
+        cached keys and values ([seq_len, b, np, hn] each).
+        """
+        if self.seq_len == 0:
+            # (re)allocate only at the start of a generation, in case the batch size / dtype changed
+            self._allocate(key_layer)
+        end = self.seq_len + key_layer.shape[0]
+        assert (
+            end <= self.max_seq_len
+        ), f"StaticKVCache overflow: {end} positions requested but only {self.max_seq_len} allocated"
+        self.buffer[0, self.seq_len : end] = key_layer
+        self.buffer[1, self.seq_len : end] = value_layer
+        self.seq_len = end
+        return self.buffer[0, :end], self.buffer[1, :end]
+
+    def reset(self):
+        """Resets the fill pointer. The buffer is kept around to be reused by the next generation."""
+        self.seq_len = 0
+        self.position_offset = 0
+
+    def truncate(self, seq_len):
+        """Drops the cached positions from seq_len onwards, e.g. keys / values of rejected speculative tokens."""
+        self.seq_len = min(self.seq_len, seq_len)
+
+    def select_rows(self, index):
+        """
+        Keeps only the batch rows in `index` (a LongTensor on the cache's device), e.g. to evict finished sequences. An
+        index of the same batch size (e.g. reordering beams) reorders the cached positions within the buffer.
+        """
+        if index.numel() == self.buffer.size(2):
+            self.buffer[:, : self.seq_len] = self.buffer[
+                :, : self.seq_len
+            ].index_select(2, index)
+        else:
+            self.buffer = self.buffer.index_select(2, index)
+
+    def append_rows(self, other):
+        """Appends the batch rows of `other`, which must cache the same positions."""
+        assert (
+            other.seq_len == self.seq_len
+            and other.position_offset == self.position_offset
+        ), "can only append rows caching the same positions"
+        self.buffer = torch.cat((self.buffer, other.buffer), dim=2)
+
+    def zero_rows(self, batch_size, seq_len):
+        """
+        Returns a new cache for `batch_size` rows, at the same position offset, with its first `seq_len` positions
+        filled with zeros. Forwarding a prompt of length L into it with seq_len = T - L lines the prompt up with the
+        last L positions of a cache holding T positions.
+        """
+        cache = StaticKVCache(self.max_seq_len)
+        cache.buffer = self.buffer.new_zeros(
+            (2, self.max_seq_len, batch_size) + tuple(self.buffer.shape[3:])
+        )
+        cache.seq_len = seq_len
+        cache.position_offset = self.position_offset
+        return cache
+
+    def evict(self, start, n):
+        """Drops the n cached positions from `start` on in place, moving the later positions n positions earlier."""
+        if n <= 0:
+            return
+        self.buffer[:, start : self.seq_len - n] = self.buffer[
+            :, start + n : self.seq_len
+        ].clone()
+        self.seq_len -= n
+
+    def drop_front(self, n):
+        """
+        Drops the first n cached positions to make room at the end of the buffer. The position offset is advanced so
+        the remaining positions keep their rotary positions.
+        """
+        if n <= 0:
+            return
+        self.evict(0, n)
+        self.position_offset += n
+
+    def numel(self):
+        # mirrors torch.Tensor.numel() so a StaticKVCache can be checked for emptiness like a `layer_past` tensor
+        if self.buffer is None:
+            return 0
+        return self.buffer[:, : self.seq_len].numel()
+
+    def cached(self):
+        """Returns the cached keys and values as a [2, seq_len, b, np, hn] tensor."""
+        return self.buffer[:, : self.seq_len]
+
+    def nbytes(self):
+        """Number of bytes allocated by the cache."""
+        if self.buffer is None:
+            return 0
+        return self.buffer.numel() * self.buffer.element_size()
+
+
+class Int8KVCache(StaticKVCache):
+    """
+    StaticKVCache storing keys / values in int8, with a symmetric (absmax) scale per position, batch row and head, in
+    the dtype of the keys / values. Takes about half the memory of a float16 cache (a quarter of a float32 one), so
+    twice the sequences fit into the same memory.
+
+    New keys / values are quantized as they are written (see `write`) and ParallelSelfAttention.attention dequantizes
+    all cached positions of the layer (see `cached`), so the attention of every position, including the newest ones,
+    reads the quantized keys / values.
+
+    :param max_seq_len: number of positions to allocate (usually neox_args.seq_length)
+    """
+
+    def __init__(self, max_seq_len):
+        super().__init__(max_seq_len)
+        # [2, max_seq_len, b, np, 1]
+        self.scale = None
+
+    def _allocate(self, key_layer):
+        shape = (2, self.max_seq_len) + tuple(key_layer.shape[1:])
+        if (
+            self.buffer is None
+            or self.buffer.shape != shape
+            or self.scale.dtype != key_layer.dtype
+            or self.buffer.device != key_layer.device
+        ):
+            self.buffer = torch.empty(shape, dtype=torch.int8, device=key_layer.device)
+            self.scale = torch.empty(
+                shape[:-1] + (1,), dtype=key_layer.dtype, device=key_layer.device
+            )
+
+    def store(self, index, start, x):
+        """Quantizes x ([sq, b, np, hn] keys if index is 0, values if 1) into the positions from `start` on."""
+        scale = (x.detach().abs().amax(dim=-1, keepdim=True).float() / 127.0).to(
+            self.scale.dtype
+        )
+        # all zero heads quantize to zeros
+        scale = scale.masked_fill(scale == 0, 1.0)
+        end = start + x.shape[0]
+        self.buffer[index, start:end] = torch.round(x.float() / scale.float()).clamp_(
+            -127, 127
+        )
+        self.scale[index, start:end] = scale
+
+    def write(self, key_layer, value_layer):
+        """Quantizes key_layer / value_layer ([sq, b, np, hn]) into the positions at the fill pointer, and advances it."""
+        if self.seq_len == 0:
+            self._allocate(key_layer)
+        end = self.seq_len + key_layer.shape[0]
+        assert (
+            end <= self.max_seq_len
+        ), f"Int8KVCache overflow: {end} positions requested but only {self.max_seq_len} allocated"
+        self.store(0, self.seq_len, key_layer)
+        self.store(1, self.seq_len, value_layer)
+        self.seq_len = end
+
+    def update(self, key_layer, value_layer):
+        self.write(key_layer, value_layer)
+        key_layer, value_layer = self.cached()
+        return key_layer, value_layer
+
+    def cached(self):
+        """Returns the dequantized keys and values as a [2, seq_len, b, np, hn] tensor."""
+        return (
+            self.buffer[:, : self.seq_len].to(self.scale.dtype)
+            * self.scale[:, : self.seq_len]
+        )
+
+    def select_rows(self, index):
+        if index.numel() == self.buffer.size(2):
+            self.buffer[:, : self.seq_len] = self.buffer[
+                :, : self.seq_len
+            ].index_select(2, index)
+            self.scale[:, : self.seq_len] = self.scale[:, : self.seq_len].index_select(
+                2, index
+            )
+        else:
+            self.buffer = self.buffer.index_select(2, index)
+            self.scale = self.scale.index_select(2, index)
+
+    def append_rows(self, other):
+        super().append_rows(other)
+        self.scale = torch.cat((self.scale, other.scale), dim=2)
+
+    def zero_rows(self, batch_size, seq_len):
+        cache = Int8KVCache(self.max_seq_len)
+        cache.buffer = self.buffer.new_zeros(
+            (2, self.max_seq_len, batch_size) + tuple(self.buffer.shape[3:])
+        )
+        cache.scale = self.scale.new_ones(
+            (2, self.max_seq_len, batch_size) + tuple(self.scale.shape[3:])
+        )
+        cache.seq_len = seq_len
+        cache.position_offset = self.position_offset
+        return cache
+
+    def evict(self, start, n):
+        if n <= 0:
+            return
+        self.scale[:, start : self.seq_len - n] = self.scale[
+            :, start + n : self.seq_len
+        ].clone()
+        super().evict(start, n)
+
+    def nbytes(self):
+        if self.buffer is None:
+            return 0
+        return super().nbytes() + self.scale.numel() * self.scale.element_size()
+
+
+class BlockAllocator:
+    """
+    Reference counted allocator of the fixed-size blocks of a paged key / value cache, identified by their index into
+    the block pool.
+
+    A block is shared (e.g. by sequences with a common prompt prefix) by taking another reference with `incref`, and
+    returns to the free list once its last reference has been freed.
+
+    :param num_blocks: number of blocks in the pool
+    """
+
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        # popped from the end, so the lowest block ids are handed out first
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.refcounts = [0] * num_blocks
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def allocate(self):
+        """Takes a block off the free list and returns its id, with a reference count of 1."""
+        if not self.free_blocks:
+            raise RuntimeError(
+                f"out of key / value cache blocks (all {self.num_blocks} are in use)"
+            )
+        block = self.free_blocks.pop()
+        self.refcounts[block] = 1
+        return block
+
+    def incref(self, block):
+        """Takes another reference to an allocated block."""
+        assert self.refcounts[block] > 0, f"block {block} is not allocated"
+        self.refcounts[block] += 1
+
+    def free(self, block):
+        """Drops a reference to a block, returning it to the free list if that was the last one."""
+        assert self.refcounts[block] > 0, f"block {block} is not allocated"
+        self.refcounts[block] -= 1
+        if self.refcounts[block] == 0:
+            self.free_blocks.append(block)
+
+
+class PagedKVCacheManager:
+    """
+    Block tables of the sequences sharing a paged key / value cache.
+
+    The cache is split into `num_blocks` blocks of `block_size` positions each. Every sequence has a block table, the
+    list of blocks holding its positions in order, and only takes up the blocks its length needs: nothing is padded to
+    the longest sequence in the batch or preallocated up to seq_length. The block tables are shared by all layers, each
+    of which keeps its own block pool (see PagedKVCache).
+
+    `fork` shares all blocks of a sequence with a new one, e.g. to sample a prompt several times while caching it once.
+    A shared block is copied on write, when one of the sequences sharing it appends into it.
+
+    Before every forward pass, `prepare` is called with the sequences in the batch (in row order) and the number of
+    tokens each of them is forwarding. It makes room for the new positions and computes the tensors the layers need:
+
+        - slot_mapping [sq, b]: the pool slot (block * block_size + offset) each new key / value is written to
+        - key_slots [sk, b]: the pool slots of all cached positions of each row, padded to the longest row
+        - attention_mask [b, 1, sq, sk]: causal mask over each row's own positions (True == masked)
+        - position_ids [b, sq]: the positions of the new tokens of each row
+
+    :param num_blocks: number of blocks in the pool
+    :param block_size: number of positions per block
+    :param device: device of the tensors computed by prepare
+    """
+
+    def __init__(self, num_blocks, block_size=16, device=None):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.device = device
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables = {}
+        self.seq_lens = {}
+
+        # set by prepare
+        self.step = 0
+        self.max_length = 0  # of the longest row in the batch
+        self.slot_mapping = None
+        self.key_slots = None
+        self.attention_mask = None
+        self.position_ids = None
+        self.copy_src = None
+        self.copy_dst = None
+
+    def add_sequence(self, seq_id):
+        """Adds an empty sequence."""
+        assert seq_id not in self.block_tables, f"sequence {seq_id} already exists"
+        self.block_tables[seq_id] = []
+        self.seq_lens[seq_id] = 0
+
+    def fork(self, parent_id, child_id):
+        """Adds a sequence `child_id` sharing all blocks (and thus all cached positions) of `parent_id`."""
+        assert child_id not in self.block_tables, f"sequence {child_id} already exists"
+        self.block_tables[child_id] = list(self.block_tables[parent_id])
+        self.seq_lens[child_id] = self.seq_lens[parent_id]
+        for block in self.block_tables[child_id]:
+            self.allocator.incref(block)
+
+    def free_sequence(self, seq_id):
+        """Removes a sequence, freeing its references to its blocks."""
+        for block in self.block_tables.pop(seq_id):
+            self.allocator.free(block)
+        del self.seq_lens[seq_id]
+
+    def blocks_needed(self, seq_id, num_tokens):
+        """Number of blocks that have to be allocated to append num_tokens positions to a sequence."""
+        seq_len = self.seq_lens[seq_id]
+        block_table = self.block_tables[seq_id]
+        needed = -(-(seq_len + num_tokens) // self.block_size) - len(block_table)
+        if self._copy_on_write(seq_len, block_table):
+            needed += 1
+        return max(needed, 0)
+
+    def can_append(self, seq_ids, num_tokens):
+        """Whether there are enough free blocks to append num_tokens positions to each of seq_ids."""
+        needed = sum(self.blocks_needed(seq_id, num_tokens) for seq_id in seq_ids)
+        return needed <= self.allocator.num_free_blocks
+
+    @property
+    def num_cached_tokens(self):
+        """Number of positions cached over all sequences (shared positions counted once per sequence)."""
+        return sum(self.seq_lens.values())
+
+    def _copy_on_write(self, seq_len, block_table):
+        # a partially filled last block that other sequences also use
+        return (
+            seq_len % self.block_size != 0
+            and self.allocator.refcounts[block_table[-1]] > 1
+        )
+
+    def prepare(self, seq_ids, num_tokens):
+        """
+        Appends num_tokens positions to each sequence in seq_ids (the rows of the next forward pass, in order),
+        allocating blocks as needed, and computes the tensors of the forward pass (see above).
+        """
+        if not self.can_append(seq_ids, num_tokens):
+            raise RuntimeError(
+                f"out of key / value cache blocks: appending {num_tokens} positions to {len(seq_ids)} sequences "
+                f"needs more than the {self.allocator.num_free_blocks} free blocks"
+            )
+        copies, slot_mapping, past_lens = [], [], []
+        for seq_id in seq_ids:
+            seq_len = self.seq_lens[seq_id]
+            block_table = self.block_tables[seq_id]
+            if self._copy_on_write(seq_len, block_table):
+                block = self.allocator.allocate()
+                copies.append((block_table[-1], block))
+                self.allocator.free(block_table[-1])
+                block_table[-1] = block
+            while len(block_table) * self.block_size < seq_len + num_tokens:
+                block_table.append(self.allocator.allocate())
+
+            slot_mapping.append(
+                [
+                    block_table[p // self.block_size] * self.block_size
+                    + p % self.block_size
+                    for p in range(seq_len, seq_len + num_tokens)
+                ]
+            )
+            past_lens.append(seq_len)
+            self.seq_lens[seq_id] = seq_len + num_tokens
+
+        self.step += 1
+        self.max_length = max(past_lens) + num_tokens
+        num_key_blocks = -(-self.max_length // self.block_size)
+        # rows with fewer blocks are padded with block 0; those positions are masked
+        block_tables = torch.tensor(
+            [
+                self.block_tables[seq_id][:num_key_blocks]
+                + [0] * (num_key_blocks - len(self.block_tables[seq_id]))
+                for seq_id in seq_ids
+            ],
+            dtype=torch.long,
+            device=self.device,
+        )
+        offsets = torch.arange(self.block_size, device=self.device)
+        key_slots = (block_tables.unsqueeze(-1) * self.block_size + offsets).view(
+            len(seq_ids), -1
+        )
+        self.key_slots = key_slots[:, : self.max_length].t().contiguous()
+        self.slot_mapping = torch.tensor(
+            slot_mapping, dtype=torch.long, device=self.device
+        ).t()
+
+        past_lens = torch.tensor(past_lens, dtype=torch.long, device=self.device)
+        self.position_ids = past_lens.unsqueeze(1) + torch.arange(
+            num_tokens, device=self.device
+        )
+        self.attention_mask = (
+            torch.arange(self.max_length, device=self.device)[None, None, None, :]
+            > self.position_ids[:, None, :, None]
+        )
+
+        copies = torch.tensor(copies, dtype=torch.long, device=self.device).view(-1, 2)
+        self.copy_src, self.copy_dst = copies[:, 0], copies[:, 1]
+
+
+class PagedKVCache:
+    """
+    Paged key / value cache of a single attention layer, set as its `layer_past`.
+
+    The layer's keys and values live in a pool of shape [2, num_blocks, block_size, np, hn], allocated on the first
+    forward pass; which blocks belong to which sequence is tracked by the PagedKVCacheManager shared by all layers. New
+    keys / values are written to the slots the manager prepared for this forward pass, and ParallelSelfAttention
+    gathers each row's cached keys / values through its block table.
+
+    :param manager: PagedKVCacheManager
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.pool = None
+        self._step = None
+
+    def _allocate(self, key_layer):
+        # [sq, b, np, hn] -> [2, num_blocks, block_size, np, hn]
+        shape = (2, self.manager.num_blocks, self.manager.block_size) + tuple(
+            key_layer.shape[2:]
+        )
+        if (
+            self.pool is None
+            or self.pool.shape != shape
+            or self.pool.dtype != key_layer.dtype
+            or self.pool.device != key_layer.device
+        ):
+            self.pool = torch.zeros(
+                shape, dtype=key_layer.dtype, device=key_layer.device
+            )
+
+    def write(self, key_layer, value_layer):
+        """Writes key_layer / value_layer ([sq, b, np, hn]) to the slots prepared by the manager."""
+        assert (
+            self._step != self.manager.step
+        ), "PagedKVCacheManager.prepare has to be called before every forward pass"
+        self._step = self.manager.step
+        self._allocate(key_layer)
+
+        if self.manager.copy_src.numel() > 0:
+            # copy on write of blocks that were shared
+            self.pool[:, self.manager.copy_dst] = self.pool[:, self.manager.copy_src]
+
+        slots = self.manager.slot_mapping.reshape(-1)
+        pool = self.pool.view((2, -1) + tuple(self.pool.shape[3:]))
+        pool[0].index_copy_(0, slots, key_layer.reshape((-1,) + pool.shape[2:]))
+        pool[1].index_copy_(0, slots, value_layer.reshape((-1,) + pool.shape[2:]))
+
+    def gather(self):
+        """Returns the cached keys and values of every row ([sk, b, np, hn] each), padded to the longest row."""
+        pool = self.pool.view((2, -1) + tuple(self.pool.shape[3:]))
+        key_value = pool[:, self.manager.key_slots]
+        return key_value[0], key_value[1]
+
+    @property
+    def attention_mask(self):
+        return self.manager.attention_mask
+
+    @property
+    def position_ids(self):
+        return self.manager.position_ids
+
+    def numel(self):
+        # mirrors torch.Tensor.numel(), counting the cached positions of all sequences
+        if self.pool is None:
+            return 0
+        return self.manager.num_cached_tokens * 2 * self.pool[0, 0, 0].numel()
+
+
+class _PromptCacheEntry:
+    def __init__(self, tokens, key_values, block_hashes):
+        self.tokens = tokens
+        self.key_values = key_values
+        self.block_hashes = block_hashes
+
+    @property
+    def nbytes(self):
+        return self.key_values.numel() * self.key_values.element_size()
+
+
+class PromptCache:
+    """
+    LRU cache of the keys / values of prompts after their prefill, so that prompts sharing a prefix (e.g. a long
+    few-shot preamble) only prefill the tokens after it.
+
+    Entries hold the keys / values of all layers of one prompt, [num_layers, 2, prompt_len, np, hn]. They are indexed
+    by the hash of every prefix of the prompt that is a multiple of `block_size` tokens long, so a lookup finds the
+    entries sharing the most blocks with a new prompt without comparing against every entry; the match is then extended
+    token by token. Keys / values only depend on the tokens up to their position, so the first n positions of any entry
+    sharing n tokens with a prompt can be restored.
+
+    Least recently used entries are evicted to keep the cached keys / values within `max_bytes`.
+
+    :param max_bytes: memory budget of the cached keys / values
+    :param block_size: granularity (in tokens) of the prefix hashes; shorter prompts are not cached
+    """
+
+    def __init__(self, max_bytes, block_size=16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict()  # in least recently used order
+        self.index = {}  # block prefix hash -> ids of the entries with that prefix
+        self.nbytes = 0
+        self._next_id = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.restored_tokens = 0
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "restored_tokens": self.restored_tokens,
+            "entries": len(self.entries),
+            "nbytes": self.nbytes,
+        }
+
+    def _block_hashes(self, tokens):
+        # chained, so every hash identifies the whole prefix up to the end of its block
+        hashes, h = [], 0
+        for end in range(self.block_size, len(tokens) + 1, self.block_size):
+            h = hash((h, tuple(tokens[end - self.block_size : end])))
+            hashes.append(h)
+        return hashes
+
+    def lookup(self, tokens):
+        """
+        Finds the entry sharing the longest prefix with `tokens` (a list of token ids).
+
+        returns: tuple of (entry or None, number of leading tokens shared with it)
+        """
+        hashes = self._block_hashes(tokens)
+        for num_blocks in range(len(hashes), 0, -1):
+            best_id, best_length = None, 0
+            # all candidates share num_blocks blocks, so extending each one is cheaper than a block
+            for entry_id in reversed(self.index.get(hashes[num_blocks - 1], [])):
+                entry = self.entries[entry_id]
+                length = num_blocks * self.block_size
+                max_length = min(len(tokens), len(entry.tokens))
+                while length < max_length and entry.tokens[length] == tokens[length]:
+                    length += 1
+                if length > best_length:
+                    best_id, best_length = entry_id, length
+            if best_id is None:
+                continue
+            entry = self.entries[best_id]
+            if entry.tokens[:best_length] != tokens[:best_length]:
+                return None, 0  # hash collision
+            self.entries.move_to_end(best_id)
+            return entry, best_length
+        return None, 0
+
+    def restore(self, rows):
+        """
+        Looks up the prompts of a batch (a list with a list of token ids per row). At least one token of each prompt is
+        left to be forwarded, and all rows restore the same number of positions.
+
+        returns: tuple of (number of restored positions, list with the restored keys / values of every layer as
+                 [2, length, b, np, hn]; empty on a miss)
+        """
+        matches = [self.lookup(tokens[:-1]) for tokens in rows]
+        length = min(length for _, length in matches)
+        if length == 0:
+            self.misses += len(rows)
+            return 0, []
+        self.hits += len(rows)
+        self.restored_tokens += length * len(rows)
+        num_layers = matches[0][0].key_values.size(0)
+        return length, [
+            torch.stack(
+                [entry.key_values[layer, :, :length] for entry, _ in matches], dim=2
+            )
+            for layer in range(num_layers)
+        ]
+
+    def store(self, rows, key_values):
+        """
+        Caches the keys / values of the first `length` tokens of each row of a batch (a list with a list of token ids per
+        row), unless an entry already holds all of them.
+
+        key_values: list with the keys / values of every layer, [2, length, b, np, hn]
+        """
+        for row, tokens in enumerate(rows):
+            tokens = list(tokens[: key_values[0].size(1)])
+            if len(tokens) < self.block_size:
+                continue
+            if self.lookup(tokens)[1] == len(tokens):
+                continue
+            entry = _PromptCacheEntry(
+                tokens,
+                torch.stack([kv[:, : len(tokens), row] for kv in key_values]),
+                self._block_hashes(tokens),
+            )
+            if entry.nbytes > self.max_bytes:
+                continue
+            while self.nbytes + entry.nbytes > self.max_bytes:
+                self._evict()
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self.entries[entry_id] = entry
+            for h in entry.block_hashes:
+                self.index.setdefault(h, []).append(entry_id)
+            self.nbytes += entry.nbytes
+
+    def _evict(self):
+        entry_id, entry = self.entries.popitem(last=False)
+        for h in entry.block_hashes:
+            self.index[h].remove(entry_id)
+            if not self.index[h]:
+                del self.index[h]
+        self.nbytes -= entry.nbytes
+
+    def clear(self):
+        while self.entries:
+            self._evict()
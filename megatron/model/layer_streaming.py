@@ -0,0 +1,213 @@
+"""
+Inference streaming the weights of a model's layers from a pipeline parallel checkpoint, for models larger than host or
+device memory: the layers are built without weights and load theirs from their layer_XX-model_YY-model_states.pt file
+just before they run, while the next layer's file is read on a background thread.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import torch
+from deepspeed.pipe import TiedLayerSpec
+
+from megatron import print_rank_0
+from megatron.model.gpt2_model import GPT2ModelPipe, build_sequential_layers
+from megatron.model.utils import SequentialWrapper
+
+
+def release_weights(module):
+    """Frees the parameters of module, leaving empty tensors of their dtype and device in their place."""
+    for param in module.parameters():
+        param.data = torch.empty(0, dtype=param.dtype, device=param.device)
+
+
+class StreamingSequentialWrapper(SequentialWrapper):
+    """
+    A SequentialWrapper whose layers hold no weights until they run. Every forward pass loads each layer's weights from
+    its file (see megatron.checkpointing.stream_checkpoint_weights) and frees them again after the layer ran, except
+    for the first `resident_layers` layers with weights and the `pinned_layers` (e.g. tied layers, whose weights other
+    layers use), which are kept once loaded. While a layer runs, the next one's weights are read on a background
+    thread (wrapping around to the first layer of the next forward pass), so at most the kept layers and two streamed
+    ones hold weights at a time.
+
+    Buffers (e.g. rotary frequencies) are small and stay resident. `stats` counts the loaded layers and bytes, and the
+    time forward passes waited for weights.
+    """
+
+    def __init__(self, layers, resident_layers=0, pinned_layers=(), **kwargs):
+        super().__init__(
+            layers,
+            activation_checkpoint_interval=0,
+            activation_checkpoint_func=None,
+            **kwargs,
+        )
+        self.resident_layers = resident_layers
+        self.pinned_layers = set(pinned_layers)
+        self.layer_files = {}
+        self._resident = set()
+        self._loaded = set()
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="layer_streaming"
+        )
+        self._copy_stream = None
+        self.stats = {"layers_loaded": 0, "bytes_loaded": 0, "load_wait_seconds": 0.0}
+
+    def has_weights(self, idx):
+        """True if layer idx has parameters or persistent buffers, i.e. a file in a pipeline parallel checkpoint."""
+        return len(self.sequential[idx].state_dict()) > 0
+
+    def set_layer_files(self, layer_files):
+        """
+        Sets the files the layers load their weights from, a dict of layer index -> file of every layer with weights.
+        """
+        assert all(
+            idx in layer_files
+            for idx in range(len(self.sequential))
+            if self.has_weights(idx)
+        ), "every layer with weights needs a file"
+        wait(self._pending.values())
+        self._pending.clear()
+        for idx in list(self._loaded):
+            self._release(idx)
+        self.layer_files = dict(layer_files)
+        order = sorted(self.layer_files)
+        self._resident = set(order[: self.resident_layers]) | (
+            self.pinned_layers & set(order)
+        )
+        self.stats = {"layers_loaded": 0, "bytes_loaded": 0, "load_wait_seconds": 0.0}
+
+    def _read_layer(self, idx):
+        """Reads the weights of layer idx onto its device (runs on the background thread)."""
+        state_dict = torch.load(self.layer_files[idx], map_location="cpu")
+        layer = self.sequential[idx]
+        targets = dict(layer.named_parameters())
+        targets.update(layer.named_buffers())
+        expected = set(layer.state_dict().keys())
+        if set(state_dict.keys()) != expected:
+            raise RuntimeError(
+                f"Error loading layer {idx} from {self.layer_files[idx]}: missing keys "
+                f"{sorted(expected - set(state_dict.keys()))}, unexpected keys "
+                f"{sorted(set(state_dict.keys()) - expected)}"
+            )
+
+        event = None
+        device = next(iter(targets.values())).device
+        if device.type == "cuda":
+            if self._copy_stream is None:
+                self._copy_stream = torch.cuda.Stream(device)
+            event = torch.cuda.Event()
+        tensors, nbytes = {}, 0
+        for name, tensor in state_dict.items():
+            target = targets[name]
+            if tensor.is_floating_point():
+                tensor = tensor.to(target.dtype)
+            if event is not None:
+                with torch.cuda.stream(self._copy_stream):
+                    tensor = tensor.pin_memory().to(target.device, non_blocking=True)
+            tensors[name] = tensor
+            nbytes += tensor.numel() * tensor.element_size()
+        if event is not None:
+            event.record(self._copy_stream)
+        return tensors, event, nbytes
+
+    def _prefetch(self, idx):
+        if idx is not None and idx not in self._loaded and idx not in self._pending:
+            self._pending[idx] = self._executor.submit(self._read_layer, idx)
+
+    def _next_to_load(self, idx):
+        """The first layer with weights after idx (wrapping around) that isn't loaded yet."""
+        order = sorted(self.layer_files)
+        position = order.index(idx)
+        for next_idx in order[position + 1 :] + order[: position + 1]:
+            if next_idx not in self._loaded:
+                return next_idx
+        return None
+
+    def _load(self, idx):
+        if idx in self._loaded:
+            return
+        self._prefetch(idx)
+        start = time.perf_counter()
+        tensors, event, nbytes = self._pending.pop(idx).result()
+        self.stats["load_wait_seconds"] += time.perf_counter() - start
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            for tensor in tensors.values():
+                tensor.record_stream(stream)
+
+        layer = self.sequential[idx]
+        params = dict(layer.named_parameters())
+        buffers = dict(layer.named_buffers())
+        for name, tensor in tensors.items():
+            if name in params:
+                params[name].data = tensor
+            else:
+                buffers[name].copy_(tensor)
+        self._loaded.add(idx)
+        self.stats["layers_loaded"] += 1
+        self.stats["bytes_loaded"] += nbytes
+
+    def _release(self, idx):
+        release_weights(self.sequential[idx])
+        self._loaded.discard(idx)
+
+    def forward(self, forward_input):
+        assert self.layer_files or not any(
+            self.has_weights(idx) for idx in range(len(self.sequential))
+        ), "set the layer files (see stream_checkpoint_weights) before running the model"
+        x = forward_input
+        for idx, layer in enumerate(self.sequential):
+            streamed = idx in self.layer_files
+            if streamed:
+                self._load(idx)
+                self._prefetch(self._next_to_load(idx))
+            x = layer(x)
+            if streamed and idx not in self._resident:
+                self._release(idx)
+        return x
+
+
+def build_layers_without_weights(neox_args, use_cache=False, parallel_output=True):
+    """
+    Builds the layers of the sequential model one at a time, freeing each layer's weights right after it is built, so
+    that the whole model's weights are never allocated (e.g. before they are streamed or memory mapped from a
+    checkpoint). Returns the layers, the indices of the tied layers and the number of parameters on this rank.
+    """
+    specs = GPT2ModelPipe.layer_specs(
+        neox_args,
+        num_tokentypes=0,
+        parallel_output=parallel_output,
+        use_cache=use_cache,
+    )
+    tied_layers, num_params = [], 0
+
+    def release(idx, spec, module):
+        nonlocal num_params
+        num_params += sum(p.nelement() for p in module.parameters())
+        release_weights(module)
+        if isinstance(spec, TiedLayerSpec):
+            tied_layers.append(idx)
+
+    layers = build_sequential_layers(specs, on_build=release)
+    return layers, tied_layers, num_params
+
+
+def get_streaming_model(neox_args, use_cache=False, parallel_output=True):
+    """
+    Build the sequential model for layer streaming (see StreamingSequentialWrapper) without its weights. Returns the
+    model and its number of parameters on this rank.
+    """
+    print_rank_0("building GPT2 model for layer streaming ...")
+    layers, tied_layers, num_params = build_layers_without_weights(
+        neox_args, use_cache=use_cache, parallel_output=parallel_output
+    )
+    model = StreamingSequentialWrapper(
+        layers,
+        resident_layers=neox_args.layer_streaming_resident_layers,
+        # later layers use the weights of tied layers
+        pinned_layers=tied_layers,
+        parent_class_name=GPT2ModelPipe.__name__,
+    )
+    return model, num_params
@@ -22,10 +22,17 @@ class SinusoidalPositionalEmbedding(torch.nn.Module):
 
 
 class RotaryEmbedding(torch.nn.Module):
-    def __init__(self, dim, base=10000, precision=torch.half):
+    """
+    Rotary position embedding (https://arxiv.org/abs/2104.09864) tables. The cos / sin tables are computed once in
+    float32 for max_seq_len positions (growing only past it) and stored in `precision`; forward returns views of their
+    first seq_len positions, so cached decoding steps don't recompute them.
+    """
+
+    def __init__(self, dim, base=10000, precision=torch.half, max_seq_len=None):
         super().__init__()
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer("inv_freq", inv_freq)
+        self.max_seq_len = max_seq_len
         self.seq_len_cached = None
         self.cos_cached = None
         self.sin_cached = None
@@ -34,19 +41,36 @@ class RotaryEmbedding(torch.nn.Module):
     def forward(self, x, seq_dim=1, seq_len=None):
         if seq_len is None:
             seq_len = x.shape[seq_dim]
-        if seq_len != self.seq_len_cached:
-            self.seq_len_cached = seq_len
-            t = torch.arange(seq_len, device=x.device).type_as(self.inv_freq)
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        if (
+            self.seq_len_cached is None
+            or seq_len > self.seq_len_cached
+            or self.cos_cached.device != x.device
+        ):
+            self.seq_len_cached = max(
+                seq_len, self.max_seq_len or 0, self.seq_len_cached or 0
+            )
+            t = torch.arange(self.seq_len_cached, device=x.device).float()
+            freqs = torch.einsum("i,j->ij", t, self.inv_freq.float())
             emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            if self.precision == torch.bfloat16:
-                emb = emb.float()
-            self.cos_cached = emb.cos()[:, None, None, :]
-            self.sin_cached = emb.sin()[:, None, None, :]
-            if self.precision == torch.bfloat16:
-                self.cos_cached = self.cos_cached.bfloat16()
-                self.sin_cached = self.sin_cached.bfloat16()
-        return self.cos_cached, self.sin_cached
+            self.cos_cached = emb.cos()[:, None, None, :].to(self.precision)
+            self.sin_cached = emb.sin()[:, None, None, :].to(self.precision)
+        return self.cos_cached[:seq_len], self.sin_cached[:seq_len]
+
+    def rotate_(self, x, shift):
+        """
+        Rotates x ([..., dim], e.g. cached keys) in place by shift positions; a negative shift moves cached keys to
+        earlier positions. The angles are computed in float32 rather than read from the tables in `precision`, so that
+        keys rotated repeatedly don't accumulate the tables' rounding.
+        """
+        angles = shift * self.inv_freq.float().to(x.device)
+        cos, sin = angles.cos(), angles.sin()
+        half = x.shape[-1] // 2
+        x1, x2 = x[..., :half], x[..., half:]
+        x1_float, x2_float = x1.float(), x2.float()
+        rotated = (x1_float * cos - x2_float * sin, x2_float * cos + x1_float * sin)
+        x1.copy_(rotated[0])
+        x2.copy_(rotated[1])
+        return x
 
 
 # rotary pos emb helpers:
@@ -78,8 +102,36 @@ def apply_rotary_pos_emb_torch(
     return (q * cos) + (rotate_half(q) * sin), (k * cos) + (rotate_half(k) * sin)
 
 
+def apply_rotary_pos_emb_(q, k, cos, sin, offset: int = 0):
+    """
+    In-place apply_rotary_pos_emb for inference: rotates q and k, which may be views (e.g. the rotary dims of the query
+    / key heads, so that partial rotary needs no concatenation), allocating only one half-size temporary per tensor.
+    Not differentiable.
+    """
+    cos, sin = (
+        cos[offset : q.shape[0] + offset, ...],
+        sin[offset : q.shape[0] + offset, ...],
+    )
+    # both halves of the tables are the same
+    half = q.shape[-1] // 2
+    cos, sin = cos[..., :half], sin[..., :half]
+    for x in (q, k):
+        x1, x2 = x[..., :half], x[..., half:]
+        x1_sin = x1 * sin
+        # x1 * cos - x2 * sin, x2 * cos + x1 * sin
+        x1.mul_(cos).addcmul_(x2, sin, value=-1)
+        x2.mul_(cos).add_(x1_sin)
+    return q, k
+
+
 class AliBi(torch.nn.Module):
-    def __init__(self, num_heads, mp_size=1, mp_rank=1):
+    """
+    Attention with linear biases (https://arxiv.org/abs/2108.12409). The bias matrix is built once for max_seq_len
+    positions (and only rebuilt to grow past it), and every forward adds a slice of it, so that a cached decoding step
+    costs O(sk) rather than rebuilding an O(sk^2) matrix.
+    """
+
+    def __init__(self, num_heads, mp_size=1, mp_rank=1, max_seq_len=None):
         super().__init__()
         # megatron splits across heads, so we need to make sure each
         # head receives the correct matrix
@@ -88,6 +140,7 @@ class AliBi(torch.nn.Module):
         self.mp_rank = mp_rank
         self.num_heads = num_heads
         self.slice_size = num_heads // mp_size
+        self.max_seq_len = max_seq_len
         self.cached_matrix = None
         self.cached_seq_len = None
         slopes = torch.Tensor(self._get_slopes(num_heads))[
@@ -118,34 +171,33 @@ class AliBi(torch.nn.Module):
                 ]
             )
 
-    def forward(self, x):
-        # [b, np, sq, sk]
-        seq_len_q = x.shape[-2]
-        seq_len_k = x.shape[-1]
-        if self.cached_seq_len != seq_len_k:
-            a = -torch.tril(
-                torch.arange(seq_len_k).view(seq_len_k, 1).repeat(1, seq_len_k)
-                + torch.arange(0, -seq_len_k, -1)
-            )
-            a = a.to(x.device).to(x.dtype)
+    def bias(self, seq_len, device, dtype):
+        """Returns the [np, n, n] bias matrix for n >= seq_len positions, building it on first use."""
+        a = self.cached_matrix
+        if (
+            a is None
+            or self.cached_seq_len < seq_len
+            or a.device != device
+            or a.dtype != dtype
+        ):
+            n = max(seq_len, self.max_seq_len or 0, self.cached_seq_len or 0)
+            positions = torch.arange(n)
+            a = -(positions.view(n, 1) - positions).clamp(min=0)
+            a = a.to(device).to(dtype)
             slopes = self.slopes.to(a.device).to(a.dtype)
             a = a * slopes.view(self.slopes.shape[0], 1, 1)
-            self.cached_seq_len = seq_len_k
+            self.cached_seq_len = n
             self.cached_matrix = a
-        else:
-            a = self.cached_matrix
-
-        if seq_len_q != seq_len_k:
-            # In the train case x has dimensionality [b, np, sq, sk] with sq == sk
-            # The number of query tokens is equal to the number of key tokens
-            # At inference time with cache in layer_past sq is not equal to sk. sq only contains one token (the last one in the full sequence)
-            # In this case we use the appropriate token index of the cache matrix.
-            # As the cache matrix could already be bigger from a past inference, not the last token index in the sq sequence is used
-            assert (
-                seq_len_q == 1
-            ), "assumption sq == sk unless at inference time with cache in layer_past with sq == 1"
-            a = a[:, seq_len_k - 1, :].view(
-                a.shape[0], 1, a.shape[2]
-            )  # seq_len_k - 1 points to the last token index in the current inference batch.
-
-        return x + a
+        return a
+
+    def forward(self, x, offset=None):
+        # [b, np, sq, sk]
+        seq_len_q = x.shape[-2]
+        seq_len_k = x.shape[-1]
+        if offset is None:
+            # In the train case sq == sk. At inference time with cache in layer_past, sq only contains the last
+            # tokens of the full sequence (one token when decoding, or more when a prompt is forwarded on top of an
+            # existing cache).
+            offset = seq_len_k - seq_len_q
+        a = self.bias(max(offset + seq_len_q, seq_len_k), x.device, x.dtype)
+        return x + a[:, offset : offset + seq_len_q, :seq_len_k]
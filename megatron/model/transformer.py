@@ -18,6 +18,8 @@
 """Transformer."""
 
 import math
+import warnings
+
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
@@ -31,6 +33,7 @@ from megatron.model.positional_embeddings import (
     RotaryEmbedding,
     apply_rotary_pos_emb,
     apply_rotary_pos_emb_torch,
+    apply_rotary_pos_emb_,
     AliBi,
 )
 from megatron.model.fused_bias_dropout import (
@@ -39,6 +42,7 @@ from megatron.model.fused_bias_dropout import (
     bias_dropout_add_fused_inference,
 )
 from megatron.model.utils import configure_sparse_attention
+from megatron.model.kv_cache import Int8KVCache, PagedKVCache, StaticKVCache
 
 # flags required to enable jit fusion kernels
 torch._C._jit_set_profiling_mode(False)
@@ -67,6 +71,19 @@ torch._C._jit_override_can_fuse_on_gpu(True)
                                      unmasked-attention-scores, attention-mask)
 """
 
+_warned_paged_kv_cache_fallback = False
+
+
+def _warn_paged_kv_cache_fallback():
+    """Warns once that kv_cache_type "paged" falls back to "static" outside the continuous batching scheduler."""
+    global _warned_paged_kv_cache_fallback
+    if not _warned_paged_kv_cache_fallback:
+        _warned_paged_kv_cache_fallback = True
+        warnings.warn(
+            'kv_cache_type "paged" is only used by the continuous batching scheduler (see ContinuousBatchingScheduler); '
+            'other generation uses a "static" kv cache'
+        )
+
 
 class ParallelMLP(nn.Module):
     """MLP.
@@ -203,6 +220,13 @@ class ParallelSelfAttention(nn.Module):
         if self.apply_query_key_layer_scaling:
             self.attention_softmax_in_fp32 = True
         self.layer_number = layer_number
+        # paged caches are set up by the caller (see PagedKVCacheManager); fixed batch generation uses static ones
+        self.static_kv_cache = neox_args.kv_cache_type in ["static", "paged", "int8"]
+        self.paged_kv_cache = neox_args.kv_cache_type == "paged"
+        self.kv_cache_class = (
+            Int8KVCache if neox_args.kv_cache_type == "int8" else StaticKVCache
+        )
+        self.max_seq_len = neox_args.seq_length
         # Per attention head and per partition values.
         world_size = mpu.get_model_parallel_world_size()
         self.hidden_size_per_partition = mpu.divide(neox_args.hidden_size, world_size)
@@ -236,6 +260,7 @@ class ParallelSelfAttention(nn.Module):
                 neox_args.num_attention_heads,
                 neox_args.model_parallel_size,
                 mpu.get_model_parallel_rank(),
+                max_seq_len=neox_args.max_position_embeddings,
             )
 
         # TODO: this arg shouldn't need to be passed in - get from neox_args
@@ -253,7 +278,10 @@ class ParallelSelfAttention(nn.Module):
                 else self.hidden_size_per_attention_head
             )
             self.rotary_emb = RotaryEmbedding(
-                dim, base=neox_args.rotary_emb_base, precision=neox_args.params_dtype
+                dim,
+                base=neox_args.rotary_emb_base,
+                precision=neox_args.params_dtype,
+                max_seq_len=neox_args.max_position_embeddings,
             )
         else:
             self.rotary_emb = None
@@ -296,6 +324,14 @@ class ParallelSelfAttention(nn.Module):
     def attention(
         self, query_layer, key_layer, value_layer, layer_past, attention_mask
     ):
+        if self.use_cache and isinstance(layer_past, PagedKVCache):
+            # gather each row's keys / values through its block table; positions past a row's length are masked
+            key_layer, value_layer = layer_past.gather()
+            attention_mask = layer_past.attention_mask
+        elif self.use_cache and isinstance(layer_past, Int8KVCache):
+            # dequantize the keys / values of every cached position, the new ones included
+            key_layer, value_layer = layer_past.cached()
+
         # ===================================
         # Raw attention scores. [b, np, s, s]
         # ===================================
@@ -314,23 +350,29 @@ class ParallelSelfAttention(nn.Module):
         )
         key_layer = key_layer.view(output_size[3], output_size[0] * output_size[1], -1)
 
-        # preallocating result tensor: [b * np, sq, sk]
-        matmul_result = torch.empty(
-            output_size[0] * output_size[1],
-            output_size[2],
-            output_size[3],
-            dtype=query_layer.dtype,
-            device=torch.cuda.current_device(),
-        )
-
         # Raw attention scores. [b * np, sq, sk]
-        matmul_result = torch.baddbmm(
-            matmul_result,
-            query_layer.transpose(0, 1),  # [b * np, sq, hn]
-            key_layer.transpose(0, 1).transpose(1, 2),  # [b * np, hn, sk]
-            beta=0.0,
-            alpha=(1.0 / self.norm_factor),
-        )
+        if query_layer.is_cuda:
+            # preallocating result tensor: [b * np, sq, sk]
+            matmul_result = torch.empty(
+                output_size[0] * output_size[1],
+                output_size[2],
+                output_size[3],
+                dtype=query_layer.dtype,
+                device=query_layer.device,
+            )
+            matmul_result = torch.baddbmm(
+                matmul_result,
+                query_layer.transpose(0, 1),  # [b * np, sq, hn]
+                key_layer.transpose(0, 1).transpose(1, 2),  # [b * np, hn, sk]
+                beta=0.0,
+                alpha=(1.0 / self.norm_factor),
+            )
+        else:
+            # cpu baddbmm can return nans with beta=0, so use a plain bmm there
+            matmul_result = torch.bmm(
+                query_layer.transpose(0, 1),
+                key_layer.transpose(0, 1).transpose(1, 2),
+            ).mul_(1.0 / self.norm_factor)
 
         # change view to [b, np, sq, sk]
         attention_scores = matmul_result.view(*output_size)
@@ -341,9 +383,11 @@ class ParallelSelfAttention(nn.Module):
 
         if self.use_cache:
             with torch.no_grad():
-                attention_mask = attention_mask[
-                    ..., : attention_scores.size(3), : attention_scores.size(3)
-                ]
+                sq, sk = attention_scores.size(2), attention_scores.size(3)
+                if attention_mask.size(-2) != sq:
+                    # full [s, s] mask: the queries are the last sq of the sk positions
+                    attention_mask = attention_mask[..., sk - sq : sk, :]
+                attention_mask = attention_mask[..., :sk]
 
         # ===========================
         # Attention probs and dropout
@@ -361,8 +405,9 @@ class ParallelSelfAttention(nn.Module):
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-        with mpu.get_cuda_rng_tracker().fork():
-            attention_probs = self.attention_dropout(attention_probs)
+        if self.training:
+            with mpu.get_cuda_rng_tracker().fork():
+                attention_probs = self.attention_dropout(attention_probs)
 
         # =========================
         # Context layer. [sq, b, hp]
@@ -414,6 +459,39 @@ class ParallelSelfAttention(nn.Module):
             query_layer, key_layer, value_layer, attn_mask=attn_mask, rpe=rpe
         )
 
+    def evict_cache(self, layer_past, start, n):
+        """
+        Drops the n cached positions of layer_past (a StaticKVCache, Int8KVCache or [2, s, b, np, hn] tensor) from
+        `start` on, moving the later positions n positions earlier. Their keys are rotated back by n positions, so
+        rotary embeddings see the keys at their new cache positions, like AliBi and the relative position bias, which
+        only depend on cache indices.
+
+        returns: the updated layer_past
+        """
+        assert not isinstance(
+            layer_past, PagedKVCache
+        ), "paged key / value caches don't support eviction"
+        if isinstance(layer_past, Int8KVCache):
+            layer_past.evict(start, n)
+            keys = layer_past.cached()[0, start:]
+        elif isinstance(layer_past, StaticKVCache):
+            layer_past.evict(start, n)
+            keys = layer_past.buffer[0, start : layer_past.seq_len]
+        else:
+            layer_past = torch.cat(
+                (layer_past[:, :start], layer_past[:, start + n :]), dim=1
+            )
+            keys = layer_past[0, start:]
+        if exists(self.rotary_emb):
+            rotary_keys = keys
+            if exists(self.rotary_ndims):
+                rotary_keys = keys[..., : self.rotary_ndims]
+            self.rotary_emb.rotate_(rotary_keys, -n)
+            if isinstance(layer_past, Int8KVCache):
+                # requantize the rotated keys
+                layer_past.store(0, start, keys)
+        return layer_past
+
     def forward(self, hidden_states, attention_mask, layer_past=None):
 
         # hidden_states: [sq, b, h]
@@ -437,6 +515,27 @@ class ParallelSelfAttention(nn.Module):
             mixed_x_layer, 3
         )
 
+        if self.use_cache and self.static_kv_cache and layer_past is None:
+            if self.paged_kv_cache:
+                _warn_paged_kv_cache_fallback()
+            layer_past = self.kv_cache_class(self.max_seq_len)
+        static_cache = self.use_cache and isinstance(layer_past, StaticKVCache)
+        paged_cache = self.use_cache and isinstance(layer_past, PagedKVCache)
+        assert not (
+            paged_cache and self.sparse
+        ), "paged key / value caches are not supported with sparse attention"
+        assert not (
+            isinstance(layer_past, Int8KVCache) and self.sparse
+        ), "int8 key / value caches are not supported with sparse attention"
+
+        # number of positions already in the cache, and the position of the first of them
+        past_length, position_offset = 0, 0
+        if static_cache:
+            past_length = layer_past.seq_len
+            position_offset = layer_past.position_offset
+        elif not paged_cache and exists(layer_past) and layer_past.numel() > 0:
+            past_length = layer_past[0].shape[0]
+
         if exists(self.rotary_emb):
             if exists(self.rotary_ndims):
                 # partial rotary
@@ -455,33 +554,57 @@ class ParallelSelfAttention(nn.Module):
                 apply_rotary_pos_emb_torch if self.bf16 else apply_rotary_pos_emb
             )
 
-            seq_len = key_layer.shape[0]
-            offset = 0
-            if exists(layer_past) and layer_past.numel() > 0:
-                offset = layer_past[0].shape[0]
-                seq_len += offset
-            cos, sin = self.rotary_emb(value_layer, seq_len=seq_len)
-            query_layer, key_layer = apply_rotary_fn(
-                query_rot, key_rot, cos, sin, offset=offset
-            )
+            if paged_cache:
+                # every row is at its own position: look up cos / sin per row, [sq, b, 1, rotary dim]
+                positions = layer_past.position_ids.t()
+                cos, sin = self.rotary_emb(
+                    value_layer,
+                    seq_len=max(self.max_seq_len, layer_past.manager.max_length),
+                )
+                cos, sin = cos[:, 0][positions], sin[:, 0][positions]
+                offset = 0
+            else:
+                offset = position_offset + past_length
+                seq_len = key_layer.shape[0] + offset
+                cos, sin = self.rotary_emb(value_layer, seq_len=seq_len)
+            if not torch.is_grad_enabled():
+                # rotate the rotary dims of the query / key heads in place
+                apply_rotary_pos_emb_(query_rot, key_rot, cos, sin, offset=offset)
+            else:
+                query_layer, key_layer = apply_rotary_fn(
+                    query_rot, key_rot, cos, sin, offset=offset
+                )
 
-            if exists(self.rotary_ndims):
-                query_layer = torch.cat((query_layer, query_pass), dim=-1)
-                key_layer = torch.cat((key_layer, key_pass), dim=-1)
+                if exists(self.rotary_ndims):
+                    query_layer = torch.cat((query_layer, query_pass), dim=-1)
+                    key_layer = torch.cat((key_layer, key_pass), dim=-1)
 
         # ==================================
         # Cache key and value for inference
         # ==================================
 
-        if exists(layer_past) and layer_past.numel() > 0:
-            past_key, past_value = layer_past
-            key_layer = torch.cat((past_key.type_as(key_layer), key_layer), dim=0)
-            value_layer = torch.cat(
-                (past_value.type_as(value_layer), value_layer), dim=0
-            )
+        if paged_cache:
+            # written to the cache's blocks here, gathered in self.attention
+            layer_past.write(key_layer, value_layer)
+            present = layer_past
+        elif static_cache and isinstance(layer_past, Int8KVCache):
+            # quantized into the cache here, dequantized in self.attention
+            layer_past.write(key_layer, value_layer)
+            present = layer_past
+        elif static_cache:
+            # write the new keys / values in place and attend over everything cached so far
+            key_layer, value_layer = layer_past.update(key_layer, value_layer)
+            present = layer_past
+        else:
+            if past_length > 0:
+                past_key, past_value = layer_past
+                key_layer = torch.cat((past_key.type_as(key_layer), key_layer), dim=0)
+                value_layer = torch.cat(
+                    (past_value.type_as(value_layer), value_layer), dim=0
+                )
 
-        if self.use_cache:
-            present = torch.stack((key_layer, value_layer))
+            if self.use_cache:
+                present = torch.stack((key_layer, value_layer))
 
         if not self.sparse:
             context_layer = self.attention(
@@ -676,11 +799,16 @@ class ParallelTransformerLayerPipe(ParallelTransformerLayer):
 class ParallelLinearPipe(ParallelLinear):
     """Another helper class to pass presents through to the output when doing inference with a Pipe Parallel model"""
 
+    # set by `inference_mode(last_position_only=True)`: only project the last position [b, s, h] -> [b, 1, vocab]
+    last_position_only = False
+
     def forward(self, args):
         assert isinstance(
             args, torch.Tensor
         ), "ParallelLinearPipe expects a single argument - hidden_states"
         hidden_state = args
+        if self.last_position_only:
+            hidden_state = hidden_state[:, -1:]
         logits, bias = super().forward(hidden_state)
         return logits
 
@@ -705,10 +833,7 @@ def parallel_lm_logits(input_, word_embeddings_weight, parallel_output, bias=Non
     input_parallel = mpu.copy_to_model_parallel_region(input_)
 
     # Matrix multiply.
-    if bias is None:
-        logits_parallel = F.linear(input_parallel, word_embeddings_weight)
-    else:
-        logits_parallel = F.linear(input_parallel, word_embeddings_weight, bias)
+    logits_parallel = mpu.linear(input_parallel, word_embeddings_weight, bias)
 
     # Gather if needed.
     if parallel_output:
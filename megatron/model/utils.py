@@ -20,6 +20,7 @@
 import torch
 from megatron.model.norms import LayerNorm, RMSNorm, ScaleNorm
 from megatron.model.fused_softmax import SoftmaxFusionTypes
+from megatron.model.kv_cache import PagedKVCache, StaticKVCache
 from types import GeneratorType
 
 
@@ -78,6 +79,19 @@ class Lambda(torch.nn.Module):
         return self.func(x)
 
 
+class InferenceEngine(torch.nn.Module):
+    """
+    Wraps a model for inference without deepspeed (e.g. on cpu), exposing it as `module` like a deepspeed engine.
+    """
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+
 class SequentialWrapper(torch.nn.Module):
     """
     Used to convert a deepspeed PipelineModule to an nn.Sequential like model whilst retaining
@@ -105,20 +119,67 @@ class SequentialWrapper(torch.nn.Module):
         params = [f.parameters() for f in funcs if isinstance(f, torch.nn.Module)]
         return any(len(list(p)) > 0 for p in params)
 
-    def inference_mode(self, use_cache=True):
+    def inference_mode(
+        self, use_cache=True, last_position_only=False, parallel_output=False
+    ):
         """
         Sets up the model for inference by turning on k/v caching (if specified) and setting `parallel output` of the final layer to false,
         so logits are gathered across model parallel ranks.
 
         :param cache: (bool) True if you want to use caching during inference, False otherwise
+        :param last_position_only: (bool) True if the final layer should only compute logits for the last position, e.g. when
+                                   sampling the next token. False to return logits for every position.
+        :param parallel_output: (bool) True to keep the logits split across model parallel ranks along the vocab, e.g. for
+                                sample_tokens_vocab_parallel. Needs an untied, column parallel output layer.
         """
         _set_use_cache(self.sequential, use_cache)
+        _set_last_position_only(self.sequential, last_position_only)
+        final_linear = next(
+            (
+                l.final_linear
+                for l in reversed(self.sequential)
+                if hasattr(l, "final_linear")
+            ),
+            None,
+        )
+        # only a column parallel layer (which gathers its output) splits the logits along the vocab
+        assert not parallel_output or hasattr(
+            final_linear, "gather_output"
+        ), "vocab-parallel logits need an untied, column parallel output layer"
+        if final_linear is not None:
+            final_linear.set_parallel_output(parallel_output)
 
     def train_mode(self):
         """
         Sets up the model for training by turning off k/v caching.
         """
         _set_use_cache(self.sequential, False)
+        _set_last_position_only(self.sequential, False)
+
+    def clear_cache(self):
+        """
+        Clears the kv cache on the model.
+        """
+        _clear_cache(self.sequential)
+
+    def truncate_cache(self, seq_len):
+        """
+        Truncates the kv cache on the model to its first seq_len positions.
+        """
+        _truncate_cache(self.sequential, seq_len)
+
+    def select_cache_rows(self, index):
+        """
+        Keeps only the batch rows in `index` of the kv cache on the model.
+        """
+        _select_cache_rows(self.sequential, index)
+
+    def evict_cache(self, start, n):
+        """
+        Drops the n cached positions from `start` on of the kv cache on the model, e.g. the oldest positions after the
+        sink tokens of sliding window generation.
+        """
+        _evict_cache(self.sequential, start, n)
 
     def forward(self, forward_input):
         def exec_range_func(start, end):
@@ -191,6 +252,93 @@ def _set_use_cache(modules, value: bool):
     recursive_setattr(modules, "use_cache", value, assert_type=bool)
 
 
+def _set_last_position_only(modules, value: bool):
+    """
+    Recursively sets last_position_only to `value` on a list of pytorch modules, if they have a last_position_only attribute.
+    last_position_only is used to decide whether the final layer computes logits for the last position only, or for all positions.
+    """
+    recursive_setattr(modules, "last_position_only", value, assert_type=bool)
+
+
+def _clear_cache(modules):
+    """
+    Recursively clears the `layer_past` k/v cache of a list of pytorch modules.
+    Preallocated caches (StaticKVCache) only have their fill pointer reset, so their buffers are reused by the next
+    generation; any other `layer_past` is set to None.
+    """
+    if isinstance(modules, (list, GeneratorType)):
+        for m in modules:
+            _clear_cache(m)
+    elif isinstance(modules, torch.nn.Module):
+        for m in modules.modules():
+            if hasattr(m, "layer_past"):
+                if isinstance(m.layer_past, StaticKVCache):
+                    m.layer_past.reset()
+                else:
+                    m.layer_past = None
+
+
+def _truncate_cache(modules, seq_len):
+    """
+    Recursively truncates the `layer_past` k/v cache of a list of pytorch modules to its first `seq_len` positions.
+    Paged caches (see PagedKVCacheManager) aren't supported.
+    """
+    if isinstance(modules, (list, GeneratorType)):
+        for m in modules:
+            _truncate_cache(m, seq_len)
+    elif isinstance(modules, torch.nn.Module):
+        for m in modules.modules():
+            layer_past = getattr(m, "layer_past", None)
+            if isinstance(layer_past, PagedKVCache):
+                raise ValueError("paged key / value caches don't support truncation")
+            if isinstance(layer_past, StaticKVCache):
+                layer_past.truncate(seq_len)
+            elif torch.is_tensor(layer_past) and layer_past.dim() == 5:
+                # [2, s, b, np, hn]
+                m.layer_past = layer_past[:, :seq_len]
+
+
+def _select_cache_rows(modules, index):
+    """
+    Recursively keeps only the batch rows in `index` (a LongTensor) of the `layer_past` k/v cache of a list of pytorch
+    modules, e.g. to drop finished sequences from the batch. Paged caches (see PagedKVCacheManager) aren't supported.
+    """
+    if isinstance(modules, (list, GeneratorType)):
+        for m in modules:
+            _select_cache_rows(m, index)
+    elif isinstance(modules, torch.nn.Module):
+        for m in modules.modules():
+            layer_past = getattr(m, "layer_past", None)
+            if isinstance(layer_past, PagedKVCache):
+                raise ValueError(
+                    "paged key / value caches don't support selecting batch rows"
+                )
+            if isinstance(layer_past, StaticKVCache):
+                layer_past.select_rows(index)
+            elif torch.is_tensor(layer_past) and layer_past.dim() == 5:
+                # [2, s, b, np, hn]
+                m.layer_past = layer_past.index_select(2, index)
+
+
+def _evict_cache(modules, start, n):
+    """
+    Recursively drops the n cached positions from `start` on of the `layer_past` k/v cache of a list of pytorch
+    modules, moving the later positions n positions earlier (see ParallelSelfAttention.evict_cache).
+    """
+    if isinstance(modules, (list, GeneratorType)):
+        for m in modules:
+            _evict_cache(m, start, n)
+    elif isinstance(modules, torch.nn.Module):
+        for m in modules.modules():
+            layer_past = getattr(m, "layer_past", None)
+            if (
+                hasattr(m, "attention")
+                and layer_past is not None
+                and layer_past.numel() > 0
+            ):
+                m.layer_past = m.attention.evict_cache(layer_past, start, n)
+
+
 def configure_sparse_attention(neox_args, attention_type, num_attention_heads, mpu):
     from deepspeed.ops.sparse_attention import (
         SparseSelfAttention,
@@ -144,6 +144,9 @@ class Embedding(torch.nn.Module):
 class EmbeddingPipe(Embedding):
     """Extends Embedding to forward attention_mask through the pipeline."""
 
+    # when the embedding is tied to the output layer: only compute logits for the last position (see ParallelLinearPipe)
+    last_position_only = False
+
     @property
     def word_embeddings_weight(self):
         """Easy accessory for the pipeline engine to tie embeddings across stages."""
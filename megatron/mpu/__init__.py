@@ -45,6 +45,10 @@ from .mappings import gather_from_model_parallel_region
 from .mappings import reduce_from_model_parallel_region
 from .mappings import scatter_to_model_parallel_region
 
+from .quantization import Int8Weight
+from .quantization import linear
+from .quantization import quantize_weights_int8
+
 from .random import checkpoint
 from .random import get_cuda_rng_tracker
 from .random import model_parallel_cuda_manual_seed
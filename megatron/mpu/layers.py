@@ -33,6 +33,7 @@ from .mappings import copy_to_model_parallel_region
 from .mappings import gather_from_model_parallel_region
 from .mappings import reduce_from_model_parallel_region
 from .mappings import scatter_to_model_parallel_region
+from .quantization import Int8Weight, linear
 from .random import get_cuda_rng_tracker
 from .utils import divide
 from .utils import VocabUtility
@@ -172,15 +173,18 @@ class VocabParallelEmbedding(torch.nn.Module):
         else:
             masked_input = input_
             # Get the embeddings.
-        output_parallel = F.embedding(
-            masked_input,
-            self.weight,
-            self.padding_idx,
-            self.max_norm,
-            self.norm_type,
-            self.scale_grad_by_freq,
-            self.sparse,
-        )
+        if isinstance(self.weight, Int8Weight):
+            output_parallel = self.weight.embedding(masked_input)
+        else:
+            output_parallel = F.embedding(
+                masked_input,
+                self.weight,
+                self.padding_idx,
+                self.max_norm,
+                self.norm_type,
+                self.scale_grad_by_freq,
+                self.sparse,
+            )
         # Mask the output embedding.
         if self.model_parallel_size > 1:
             output_parallel[input_mask, :] = 0.0
@@ -195,12 +199,16 @@ class ParallelRelativePositionBias(torch.nn.Module):
     Based on https://github.com/lucidrains/x-transformers/blob/6b93c21be0d0a679da6f7b9621d9bb638ab18428/x_transformers/x_transformers.py#L106 (14.12.2021)
     and adapted for megatron's model parallelism
 
+    The buckets of all query / key position pairs are computed once for max_seq_len positions (and only recomputed to
+    grow past it), and every forward embeds a slice of them, so that a cached decoding step costs O(k_len).
+
     Arguments:
         scale: scaling factor for the bias
         causal: flag for causal/non-causal language modelling.
         num_buckets: number of rp buckets.
         max_distance: max distance in sequence dim for each bucket.
         heads: number of attention heads (total)
+        max_seq_len: number of positions to compute the buckets for up front
     """
 
     def __init__(
@@ -212,6 +220,7 @@ class ParallelRelativePositionBias(torch.nn.Module):
         max_distance=128,
         heads=8,
         init_method=init.xavier_normal_,
+        max_seq_len=None,
     ):
         super().__init__()
         self.scale = scale
@@ -219,6 +228,7 @@ class ParallelRelativePositionBias(torch.nn.Module):
         self.num_buckets = num_buckets
         self.max_distance = max_distance
         self.heads = heads
+        self.max_seq_len = max_seq_len
 
         # Set the defaults for compatibility.
         self.padding_idx = None
@@ -266,8 +276,6 @@ class ParallelRelativePositionBias(torch.nn.Module):
             _initialize_affine_weight_gpu(
                 self.weight, init_method, partition_dim=1, stride=1
             )
-        self._q_len_cached = None
-        self._k_len_cached = None
         self._rel_pos_bucket_cached = None
 
     @staticmethod
@@ -305,25 +313,26 @@ class ParallelRelativePositionBias(torch.nn.Module):
         )
 
         ret += torch.where(is_small, n, val_if_large)
-        self._rel_pos_bucket_cached = ret
-        return self._rel_pos_bucket_cached
-
-    def forward(self, q_len, k_len):
-        if self._q_len_cached != q_len or self._k_len_cached != k_len:
-            # cache bucket if first step seq len stays constant
-            self._q_len_cached, self._k_len_cached = q_len, k_len
-            q_pos = torch.arange(
-                q_len, dtype=torch.long, device=torch.cuda.current_device()
-            )
-            k_pos = torch.arange(
-                k_len, dtype=torch.long, device=torch.cuda.current_device()
-            )
-            rel_pos = k_pos[None, :] - q_pos[:, None]
-            rp_bucket = self._relative_position_bucket(
+        return ret
+
+    def forward(self, q_len, k_len, offset=None):
+        # the queries are the last q_len of the k_len positions, unless given an offset
+        if offset is None:
+            offset = k_len - q_len
+        seq_len = max(offset + q_len, k_len)
+        cached = self._rel_pos_bucket_cached
+        if (
+            cached is None
+            or cached.size(0) < seq_len
+            or cached.device != self.weight.device
+        ):
+            seq_len = max(seq_len, self.max_seq_len or 0)
+            pos = torch.arange(seq_len, dtype=torch.long, device=self.weight.device)
+            rel_pos = pos[None, :] - pos[:, None]
+            cached = self._rel_pos_bucket_cached = self._relative_position_bucket(
                 rel_pos, num_buckets=self.num_buckets, max_distance=self.max_distance
             )
-        else:
-            rp_bucket = self._rel_pos_bucket_cached
+        rp_bucket = cached[offset : offset + q_len, :k_len]
         values = F.embedding(
             rp_bucket,
             self.weight,
@@ -456,7 +465,7 @@ class ColumnParallelLinear(torch.nn.Module):
         # Matrix multiply.
 
         bias = self.bias if not self.skip_bias_add else None
-        output_parallel = F.linear(input_parallel, self.weight, bias)
+        output_parallel = linear(input_parallel, self.weight, bias)
         if self.gather_output:
             # All-gather across the partitions.
             output = gather_from_model_parallel_region(output_parallel)
@@ -586,7 +595,7 @@ class RowParallelLinear(torch.nn.Module):
         else:
             input_parallel = scatter_to_model_parallel_region(input_)
         # Matrix multiply.
-        output_parallel = F.linear(input_parallel, self.weight)
+        output_parallel = linear(input_parallel, self.weight)
         # All-reduce across all the partitions.
         if not self.parallel_output:
             output_ = reduce_from_model_parallel_region(output_parallel)
@@ -0,0 +1,129 @@
+# Copyright (c) 2021, EleutherAI contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Weight-only int8 quantization of the model parallel layers for inference."""
+
+import torch
+import torch.nn.functional as F
+
+
+class Int8Weight(torch.nn.Module):
+    """
+    A weight matrix [out, in] stored as int8, with symmetric (absmax) scales per output row ("per channel"), or per
+    group of group_size consecutive inputs of every row ("group-wise"), and dequantized on the fly. Takes a quarter of
+    the memory of a float32 weight (half of a float16 one), plus the scales.
+
+    Every model parallel rank quantizes its own partition of the weight, so the scales never need to be communicated.
+
+    :param weight: float weight [out, in] to quantize
+    :param group_size: number of inputs sharing a scale, must divide `in`; None for a scale per output row
+    """
+
+    def __init__(self, weight, group_size=None):
+        super().__init__()
+        out_features, in_features = weight.shape
+        group_size = group_size or in_features
+        assert (
+            in_features % group_size == 0
+        ), f"the group size {group_size} has to divide the input size {in_features}"
+        self.group_size = group_size
+
+        groups = weight.detach().float().view(out_features, -1, group_size)
+        scale = groups.abs().amax(dim=-1, keepdim=True) / 127.0
+        # all zero groups quantize to zeros
+        scale = scale.masked_fill(scale == 0, 1.0)
+        qweight = torch.round(groups / scale).clamp_(-127, 127).to(torch.int8)
+        self.register_buffer("qweight", qweight.view(out_features, in_features))
+        # [out, in / group_size]
+        self.register_buffer("scale", scale.squeeze(-1).to(weight.dtype))
+
+    @property
+    def shape(self):
+        return self.qweight.shape
+
+    @property
+    def dtype(self):
+        # the dtype of the dequantized weight
+        return self.scale.dtype
+
+    @property
+    def device(self):
+        return self.qweight.device
+
+    def dequantize(self, dtype=None):
+        """Returns the float weight [out, in] (in dtype, defaults to the dtype of the scales)."""
+        dtype = dtype or self.dtype
+        out_features, in_features = self.qweight.shape
+        weight = self.qweight.view(out_features, -1, self.group_size).to(dtype)
+        return (weight * self.scale.to(dtype).unsqueeze(-1)).view(
+            out_features, in_features
+        )
+
+    def linear(self, input_, bias=None):
+        """F.linear(input_, weight, bias) with the dequantized weight."""
+        # scale the weight before the matmul (even where per channel scales would factor out of it): the unscaled int8
+        # weights make the outputs up to 127 / absmax times larger, which overflows float16
+        return F.linear(input_, self.dequantize(input_.dtype), bias)
+
+    def embedding(self, input_):
+        """Looks up (and dequantizes) only the rows of the weight in input_."""
+        rows = F.embedding(input_, self.qweight)
+        out_features, in_features = self.qweight.shape
+        rows = rows.view(*input_.shape, -1, self.group_size).to(self.dtype)
+        scale = F.embedding(input_, self.scale).unsqueeze(-1)
+        return (rows * scale).view(*input_.shape, in_features)
+
+    def extra_repr(self):
+        return f"shape={tuple(self.shape)}, group_size={self.group_size}"
+
+
+def linear(input_, weight, bias=None):
+    """F.linear, for a float weight or an Int8Weight"""
+    if isinstance(weight, Int8Weight):
+        return weight.linear(input_, bias)
+    return F.linear(input_, weight, bias)
+
+
+def quantize_weights_int8(model, group_size=None):
+    """
+    Replaces the weights of the ColumnParallelLinear, RowParallelLinear and VocabParallelEmbedding layers of model (and
+    thereby the output layer, whether a ParallelLinear or tied to the input embedding) with Int8Weights, in place. For
+    inference only: the quantized weights have no gradients.
+
+    model: torch.nn.Module
+    group_size: number of inputs sharing a scale, see Int8Weight; None for a scale per output row. Layers whose input
+                size it doesn't divide use per row scales.
+
+    returns: the number of bytes of the weights before and after quantization
+    """
+    from .layers import ColumnParallelLinear, RowParallelLinear, VocabParallelEmbedding
+
+    bytes_before, bytes_after = 0, 0
+    for module in model.modules():
+        if not isinstance(
+            module, (ColumnParallelLinear, RowParallelLinear, VocabParallelEmbedding)
+        ) or not isinstance(module.weight, torch.nn.Parameter):
+            continue
+        weight = module.weight
+        layer_group_size = group_size
+        if group_size is not None and weight.size(1) % group_size != 0:
+            layer_group_size = None
+        # replace the parameter by the quantized module
+        del module.weight
+        module.weight = Int8Weight(weight, group_size=layer_group_size)
+        bytes_before += weight.numel() * weight.element_size()
+        bytes_after += sum(
+            b.numel() * b.element_size() for b in module.weight.buffers()
+        )
+    return bytes_before, bytes_after
@@ -637,6 +637,9 @@ class NeoXArgs(*BASE_CLASSES):
                     global_num_gpus = self.num_gpus * len(resources)
             else:
                 global_num_gpus = torch.cuda.device_count()
+                if global_num_gpus == 0 and self.inference_device == "cpu":
+                    # one cpu process per model parallel rank, see deepy.py
+                    global_num_gpus = self.num_gpus or max(self.model_parallel_size, 1)
             self.update_value("global_num_gpus", global_num_gpus)
 
         logging.info(
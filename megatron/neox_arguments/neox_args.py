@@ -926,7 +926,7 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     text_gen_type: str = None
     """
     How to generate text/sample the model.
-    Options: `unconditional`, `input-file`, `interactive`
+    Options: `unconditional`, `input-file`, `interactive`, `server`
     """
 
     temperature: float = 0.0
@@ -944,6 +944,17 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     integer between 0 and the models vocab size. Filters out any logits with a probability less than that of the top_kth token.
     """
 
+    repetition_penalty: float = 1.0
+    """
+    Divides positive (multiplies negative) logits of tokens that already occur in the context or completion (https://arxiv.org/abs/1909.05858).
+    1.0 disables the penalty.
+    """
+
+    presence_penalty: float = 0.0
+    """
+    Subtracted from the logits of tokens that already occur in the context or completion. 0.0 disables the penalty.
+    """
+
     maximum_tokens: int = 64
     """
     maximum number of tokens to be generated
@@ -959,17 +970,194 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     Output file
     """
 
+    shard_sample_input: bool = False
+    """
+    If true, input-file generation splits the prompts of sample_input_file across the data parallel groups, which
+    write each batch of completions to their own shard, sample_output_file.shard_XXXXX.jsonl, as soon as it is done.
+    Records carry the prompt's id (its index among the non-empty lines of sample_input_file). A restarted run skips
+    the prompts completed in any shard, so the number of data parallel groups may change between runs. Once all
+    prompts are done, rank 0 merges the shards into sample_output_file in prompt order.
+    """
+
+    server_host: str = "127.0.0.1"
+    """
+    Address the generation server (text_gen_type `server`) listens on.
+    """
+
+    server_port: int = 5000
+    """
+    Port of the generation server (text_gen_type `server`), which listens on server_host. It completes batches of up
+    to generation_batch_size queued requests with the same sampling parameters together.
+    """
+
+    server_batch_wait_ms: float = 10.0
+    """
+    How long the generation server waits for more requests to batch with a newly queued request, in milliseconds.
+    """
+
     num_samples: int = 1
     """
     Number of samples to generate unconditionally, defaults to 1 and interactive conditional sampling
     """
 
+    generation_batch_size: int = 1
+    """
+    Number of prompts to generate completions for at once. Prompts are sorted by length and grouped into batches of this size.
+    """
+
+    num_beams: int = 1
+    """
+    Number of beams of beam search per prompt. Values > 1 complete prompts with beam search, which keeps the beams
+    as extra batch rows and reorders their cached keys / values at each step, instead of sampling; temperature, top_k,
+    top_p, the penalties and speculative decoding are then ignored. Needs the kv cache.
+    """
+
+    beam_length_penalty: float = 1.0
+    """
+    Exponent of the length normalization of beam search: hypotheses are ranked by their log probability divided by
+    (number of generated tokens) ** beam_length_penalty. Values > 0.0 favour longer completions.
+    """
+
+    beam_early_stopping: bool = True
+    """
+    Stop beam search for a prompt once num_beams hypotheses are finished. If false, also wait until no beam can
+    improve on the finished hypotheses at its current length.
+    """
+
+    sliding_window_tokens: int = None
+    """
+    Generate past seq_length with the kv cache holding only the sliding_window_sink_tokens first positions and the most
+    recent sliding_window_tokens ones, evicting the oldest positions in place once it is full, so that long completions
+    take bounded memory and time per token. Generation is then only bounded by maximum_tokens. Needs the kv cache and
+    rotary, alibi, rpe or no position embeddings; prompts have to fit in the cache. None disables the window.
+    """
+
+    sliding_window_sink_tokens: int = 4
+    """
+    Number of leading positions ("attention sinks", https://arxiv.org/abs/2309.17453) kept in the kv cache for good
+    with sliding_window_tokens.
+    """
+
+    vocab_parallel_sampling: bool = False
+    """
+    Sample generated tokens from the logits split across model parallel ranks along the vocab, exchanging only each
+    rank's top candidates and softmax normalizer rather than all-gathering the full logits at every step. Draws the
+    same tokens as sampling from the gathered logits. Needs a column parallel output layer (or weight tying with
+    pipeline parallelism), and is not supported with speculative decoding or per-request sampling parameters.
+    """
+
+    weight_quantization: Literal["int8"] = None
+    """
+    Quantize the weights of the linear and embedding layers (including the output layer) to int8 after loading the
+    checkpoint for inference, with symmetric scales per output channel or per group of
+    weight_quantization_group_size inputs, and dequantize them on the fly in forward. Roughly halves (fp16) or quarters
+    (fp32) the memory of the weights. Activations, the kv cache and norms stay in the model's precision.
+    """
+
+    weight_quantization_group_size: int = None
+    """
+    Number of consecutive inputs of a weight row sharing a scale with weight_quantization. None for a scale per output
+    channel. Smaller groups are more accurate; layers whose (model parallel) input size it doesn't divide use per
+    channel scales.
+    """
+
+    inference_device: Literal["cuda", "cpu"] = "cuda"
+    """
+    Device to run inference (generate.py and setup_for_inference_or_eval) on. "cpu" builds the model on cpu without
+    a deepspeed engine, loads the checkpoint's weights into it directly and runs model parallelism over a gloo process
+    group, for hosts without gpus. Runs in bfloat16 or fp32 (fp16 models run in bfloat16), without the fused softmax
+    kernels, and doesn't support pipeline parallelism (checkpoints trained with it are loaded as a single stage). On
+    hosts without gpus, deepy.py starts one process per model parallel rank (or num_gpus processes). Checkpoints
+    exported with tools/export_mmap_weights.py have their weights memory mapped rather than loaded, shared by all
+    processes on a host.
+    """
+
+    inference_threads: int = None
+    """
+    Number of intra-op threads (torch.set_num_threads) of every process with inference_device "cpu". None keeps
+    torch's default.
+    """
+
+    layer_streaming: bool = False
+    """
+    Stream the weights of the layers from the checkpoint during inference, for models larger than host or device
+    memory: the model is built without weights, and every forward pass loads each layer's weights from its
+    layer_XX-model_YY-model_states.pt file just before it runs (reading the next layer's file on a background thread)
+    and frees them afterwards. Needs a pipeline parallel checkpoint (e.g. one merged with tools/merge20b.py), runs without
+    a deepspeed engine on inference_device, and doesn't support pipeline parallelism or weight_quantization. Every
+    forward pass reads all streamed layers, so it suits batch scoring over generation.
+    """
+
+    layer_streaming_resident_layers: int = 0
+    """
+    Number of layers (with weights, from the first one) whose weights layer_streaming keeps in memory once loaded,
+    rather than streaming them in every forward pass. Tied layers are always kept.
+    """
+
+    compact_finished_threshold: float = None
+    """
+    If set, finished completions are dropped from a generation batch (its tokens, position ids and kv caches) once
+    this fraction of the batch items still being decoded is finished, so that long-tail completions don't keep
+    forwarding the finished ones. None keeps every batch item until the whole batch is done.
+    """
+
     recompute: bool = False
     """
     During generation recompute all attention instead of using previously computed keys/values.
     Should be set to true for sparse attention models
     """
 
+    kv_cache_type: Literal["dynamic", "static", "paged", "int8"] = "dynamic"
+    """
+    How keys/values are cached during generation (ignored if recompute is true).
+    "dynamic" concatenates the new keys/values onto the cache at every step; "static" preallocates a [2, seq_length, ...]
+    buffer per layer on the first forward pass and writes into it in place, reusing it across generation calls.
+    "paged" stores the keys/values of continuously batched sequences in blocks of kv_cache_block_size positions drawn
+    from a pool, so each sequence only takes up the blocks its length needs and identical prompts share their blocks
+    (other generation falls back to "static", with a warning).
+    "int8" is a "static" cache storing the keys/values in int8 with a scale per position and head, dequantized in
+    attention, which halves the memory of a float16 cache at a small cost in accuracy.
+    """
+
+    kv_cache_block_size: int = 16
+    """
+    Number of positions per block of a "paged" kv cache.
+    """
+
+    kv_cache_num_blocks: int = None
+    """
+    Number of blocks in the pool of a "paged" kv cache. Defaults to the memory of a "static" cache for
+    seq_length positions in every slot of the continuous batching scheduler.
+    """
+
+    prompt_cache_size_mb: float = 0.0
+    """
+    Memory budget (in MB per model parallel rank) for caching the keys/values of prompts after their prefill, so that
+    generate_samples_from_prompt only prefills the part of a prompt after the longest prefix it shares with a cached
+    one (e.g. a few-shot preamble reused across requests). Least recently used prompts are evicted. 0 disables the
+    cache; it is not used with recompute or pipeline parallelism.
+    """
+
+    speculative_decoding: Literal["draft", "ngram"] = None
+    """
+    Speculative decoding for text generation: a proposer guesses the next speculative_tokens tokens, which the model
+    verifies in a single forward pass; the completions are distributed as without it. "draft" proposes with a small
+    model (see speculative_draft_config), "ngram" looks the tokens up in the prompt and completion so far. Needs the
+    kv cache, and is not supported with pipeline parallelism or the repetition / presence penalties.
+    """
+
+    speculative_tokens: int = 4
+    """
+    Number of tokens proposed per forward pass of the model with speculative decoding.
+    """
+
+    speculative_draft_config: list = None
+    """
+    Config files of the draft model for speculative_decoding = "draft", e.g. ["configs/small.yml"], including the
+    `load` path of its checkpoint. The draft model must use the same tokenizer as the model; its model parallel size
+    is set to the model's.
+    """
+
     eval_results_prefix: str = ""
     """
     prefix to which to save evaluation results - final fp will be {eval_results_prefix}_eval_results_yy-mm-dd-HH-MM.json
@@ -0,0 +1,461 @@
+# Copyright (c) 2021  Josh Levy-Kramer <josh@levykramer.co.uk>. All rights reserved.
+# This file is based on code by the authors denoted below and has been modified from its original version.
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched sampling of the next token from the model's logits."""
+
+import torch
+import torch.nn.functional as F
+
+
+def _per_row(value, batch_size, dtype, device):
+    """Broadcasts a scalar or per-row [batch] sampling parameter to a [batch] tensor"""
+    if torch.is_tensor(value):
+        return value.to(device=device, dtype=dtype).view(-1).expand(batch_size)
+    return torch.full((batch_size,), value, dtype=dtype, device=device)
+
+
+def _sample_categorical(probs):
+    """
+    Draws one index per row of probs ([batch, n], non-negative) by inverting the cumulative distribution with one
+    uniform draw per row. Unlike torch.multinomial, the index drawn doesn't depend on trailing zero probabilities, so
+    sampling among a subset of the candidates (see sample_tokens_vocab_parallel) draws the same tokens.
+    """
+    cdf = probs.float().cumsum(dim=-1)
+    u = torch.rand(probs.size(0), 1, device=probs.device) * cdf[:, -1:]
+    return torch.searchsorted(cdf, u, right=True).clamp(max=probs.size(-1) - 1)
+
+
+def _top_k_top_p_candidates(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
+    """
+    Selects the candidates of top_k / top_p filtering for all batch items at once: the top_k candidates are selected
+    (sorted) with a single topk and the nucleus is masked in that candidate space. Only batches with a row that uses top_p
+    without top_k sort the full vocab.
+
+    returns: tuple of (candidate logits, with filtered candidates set to filter_value; their vocab indices), both of shape
+             [batch, num_candidates], or None if nothing is filtered
+    """
+    batch_size, vocab_size = logits.shape
+
+    # the number of candidates has to be known on the host, so per-row parameters cost one sync each
+    if torch.is_tensor(top_k):
+        top_k = _per_row(top_k, batch_size, torch.long, logits.device)
+        use_top_k = ((top_k > 0) & (top_k < vocab_size)).any().item()
+        num_candidates = (
+            vocab_size if (top_k <= 0).any() else min(top_k.max().item(), vocab_size)
+        )
+    else:
+        use_top_k = 0 < top_k < vocab_size
+        num_candidates = top_k if use_top_k else vocab_size
+    use_top_p = (top_p > 0.0).any().item() if torch.is_tensor(top_p) else top_p > 0.0
+    if not use_top_k and not use_top_p:
+        return None
+
+    # [batch, num_candidates], sorted in descending order
+    candidate_logits, candidate_indices = torch.topk(logits, num_candidates, dim=-1)
+
+    if torch.is_tensor(top_k):
+        # rows asking for fewer candidates than the largest top_k
+        ranks = torch.arange(num_candidates, device=logits.device)
+        candidate_logits = candidate_logits.masked_fill(
+            (ranks.unsqueeze(0) >= top_k.unsqueeze(1)) & (top_k.unsqueeze(1) > 0),
+            filter_value,
+        )
+
+    if use_top_p:
+        top_p = _per_row(top_p, batch_size, torch.float, logits.device).unsqueeze(1)
+        cumulative_probs = torch.cumsum(
+            F.softmax(candidate_logits.float(), dim=-1), dim=-1
+        )
+
+        # Remove tokens with cumulative probability above the threshold
+        # Shift the indices to the right to keep also the first token above the threshold
+        candidates_to_remove = torch.zeros_like(cumulative_probs, dtype=torch.bool)
+        candidates_to_remove[:, 1:] = cumulative_probs[:, :-1] > top_p
+        candidate_logits = candidate_logits.masked_fill(
+            candidates_to_remove & (top_p > 0.0), filter_value
+        )
+
+    return candidate_logits, candidate_indices
+
+
+def filter_logits(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
+    """
+    Filters the logits using top_k / top_p, filling any filtered vocab items with filter_value (defaults to -inf).
+    All batch items are filtered at once, see _top_k_top_p_candidates.
+
+    logits: torch.Tensor of shape [batch, vocab_size]
+    top_k: integer or [batch] tensor -> integer between 0 and the models vocab size. Keeps the top_k most likely tokens;
+           0 disables top_k (for that row).
+    top_p: float or [batch] tensor -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose
+           cumulative probability exceeds the probability top_p; 0.0 disables top_p (for that row).
+
+    returns: (filtered) logits
+    """
+    candidates = _top_k_top_p_candidates(logits, top_k, top_p, filter_value)
+    if candidates is None:
+        return logits
+    candidate_logits, candidate_indices = candidates
+    return torch.full_like(logits, filter_value).scatter_(
+        -1, candidate_indices, candidate_logits
+    )
+
+
+def sample_tokens(logits, temperature=0.0, top_k=0, top_p=0.0):
+    """
+    Samples one token id per batch item.
+
+    logits: torch.Tensor of shape [batch, vocab_size]
+    temperature (default 0.0): float or [batch] tensor -> exponential scaling output distribution ("higher == more risk")
+    top_k (default 0): integer or [batch] tensor -> integer between 0 and the models vocab size. Filters out any logits with a probability less than that of the top_kth token.
+    top_p (default 0.0): float or [batch] tensor -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
+    note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0 (per row, if given per row)
+
+    returns: torch.Tensor of shape [batch] with the sampled token ids
+    """
+    per_row = any(torch.is_tensor(p) for p in (temperature, top_k, top_p))
+    if not per_row and temperature == 0.0 and top_k == 0 and top_p == 0.0:
+        return torch.argmax(logits, dim=-1).view(-1)
+
+    batch_size = logits.size(0)
+    logits = logits.float()
+    if per_row or temperature > 0.0:
+        temperature = _per_row(temperature, batch_size, torch.float, logits.device)
+        # a temperature of 0.0 leaves the logits unscaled
+        logits = logits / torch.where(
+            temperature > 0.0, temperature, torch.ones_like(temperature)
+        ).unsqueeze(1)
+
+    # sample among the candidates only, rather than scattering them back to the full vocab
+    candidates = _top_k_top_p_candidates(logits, top_k=top_k, top_p=top_p)
+    if candidates is None:
+        tokens = _sample_categorical(F.softmax(logits, dim=-1))
+    else:
+        candidate_logits, candidate_indices = candidates
+        tokens = candidate_indices.gather(
+            1, _sample_categorical(F.softmax(candidate_logits, dim=-1))
+        )
+    tokens = tokens.view(-1)
+
+    if per_row:
+        greedy = (
+            (temperature == 0.0)
+            & (_per_row(top_k, batch_size, torch.long, logits.device) == 0)
+            & (_per_row(top_p, batch_size, torch.float, logits.device) == 0.0)
+        )
+        tokens = torch.where(greedy, torch.argmax(logits, dim=-1), tokens)
+    return tokens
+
+
+def _all_gather(tensor, group):
+    tensors = [
+        torch.empty_like(tensor)
+        for _ in range(torch.distributed.get_world_size(group=group))
+    ]
+    torch.distributed.all_gather(tensors, tensor.contiguous(), group=group)
+    return tensors
+
+
+def _vocab_parallel_logsumexp(logits, group):
+    """logsumexp over the full vocab of vocab-parallel logits [batch, vocab_size / world_size] -> [batch, 1]"""
+    max_logits = logits.max(dim=-1, keepdim=True)[0]
+    torch.distributed.all_reduce(
+        max_logits, op=torch.distributed.ReduceOp.MAX, group=group
+    )
+    sum_exp = torch.exp(logits - max_logits).sum(dim=-1, keepdim=True)
+    torch.distributed.all_reduce(sum_exp, group=group)
+    return max_logits + sum_exp.log()
+
+
+def _vocab_parallel_top_k(logits, k, vocab_start_index, group):
+    """
+    Gathers the local top k logits of every rank, sorted in descending order with their vocab indices
+    ([batch, k * world_size] each). The gathered logits are the largest of the full vocab down to `bound` ([batch, 1]):
+    a logit that was not gathered is at most the smallest gathered one of its rank.
+    """
+    local_logits, local_indices = torch.topk(logits, k, dim=-1)
+    gathered_logits = _all_gather(local_logits, group)
+    gathered_indices = _all_gather(local_indices + vocab_start_index, group)
+    if k < logits.size(-1):
+        bound = torch.stack([l[:, -1] for l in gathered_logits], dim=-1).max(
+            dim=-1, keepdim=True
+        )[0]
+    else:
+        bound = torch.full_like(local_logits[:, :1], -float("Inf"))
+    candidate_logits, order = torch.sort(
+        torch.cat(gathered_logits, dim=-1), dim=-1, descending=True
+    )
+    return (
+        candidate_logits,
+        torch.cat(gathered_indices, dim=-1).gather(-1, order),
+        bound,
+    )
+
+
+def _vocab_parallel_candidates(
+    logits, vocab_start_index, group, top_k=0, top_p=0.0, filter_value=-float("Inf")
+):
+    """
+    _top_k_top_p_candidates of vocab-parallel logits: only the candidates are gathered. The top_k candidates are the
+    top_k of the gathered local top_k of every rank. Without top_k, the nucleus is found by gathering growing local top
+    k's until the gathered logits cover it, with its probabilities normalized over the full vocab.
+    """
+    local_vocab_size = logits.size(-1)
+    vocab_size = local_vocab_size * torch.distributed.get_world_size(group=group)
+    if 0 < top_k < vocab_size:
+        candidate_logits, candidate_indices, _ = _vocab_parallel_top_k(
+            logits, min(top_k, local_vocab_size), vocab_start_index, group
+        )
+        candidate_logits = candidate_logits[:, :top_k]
+        candidate_indices = candidate_indices[:, :top_k]
+        if top_p > 0.0:
+            cumulative_probs = torch.cumsum(
+                F.softmax(candidate_logits.float(), dim=-1), dim=-1
+            )
+    elif top_p > 0.0:
+        log_normalizer = _vocab_parallel_logsumexp(logits.float(), group)
+        k = min(64, local_vocab_size)
+        while True:
+            candidate_logits, candidate_indices, bound = _vocab_parallel_top_k(
+                logits, k, vocab_start_index, group
+            )
+            cumulative_probs = torch.cumsum(
+                torch.exp(candidate_logits.float() - log_normalizer), dim=-1
+            )
+            # the nucleus ends at the first candidate past top_p, which has to be larger than any logit not gathered
+            past_top_p = cumulative_probs > top_p
+            last = past_top_p.long().argmax(dim=-1, keepdim=True)
+            covered = past_top_p.any(dim=-1, keepdim=True) & (
+                candidate_logits.gather(-1, last) > bound
+            )
+            if k == local_vocab_size or covered.all():
+                break
+            k = min(4 * k, local_vocab_size)
+    else:
+        return None
+
+    if top_p > 0.0:
+        candidates_to_remove = torch.zeros_like(cumulative_probs, dtype=torch.bool)
+        candidates_to_remove[:, 1:] = cumulative_probs[:, :-1] > top_p
+        candidate_logits = candidate_logits.masked_fill(
+            candidates_to_remove, filter_value
+        )
+    return candidate_logits, candidate_indices
+
+
+def sample_tokens_vocab_parallel(
+    logits, vocab_start_index, group=None, temperature=0.0, top_k=0, top_p=0.0
+):
+    """
+    sample_tokens for vocab-parallel logits, i.e. the output of the final layer with parallel_output. Rather than
+    gathering the full logits, the ranks exchange their local argmax / top-k candidates and softmax normalizers; every
+    rank returns the same tokens, which are the tokens sample_tokens draws from the gathered logits (with the same
+    random state; up to rounding and ties).
+
+    logits: torch.Tensor of shape [batch, vocab_size / world_size], the vocab items [vocab_start_index,
+            vocab_start_index + logits.size(-1)) of this rank
+    group: the (model parallel) process group the vocab is split across
+    temperature / top_k / top_p: see sample_tokens (scalars only)
+
+    returns: torch.Tensor of shape [batch] with the sampled token ids
+    """
+    assert not any(
+        torch.is_tensor(p) for p in (temperature, top_k, top_p)
+    ), "per-row sampling parameters need the gathered logits"
+    if temperature == 0.0 and top_k == 0 and top_p == 0.0:
+        _, candidate_indices, _ = _vocab_parallel_top_k(
+            logits, 1, vocab_start_index, group
+        )
+        return candidate_indices[:, 0]
+
+    logits = logits.float()
+    if temperature > 0.0:
+        logits = logits / temperature
+
+    candidates = _vocab_parallel_candidates(
+        logits, vocab_start_index, group, top_k=top_k, top_p=top_p
+    )
+    if candidates is not None:
+        candidate_logits, candidate_indices = candidates
+        return candidate_indices.gather(
+            1, _sample_categorical(F.softmax(candidate_logits, dim=-1))
+        ).view(-1)
+
+    # sample from the full vocab: find the rank whose part of the cumulative distribution holds the draw
+    probs = torch.exp(logits - _vocab_parallel_logsumexp(logits, group))
+    local_cdf = probs.cumsum(dim=-1)
+    # [batch, world_size + 1] cumulative probability mass before the vocab items of every rank, and in total
+    mass = torch.stack(_all_gather(local_cdf[:, -1], group), dim=-1).cumsum(dim=-1)
+    mass = F.pad(mass, (1, 0))
+    rank = torch.distributed.get_rank(group=group)
+    u = torch.rand(logits.size(0), 1, device=logits.device) * mass[:, -1:]
+    local_token = torch.searchsorted(
+        local_cdf, u - mass[:, rank : rank + 1], right=True
+    )
+    owned = (u >= mass[:, rank : rank + 1]) & (u < mass[:, rank + 1 : rank + 2])
+    tokens = torch.where(
+        owned,
+        local_token.clamp(max=logits.size(-1) - 1) + vocab_start_index,
+        torch.full_like(local_token, -1),
+    )
+    torch.distributed.all_reduce(tokens, op=torch.distributed.ReduceOp.MAX, group=group)
+    return tokens.view(-1)
+
+
+def sampling_probs(logits, temperature=0.0, top_k=0, top_p=0.0):
+    """
+    Returns the distribution sample_tokens samples from: the softmax of the temperature scaled, top_k / top_p filtered
+    logits, or a one-hot distribution on the most likely token for greedy decoding.
+
+    logits: torch.Tensor of shape [..., vocab_size]
+    temperature / top_k / top_p: see sample_tokens (scalars only)
+
+    returns: float torch.Tensor of the same shape as logits
+    """
+    shape = logits.shape
+    logits = logits.float().view(-1, shape[-1])
+    if temperature == 0.0 and top_k == 0 and top_p == 0.0:
+        probs = F.one_hot(torch.argmax(logits, dim=-1), shape[-1]).float()
+    else:
+        if temperature > 0.0:
+            logits = logits / temperature
+        probs = F.softmax(filter_logits(logits, top_k=top_k, top_p=top_p), dim=-1)
+    return probs.view(shape)
+
+
+def verify_proposals(proposals, target_probs, proposal_probs=None, accepted=None):
+    """
+    Speculative sampling (https://arxiv.org/abs/2211.17192): verifies k proposed tokens per batch item against the
+    distributions of the model, such that the tokens kept are distributed exactly as if they had been sampled from the
+    model one at a time.
+
+    Each proposal x is accepted with probability min(1, p(x) / q(x)), where p is the model's distribution and q the one x
+    was drawn from. The first rejected proposal is resampled from the normalized max(0, p - q); if all proposals are
+    accepted, one more token is sampled from p. All batch items keep as many proposals as the one that accepted the
+    fewest (m), so they stay at the same position; for batch items that accepted more, the proposal at m was accepted
+    and thus already is a sample from p.
+
+    proposals: torch.Tensor of shape [batch, k] with the proposed token ids
+    target_probs: torch.Tensor of shape [batch, k + 1, vocab_size], the model's distributions (see sampling_probs) after
+                  the last token and after each proposal
+    proposal_probs (optional): torch.Tensor of shape [batch, k, vocab_size], the distributions the proposals were drawn
+                               from; None for deterministic proposals (q is one-hot)
+    accepted (optional): bool torch.Tensor of shape [batch, k], proposals to accept regardless (e.g. for batch items
+                         that are done, or tokens that are already known)
+
+    returns: tuple of (torch.Tensor of shape [batch, m + 1] with the m proposals kept and the next token; torch.Tensor of
+             shape [batch] with the number of leading proposals accepted by each batch item)
+    """
+    batch_size, k = proposals.shape
+    index = proposals.unsqueeze(-1)
+    p = target_probs[:, :k].gather(-1, index).squeeze(-1)
+    if proposal_probs is None:
+        q = torch.ones_like(p)
+    else:
+        q = proposal_probs.gather(-1, index).squeeze(-1)
+
+    # u < p(x) / q(x), without dividing by q(x)
+    accept = torch.rand_like(p) * q < p
+    if accepted is not None:
+        accept = accept | accepted
+    num_accepted = accept.long().cumprod(dim=1).sum(dim=1)
+    m = num_accepted.min().item()
+
+    if m == k:
+        next_token = torch.multinomial(target_probs[:, k], num_samples=1).view(-1)
+    else:
+        p_m = target_probs[:, m]
+        if proposal_probs is None:
+            q_m = F.one_hot(proposals[:, m], p_m.size(-1)).to(p_m.dtype)
+        else:
+            q_m = proposal_probs[:, m]
+        residual = (p_m - q_m).clamp(min=0.0)
+        # a proposal is only rejected where p(x) < q(x), so the residual is not empty (but may round to it)
+        residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p_m)
+        resampled = torch.multinomial(residual, num_samples=1).view(-1)
+        next_token = torch.where(num_accepted > m, proposals[:, m], resampled)
+
+    tokens = torch.cat((proposals[:, :m], next_token.unsqueeze(1)), dim=1)
+    return tokens, num_accepted
+
+
+class TokenPenalties:
+    """
+    Repetition and presence penalties for a batch of sequences.
+
+    Keeps a [batch, vocab_size] count of the tokens seen by each batch item, which is updated with the new tokens at
+    every step instead of rescanning the sequence history.
+
+    batch_size: number of sequences
+    vocab_size: size of the last dimension of the logits to penalize
+    repetition_penalty (default 1.0): float or [batch] tensor -> divides positive (multiplies negative) logits of tokens
+                                      that were already seen (https://arxiv.org/abs/1909.05858); 1.0 disables it.
+    presence_penalty (default 0.0): float or [batch] tensor -> subtracted from the logits of tokens that were already
+                                    seen; 0.0 disables it.
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        vocab_size,
+        repetition_penalty=1.0,
+        presence_penalty=0.0,
+        device=None,
+    ):
+        self.counts = torch.zeros(
+            batch_size, vocab_size, dtype=torch.int32, device=device
+        )
+        self.repetition_penalty = _per_row(
+            repetition_penalty, batch_size, torch.float, device
+        ).unsqueeze(1)
+        self.presence_penalty = _per_row(
+            presence_penalty, batch_size, torch.float, device
+        ).unsqueeze(1)
+
+    def update(self, tokens, mask=None):
+        """
+        Counts new tokens.
+
+        tokens: torch.Tensor of shape [batch] or [batch, n] with the new token ids of each batch item
+        mask (optional): bool torch.Tensor of the same shape, only tokens where mask is True are counted
+        """
+        tokens = tokens.view(self.counts.size(0), -1)
+        if mask is None:
+            increment = torch.ones_like(tokens, dtype=self.counts.dtype)
+        else:
+            increment = mask.view_as(tokens).to(self.counts.dtype)
+        self.counts.scatter_add_(1, tokens, increment)
+
+    def select_rows(self, index):
+        """Keeps only the batch rows in `index` (a LongTensor), e.g. to drop finished sequences from the batch."""
+        self.counts = self.counts.index_select(0, index)
+        self.repetition_penalty = self.repetition_penalty.index_select(0, index)
+        self.presence_penalty = self.presence_penalty.index_select(0, index)
+
+    def __call__(self, logits, vocab_start_index=0):
+        """
+        Applies the penalties to logits of shape [batch, vocab_size], or to the vocab items [vocab_start_index,
+        vocab_start_index + logits.size(-1)) of vocab-parallel logits; returns the penalized logits
+        """
+        seen = (
+            self.counts[:, vocab_start_index : vocab_start_index + logits.size(-1)] > 0
+        )
+        penalized = torch.where(
+            logits > 0,
+            logits / self.repetition_penalty,
+            logits * self.repetition_penalty,
+        )
+        logits = torch.where(seen, penalized, logits)
+        return logits - self.presence_penalty * seen
@@ -0,0 +1,516 @@
+"""Iteration-level ("continuous") batching for text generation."""
+
+import time
+from collections import deque
+from typing import List, Union
+
+import torch
+
+from megatron import mpu, print_rank_0
+from megatron.model.kv_cache import PagedKVCache, PagedKVCacheManager
+from megatron.model.transformer import ParallelTransformerLayer
+from megatron.text_generation_sampling import sample_tokens
+from megatron.text_generation_utils import forward_model
+from megatron.utils import is_mp_rank_0
+
+
+class _Sequence:
+    """A request in flight: its prompt, the tokens generated so far and the cache position its prompt starts at."""
+
+    def __init__(self, request_id, context_tokens):
+        self.request_id = request_id
+        self.context_tokens = context_tokens
+        self.generated_tokens = []
+        self.start = 0
+        self.finished = False
+        self.arrival_time = time.time()
+        self.first_token_time = None
+
+
+class ContinuousBatchingScheduler:
+    """
+    Iteration-level batching scheduler for text generation.
+
+    stream_tokens steps a fixed batch until its longest completion is done. The scheduler instead keeps up to
+    `num_slots` sequences in flight and checks them after every decoding step. Sequences that produced an eos token or
+    a stop sequence, or hit maximum_tokens, are evicted from the per-layer k/v caches. Queued prompts are then
+    prefilled into the free slots and decode alongside the rest.
+
+    All sequences in flight share one StaticKVCache fill pointer per layer. A prompt of length L, admitted when the
+    caches hold T positions, is forwarded into positions [T - L, T) and everything before it is masked. Prompts longer
+    than T wait (first come first served) until the caches have grown or drained. Positions are thus cache indices,
+    which is only correct for relative position embeddings (rotary, alibi or none). When the caches are full, the
+    leading positions no sequence attends to any more are dropped.
+
+    With neox_args.kv_cache_type == "paged", the sequences instead share a PagedKVCacheManager: every sequence has its
+    own positions and takes up only the cache blocks its length needs, so nothing is padded and more sequences fit in
+    the same memory. Prompts are admitted as long as there are slots and free blocks; identical prompts admitted
+    together are prefilled once and share their blocks. When the pool runs out during decoding, the most recently
+    admitted sequences are preempted: their blocks are freed and they are requeued, to be prefilled again (with the
+    tokens they generated so far) once there is room.
+
+    All model parallel ranks must add the same requests in the same order. Sampled tokens are broadcast from the model
+    parallel src rank so every rank makes the same scheduling decisions.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model in inference mode with use_cache=True (not pipe parallel).
+    num_slots: maximum number of sequences decoded together.
+    eos_token_id: end of text token at which a completion is terminated, defaults to the tokenizer's eod token
+    maximum_tokens: maximum number of tokens to be generated per request
+    temperature / top_k / top_p: sampling parameters, see sample_tokens
+    stop_tokens: a list of token ids, or a list of lists of token ids, at which a completion is terminated
+    """
+
+    def __init__(
+        self,
+        neox_args,
+        model,
+        num_slots: int,
+        eos_token_id: int = None,
+        maximum_tokens: int = 64,
+        temperature: float = 0.0,
+        top_k: int = 0,
+        top_p: float = 0.0,
+        stop_tokens=None,
+    ):
+        assert num_slots > 0, "num_slots must be > 0"
+        assert (
+            not neox_args.is_pipe_parallel
+        ), "continuous batching is not supported with pipeline parallelism"
+        if neox_args.pos_emb not in ["rotary", "alibi", "none"]:
+            raise ValueError(
+                f"continuous batching requires relative position embeddings (rotary, alibi or none), got {neox_args.pos_emb}"
+            )
+
+        self.neox_args = neox_args
+        self.model = model
+        self.num_slots = num_slots
+        self.eos_token_id = eos_token_id or neox_args.tokenizer.eod
+        self.maximum_tokens = maximum_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        if stop_tokens and type(stop_tokens[0]) is not list:
+            stop_tokens = [stop_tokens]
+        self.stop_tokens = stop_tokens or []
+        self.max_seq_len = neox_args.seq_length
+        self.paged = neox_args.kv_cache_type == "paged"
+
+        self.layers = [
+            m for m in model.module.modules() if isinstance(m, ParallelTransformerLayer)
+        ]
+        self.device = next(model.module.parameters()).device
+
+        self.queue = deque()
+        self.active = []  # the sequence in row i of the caches
+        self.caches = None  # one StaticKVCache (or Int8KVCache) per layer while sequences are in flight
+        if self.paged:
+            block_size = neox_args.kv_cache_block_size
+            blocks_per_sequence = -(-self.max_seq_len // block_size)
+            num_blocks = (
+                neox_args.kv_cache_num_blocks or num_slots * blocks_per_sequence
+            )
+            assert (
+                num_blocks >= blocks_per_sequence
+            ), "kv_cache_num_blocks must leave room for at least one sequence of seq_length"
+            self.manager = PagedKVCacheManager(num_blocks, block_size, self.device)
+            self.caches = [PagedKVCache(self.manager) for _ in self.layers]
+        self._next_request_id = 0
+
+        # stats
+        self.generated_tokens = 0
+        self.prompt_tokens = 0
+        self.decode_steps = 0
+        self.occupied_slots = 0
+        self.elapsed_seconds = 0.0
+        self.preempted_sequences = 0
+
+    def add_request(self, context_tokens: List[int], request_id=None):
+        """Queues a prompt (a list of token ids) for generation and returns its request id."""
+        if len(context_tokens) == 0:
+            context_tokens = [self.eos_token_id]
+        if len(context_tokens) >= self.max_seq_len:
+            raise ValueError(
+                f"context length {len(context_tokens)} leaves no room to generate with seq_length {self.max_seq_len}"
+            )
+        if request_id is None:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+        self.queue.append(_Sequence(request_id, list(context_tokens)))
+        return request_id
+
+    def has_unfinished_requests(self):
+        return len(self.queue) > 0 or len(self.active) > 0
+
+    @property
+    def stats(self):
+        """tokens/sec and slot occupancy (mean fraction of the slots in use per decoding step) so far."""
+        return {
+            "generated_tokens": self.generated_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "decode_steps": self.decode_steps,
+            "elapsed_seconds": self.elapsed_seconds,
+            "tokens_per_second": self.generated_tokens
+            / max(self.elapsed_seconds, 1e-9),
+            "slot_occupancy": self.occupied_slots
+            / max(self.decode_steps * self.num_slots, 1),
+            "preempted_sequences": self.preempted_sequences,
+        }
+
+    def step(self):
+        """
+        Admits queued prompts into free slots, then runs one decoding step over all sequences in flight.
+
+        returns: list of dicts for the requests that finished in this step, see `_result`
+        """
+        start_time = time.time()
+        if self.paged:
+            finished = self._admit_paged()
+            if self.active:
+                finished.extend(self._decode_paged())
+        else:
+            finished = self._admit()
+            if self.active:
+                finished.extend(self._decode())
+        self.elapsed_seconds += time.time() - start_time
+        return finished
+
+    def run(self):
+        """Steps until all queued requests are done and returns their results in order of completion."""
+        results = []
+        while self.has_unfinished_requests():
+            results.extend(self.step())
+        return results
+
+    def _forward(self, tokens, position_ids, attention_mask, caches):
+        for layer, cache in zip(self.layers, caches):
+            layer.layer_past = cache
+        logits = forward_model(self.model, (tokens, position_ids, attention_mask))
+        # keep the model's own caches out of the way of other generation functions
+        for layer in self.layers:
+            layer.layer_past = None
+        return logits[:, -1]
+
+    def _sample(self, logits):
+        tokens = sample_tokens(
+            logits, temperature=self.temperature, top_k=self.top_k, top_p=self.top_p
+        )
+        # the sampled tokens decide which sequences finish, so all model parallel ranks need to agree on them
+        torch.distributed.broadcast(
+            tokens,
+            mpu.get_model_parallel_src_rank(),
+            group=mpu.get_model_parallel_group(),
+        )
+        return tokens.tolist()
+
+    def _admit(self):
+        """Prefills as many queued prompts as there are free slots (and room in the caches)."""
+        cache_len = self.caches[0].seq_len if self.active else 0
+        admitted = []
+        while self.queue and len(self.active) + len(admitted) < self.num_slots:
+            if self.active and len(self.queue[0].context_tokens) > cache_len:
+                break
+            admitted.append(self.queue.popleft())
+        if not admitted:
+            return []
+
+        prompt_len = max(len(seq.context_tokens) for seq in admitted)
+        if self.active:
+            caches = [
+                cache.zero_rows(len(admitted), cache_len - prompt_len)
+                for cache in self.caches
+            ]
+        else:
+            cache_len = prompt_len
+            caches = [
+                layer.attention.kv_cache_class(self.max_seq_len)
+                for layer in self.layers
+            ]
+
+        # left pad the prompts, so that they all end at cache position cache_len
+        tokens = []
+        for seq in admitted:
+            seq.start = cache_len - len(seq.context_tokens)
+            padding = prompt_len - len(seq.context_tokens)
+            tokens.append([self.neox_args.tokenizer.eod] * padding + seq.context_tokens)
+        tokens = torch.tensor(tokens, dtype=torch.long, device=self.device)
+
+        # causal mask over cache positions, also masking everything before each prompt (True == masked)
+        starts = torch.tensor([seq.start for seq in admitted], device=self.device)
+        key_positions = torch.arange(cache_len, device=self.device)
+        query_positions = key_positions[cache_len - prompt_len :]
+        attention_mask = (
+            key_positions[None, None, :] > query_positions[None, :, None]
+        ) | (key_positions[None, None, :] < starts[:, None, None])
+        position_ids = query_positions.unsqueeze(0).expand(len(admitted), -1)
+
+        logits = self._forward(
+            tokens, position_ids, attention_mask.unsqueeze(1), caches
+        )
+        if self.active:
+            for cache, new_rows in zip(self.caches, caches):
+                cache.append_rows(new_rows)
+        else:
+            self.caches = caches
+        self.active.extend(admitted)
+        self.prompt_tokens += sum(len(seq.context_tokens) for seq in admitted)
+
+        new_tokens = self._sample(logits)
+        return self._update(
+            list(range(len(self.active) - len(admitted), len(self.active))),
+            new_tokens,
+        )
+
+    def _decode(self):
+        """Forwards the last sampled token of every sequence in flight and samples the next one."""
+        if self.caches[0].seq_len == self.max_seq_len:
+            # the caches are full, drop the leading positions no sequence attends to
+            n = min(seq.start for seq in self.active)
+            for cache in self.caches:
+                cache.drop_front(n)
+            for seq in self.active:
+                seq.start -= n
+
+        cache_len = self.caches[0].seq_len
+        batch_size = len(self.active)
+        tokens = torch.tensor(
+            [[seq.generated_tokens[-1]] for seq in self.active],
+            dtype=torch.long,
+            device=self.device,
+        )
+        position_ids = torch.full(
+            (batch_size, 1), cache_len, dtype=torch.long, device=self.device
+        )
+        starts = torch.tensor([seq.start for seq in self.active], device=self.device)
+        attention_mask = (
+            torch.arange(cache_len + 1, device=self.device)[None, :] < starts[:, None]
+        )
+
+        logits = self._forward(
+            tokens, position_ids, attention_mask.view(batch_size, 1, 1, -1), self.caches
+        )
+        self.decode_steps += 1
+        self.occupied_slots += batch_size
+
+        return self._update(list(range(batch_size)), self._sample(logits))
+
+    def _admit_paged(self):
+        """Prefills as many queued prompts as there are free slots and cache blocks for."""
+        block_size = self.manager.block_size
+        free_blocks = self.manager.allocator.num_free_blocks
+        admitted, prompts = [], {}
+        while self.queue and len(self.active) + len(admitted) < self.num_slots:
+            seq = self.queue[0]
+            # preempted sequences are prefilled with the tokens they generated so far, except the last one
+            prompt = tuple(seq.context_tokens + seq.generated_tokens[:-1])
+            if prompt not in prompts:
+                # room for the prompt and the first decoding step
+                needed = len(prompt) // block_size + 1
+                if needed > free_blocks:
+                    break
+                free_blocks -= needed
+                prompts[prompt] = []
+            prompts[prompt].append(self.queue.popleft())
+            admitted.append(seq)
+        if not admitted:
+            return []
+
+        rows = []
+        for prompt, seqs in prompts.items():
+            # prefill the prompt once, all sequences with the same prompt share its blocks
+            self.manager.add_sequence(seqs[0])
+            self.manager.prepare([seqs[0]], len(prompt))
+            tokens = torch.tensor([prompt], dtype=torch.long, device=self.device)
+            logits = self._forward(
+                tokens,
+                self.manager.position_ids,
+                self.manager.attention_mask,
+                self.caches,
+            )
+            for seq in seqs[1:]:
+                self.manager.fork(seqs[0], seq)
+            self.active.extend(seqs)
+            rows.append(logits.expand(len(seqs), -1))
+            self.prompt_tokens += len(prompt) * len(seqs)
+
+        new_tokens = self._sample(torch.cat(rows))
+        rows = range(len(self.active) - len(admitted), len(self.active))
+        # the prompt of a preempted sequence predicts the last token it generated, which was already sampled
+        new_rows = [
+            (row, token)
+            for row, token in zip(rows, new_tokens)
+            if not self.active[row].generated_tokens
+        ]
+        return self._update(
+            [row for row, _ in new_rows], [token for _, token in new_rows]
+        )
+
+    def _decode_paged(self):
+        """Forwards the last sampled token of every sequence in flight, with a paged cache, and samples the next one."""
+        # make room for the next position of every sequence, preempting the most recently admitted ones
+        while not self.manager.can_append(self.active, 1):
+            seq = self.active.pop()
+            self.manager.free_sequence(seq)
+            self.queue.appendleft(seq)
+            self.preempted_sequences += 1
+
+        batch_size = len(self.active)
+        tokens = torch.tensor(
+            [[seq.generated_tokens[-1]] for seq in self.active],
+            dtype=torch.long,
+            device=self.device,
+        )
+        self.manager.prepare(self.active, 1)
+        logits = self._forward(
+            tokens,
+            self.manager.position_ids,
+            self.manager.attention_mask,
+            self.caches,
+        )
+        self.decode_steps += 1
+        self.occupied_slots += batch_size
+
+        return self._update(list(range(batch_size)), self._sample(logits))
+
+    def _update(self, rows, new_tokens):
+        """Appends new_tokens to the sequences in `rows`, and evicts the sequences that are done."""
+        now = time.time()
+        done = []
+        for row, token in zip(rows, new_tokens):
+            seq = self.active[row]
+            if seq.first_token_time is None:
+                seq.first_token_time = now
+            seq.generated_tokens.append(token)
+            self.generated_tokens += 1
+
+            all_tokens = seq.context_tokens + seq.generated_tokens
+            if token == self.eos_token_id or any(
+                all_tokens[-len(stop) :] == stop for stop in self.stop_tokens
+            ):
+                # like stream_tokens, the token that ended the completion is not part of it
+                seq.generated_tokens.pop()
+                seq.finished = True
+                done.append(row)
+            elif (
+                self.maximum_tokens is not None
+                and len(seq.generated_tokens) >= self.maximum_tokens
+            ) or len(all_tokens) >= self.max_seq_len:
+                done.append(row)
+
+        if not done:
+            return []
+
+        results = [self._result(self.active[row]) for row in done]
+        keep = [row for row in range(len(self.active)) if row not in done]
+        if self.paged:
+            for row in done:
+                self.manager.free_sequence(self.active[row])
+            self.active = [self.active[row] for row in keep]
+            return results
+        self.active = [self.active[row] for row in keep]
+        if self.active:
+            index = torch.tensor(keep, dtype=torch.long, device=self.device)
+            for cache in self.caches:
+                cache.select_rows(index)
+        else:
+            self.caches = None
+        return results
+
+    def _result(self, seq):
+        """
+        returns: dict containing the following fields:
+            - 'request_id'
+            - 'tokens' (the generated token ids)
+            - 'text' (the completion)
+            - 'length' (the length of the completion in number of tokens)
+            - 'finished' (True if an eos token or stop sequence ended the completion)
+            - 'message': a message associated with the generation procedure, can be a warning or error
+            - 'time_to_first_token_seconds' / 'duration_seconds': measured from when the request was added
+        """
+        message = None
+        try:
+            text = self.neox_args.tokenizer.detokenize(seq.generated_tokens)
+        except KeyError:
+            text = None
+            message = "WARNING: generated token which doesn't exist."
+        if not seq.generated_tokens:
+            message = "WARNING: text generation did not start; the first generated token was a stop token or eos token"
+        return {
+            "request_id": seq.request_id,
+            "tokens": seq.generated_tokens,
+            "text": text,
+            "length": len(seq.generated_tokens),
+            "finished": seq.finished,
+            "message": message,
+            "time_to_first_token_seconds": float(
+                seq.first_token_time - seq.arrival_time
+            ),
+            "duration_seconds": float(time.time() - seq.arrival_time),
+        }
+
+
+def generate_samples_continuous(
+    neox_args,
+    model,
+    text: Union[List[str], str],
+    num_slots: int,
+    eos_token_id: int = None,
+    maximum_tokens: int = 64,
+    temperature: float = 0.0,
+    top_k: int = 0,
+    top_p: float = 0.0,
+    stop_tokens=None,
+):
+    """
+    Generates samples from raw text with a ContinuousBatchingScheduler of `num_slots` slots and returns them in a
+    dictionary, in the order of `text`.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model in inference mode with use_cache=True
+    text: either a single prompt (str) or a list of prompts (List[str]).
+    num_slots: maximum number of prompts decoded together
+
+    eos_token_id, maximum_tokens, temperature, top_k, top_p, stop_tokens: see generate_samples_from_prompt
+
+    returns: List[dict] -> a list of dicts containing the fields of generate_samples_from_prompt
+                           ('context', 'text', 'length', 'finished', 'message', 'duration_seconds')
+    """
+    if isinstance(text, str):
+        text = [text]
+
+    model.module.clear_cache()
+    scheduler = ContinuousBatchingScheduler(
+        neox_args,
+        model,
+        num_slots=num_slots,
+        eos_token_id=eos_token_id,
+        maximum_tokens=maximum_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        stop_tokens=stop_tokens,
+    )
+    for idx, raw_text in enumerate(text):
+        scheduler.add_request(neox_args.tokenizer.tokenize(raw_text), request_id=idx)
+
+    generated_texts = [None] * len(text)
+    for result in scheduler.run():
+        generated_texts[result["request_id"]] = {
+            "context": text[result["request_id"]],
+            "text": result["text"],
+            "length": result["length"],
+            "finished": result["finished"],
+            "message": result["message"],
+            "duration_seconds": result["duration_seconds"],
+        }
+
+    stats = scheduler.stats
+    print_rank_0(
+        "generate_samples_continuous() {} tokens in {:.2f}s ({:.2f} tokens/sec), slot occupancy {:.1%}".format(
+            stats["generated_tokens"],
+            stats["elapsed_seconds"],
+            stats["tokens_per_second"],
+            stats["slot_occupancy"],
+        )
+    )
+    return generated_texts if is_mp_rank_0() else []
@@ -0,0 +1,443 @@
+"""Local HTTP server for text generation, batching queued requests into stream_tokens calls."""
+
+import asyncio
+import http
+import json
+import math
+import threading
+import time
+from collections import deque
+from typing import List
+
+import numpy as np
+import torch
+
+from megatron import mpu, print_rank_0
+from megatron.text_generation_utils import stream_generated_tokens
+
+# the type of every sampling parameter of a request (the type of its NeoXArgs field, whose config value may be an int
+# for a float field), and the check and description of its valid values
+SAMPLING_PARAMS = {
+    "temperature": (float, lambda value: value >= 0, ">= 0"),
+    "top_k": (int, lambda value: value >= 0, "an integer >= 0"),
+    "top_p": (float, lambda value: 0 <= value <= 1, "between 0 and 1"),
+    "repetition_penalty": (float, lambda value: value > 0, "> 0"),
+    "presence_penalty": (float, lambda value: True, "a number"),
+}
+
+
+def parse_sampling_params(data: dict, neox_args) -> dict:
+    """
+    Returns the sampling parameters of a request's json data, defaulting to the values in neox_args; raises a ValueError
+    for values that aren't (finite) numbers of the parameter's type or are out of its range.
+    """
+    sampling = {}
+    for param, (param_type, is_valid, description) in SAMPLING_PARAMS.items():
+        value = data.get(param, getattr(neox_args, param))
+        if (
+            isinstance(value, bool)
+            or not isinstance(value, (int, float))
+            or not math.isfinite(value)
+            or (param_type is int and not float(value).is_integer())
+            or not is_valid(value)
+        ):
+            raise ValueError(f"{param} must be {description}, got {value!r}")
+        sampling[param] = param_type(value)
+    return sampling
+
+
+class _Request:
+    """A completion request, its sampling parameters and the queue of events streamed back to its connection."""
+
+    def __init__(self, context_tokens: List[int], maximum_tokens: int, sampling: dict):
+        self.context_tokens = context_tokens
+        self.maximum_tokens = maximum_tokens
+        self.sampling = sampling
+        self.events = asyncio.Queue()
+        self.arrival_time = time.time()
+        self.start_time = None
+        self.first_token_time = None
+        self.length = 0
+        self.done = False
+
+    @property
+    def key(self):
+        """requests with the same key can be completed in one stream_tokens call"""
+        return tuple(self.sampling[param] for param in SAMPLING_PARAMS)
+
+
+class ServerMetrics:
+    """Counters and latency windows of the server, read through GET /metrics."""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.requests_total = 0
+        self.requests_completed = 0
+        self.tokens_generated_total = 0
+        self.batches_total = 0
+        self.batch_sizes = {}
+        self.queue_wait_ms = deque(maxlen=window)
+        self.time_to_first_token_ms = deque(maxlen=window)
+        self.request_latency_ms = deque(maxlen=window)
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {"p50": None, "p99": None}
+        return {
+            "p50": float(np.percentile(values, 50)),
+            "p99": float(np.percentile(values, 99)),
+        }
+
+    def snapshot(self, queue_depth: int):
+        with self.lock:
+            num_batched = sum(size * n for size, n in self.batch_sizes.items())
+            return {
+                "queue_depth": queue_depth,
+                "requests_total": self.requests_total,
+                "requests_completed": self.requests_completed,
+                "tokens_generated_total": self.tokens_generated_total,
+                "batches_total": self.batches_total,
+                "batch_size_mean": num_batched / max(self.batches_total, 1),
+                "batch_size_counts": {
+                    str(size): n for size, n in sorted(self.batch_sizes.items())
+                },
+                "queue_wait_ms": self._percentiles(self.queue_wait_ms),
+                "time_to_first_token_ms": self._percentiles(
+                    self.time_to_first_token_ms
+                ),
+                "request_latency_ms": self._percentiles(self.request_latency_ms),
+            }
+
+
+class GenerationServer:
+    """
+    Serves completions over a local HTTP socket.
+
+    Global rank 0 runs an asyncio event loop in a background thread, which accepts the requests and queues them. The
+    model loop (`run`, on all ranks) takes the oldest queued request together with the queued requests that have the
+    same sampling parameters, up to max_batch_size, and broadcasts them to the model parallel ranks, which complete
+    them together in one stream_tokens call. Generated text is streamed back as soon as it is detokenized.
+
+    Endpoints:
+        POST /completions: json body with "prompt" and optionally "maximum_tokens", "temperature", "top_k", "top_p",
+                           "repetition_penalty", "presence_penalty" (defaulting to neox_args) and "stream". Responds
+                           with json {"text", "length", "finished", "duration_seconds"}, where finished means an eos
+                           token was generated, or with "stream": true with server-sent events: {"text"} for every
+                           new piece of text, then the json response without the text, then [DONE].
+        GET /metrics: queue depth, request / token / batch counters, batch sizes, and p50 / p99 of the queue wait,
+                      time to first token and request latency over the last requests.
+        GET /health
+
+    neox_args: NeoXArgs.
+    model: a Megatron model in inference mode (not pipe parallel, and without data parallelism).
+    host / port: address the server listens on, port 0 picks a free port (see `port` after `start`)
+    max_batch_size: maximum number of requests completed together
+    batch_wait_ms: how long a new request waits for more requests to be batched with
+    idle_poll_seconds: how often the model parallel ranks are woken up while no requests are queued
+    """
+
+    def __init__(
+        self,
+        neox_args,
+        model,
+        host: str = "127.0.0.1",
+        port: int = 5000,
+        max_batch_size: int = 1,
+        batch_wait_ms: float = 10.0,
+        idle_poll_seconds: float = 1.0,
+    ):
+        assert max_batch_size > 0, "max_batch_size must be > 0"
+        assert (
+            not neox_args.is_pipe_parallel
+        ), "the generation server is not supported with pipeline parallelism"
+        assert (
+            mpu.get_data_parallel_world_size() == 1
+        ), "the generation server serves one model replica, without data parallelism"
+        self.neox_args = neox_args
+        self.model = model
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.batch_wait_seconds = batch_wait_ms / 1000
+        self.idle_poll_seconds = idle_poll_seconds
+        self.is_server_rank = torch.distributed.get_rank() == 0
+        self.metrics = ServerMetrics()
+        self.loop = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    # event loop thread (rank 0)
+
+    def start(self):
+        """Starts listening on rank 0; requests are answered once `run` is called on all ranks."""
+        if not self.is_server_rank:
+            return
+        started = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.queue = asyncio.Queue()
+            self.waiting = []
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port)
+            )
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        print_rank_0(f"generation server listening on http://{self.host}:{self.port}")
+
+    def shutdown(self):
+        """Makes `run` return after the current batch; can be called from any thread of rank 0."""
+        self.stopping.set()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ["\r\n", "\n", ""]:
+                    break
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "POST" and path == "/completions":
+                await self._completion(writer, body)
+            elif method == "GET" and path == "/metrics":
+                queue_depth = len(self.waiting) + self.queue.qsize()
+                await self._respond(writer, 200, self.metrics.snapshot(queue_depth))
+            elif method == "GET" and path == "/health":
+                await self._respond(writer, 200, {"status": "ok"})
+            else:
+                await self._respond(writer, 404, {"error": f"no {method} {path}"})
+        except (ValueError, KeyError, TypeError) as e:
+            await self._respond(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, data):
+        body = json.dumps(data).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    async def _completion(self, writer, body):
+        data = json.loads(body)
+        prompt = data["prompt"]
+        if not isinstance(prompt, str):
+            raise TypeError("prompt must be a string")
+        context_tokens = self.neox_args.tokenizer.tokenize(prompt) or [
+            self.neox_args.tokenizer.eod
+        ]
+        context_tokens = [int(t) for t in context_tokens]
+        if len(context_tokens) >= self.neox_args.seq_length - 1:
+            raise ValueError(
+                f"the prompt has {len(context_tokens)} tokens, the model's seq_length is "
+                f"{self.neox_args.seq_length}"
+            )
+        maximum_tokens = int(
+            data.get("maximum_tokens", self.neox_args.maximum_tokens or 64)
+        )
+        if maximum_tokens <= 0:
+            raise ValueError("maximum_tokens must be > 0")
+        sampling = parse_sampling_params(data, self.neox_args)
+        request = _Request(context_tokens, maximum_tokens, sampling)
+        with self.metrics.lock:
+            self.metrics.requests_total += 1
+        self.queue.put_nowait(request)
+
+        stream = bool(data.get("stream", False))
+        if stream:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+            )
+        text = []
+        while True:
+            event, value = await request.events.get()
+            if event == "text":
+                text.append(value)
+                if stream:
+                    writer.write(f"data: {json.dumps({'text': value})}\n\n".encode())
+                    await writer.drain()
+            else:
+                break
+        if stream:
+            writer.write(f"data: {json.dumps(value)}\n\ndata: [DONE]\n\n".encode())
+            await writer.drain()
+        else:
+            await self._respond(writer, 200, dict(text="".join(text), **value))
+
+    async def _next_batch(self):
+        """the oldest queued request and the queued requests compatible with it, or None if none arrived in time"""
+        if not self.waiting:
+            try:
+                self.waiting.append(
+                    await asyncio.wait_for(
+                        self.queue.get(), timeout=self.idle_poll_seconds
+                    )
+                )
+            except asyncio.TimeoutError:
+                return None
+            if self.max_batch_size > 1 and self.batch_wait_seconds > 0:
+                await asyncio.sleep(self.batch_wait_seconds)
+        while not self.queue.empty():
+            self.waiting.append(self.queue.get_nowait())
+        key = self.waiting[0].key
+        batch = [r for r in self.waiting if r.key == key][: self.max_batch_size]
+        self.waiting = [r for r in self.waiting if r not in batch]
+        return batch
+
+    def _emit(self, request, event, value):
+        self.loop.call_soon_threadsafe(request.events.put_nowait, (event, value))
+
+    # model loop (all ranks)
+
+    def _next_work(self):
+        """rank 0: the batch to complete next and its description for all model parallel ranks"""
+        if self.stopping.is_set():
+            return None, {"type": "stop"}
+        batch = asyncio.run_coroutine_threadsafe(self._next_batch(), self.loop).result()
+        if batch is None:
+            return None, {"type": "idle"}
+        work = {
+            "type": "generate",
+            "context_tokens": [r.context_tokens for r in batch],
+            "maximum_tokens": [r.maximum_tokens for r in batch],
+            "sampling": batch[0].sampling,
+        }
+        return batch, work
+
+    def run(self):
+        """
+        Completes the queued requests until `shutdown` is called. Has to be called on all ranks, which receive the
+        batches from rank 0.
+        """
+        device = next(self.model.module.parameters()).device
+        while True:
+            batch, work = None, None
+            if self.is_server_rank:
+                batch, work = self._next_work()
+            objects = [work]
+            if mpu.get_model_parallel_world_size() > 1:
+                torch.distributed.broadcast_object_list(
+                    objects,
+                    src=mpu.get_model_parallel_src_rank(),
+                    group=mpu.get_model_parallel_group(),
+                )
+            work = objects[0]
+            if work["type"] == "stop":
+                break
+            if work["type"] == "generate":
+                self._generate(work, batch)
+
+        if self.is_server_rank:
+            # answer the requests that are still queued, and stop listening
+            async def drain():
+                while not self.queue.empty():
+                    self.waiting.append(self.queue.get_nowait())
+                for request in self.waiting:
+                    request.events.put_nowait(
+                        ("done", {"error": "the server is shutting down"})
+                    )
+                await asyncio.sleep(0.1)
+                self.loop.stop()
+
+            asyncio.run_coroutine_threadsafe(drain(), self.loop)
+            self.thread.join()
+
+    def _generate(self, work, batch):
+        """completes one batch on all model parallel ranks; rank 0 streams the text to the requests in batch"""
+        context_lengths = [len(tokens) for tokens in work["context_tokens"]]
+        # stream_tokens counts maximum_tokens from the shortest context in the batch
+        maximum_tokens = (
+            max(work["maximum_tokens"]) + max(context_lengths) - min(context_lengths)
+        )
+        self.model.module.clear_cache()
+        start_time = time.time()
+        if batch is not None:
+            detokenizers = [
+                self.neox_args.tokenizer.incremental_detokenizer() for _ in batch
+            ]
+            for request in batch:
+                request.start_time = start_time
+
+        for new_tokens, is_done in stream_generated_tokens(
+            neox_args=self.neox_args,
+            model=self.model,
+            context_tokens=work["context_tokens"],
+            maximum_tokens=maximum_tokens,
+            recompute=self.neox_args.recompute,
+            **work["sampling"],
+        ):
+            if batch is None:
+                continue
+            now = time.time()
+            for request, detokenizer, tokens, done in zip(
+                batch, detokenizers, new_tokens, is_done
+            ):
+                if request.done:
+                    continue
+                if tokens:
+                    if request.first_token_time is None:
+                        request.first_token_time = now
+                    request.length += len(tokens)
+                    text = detokenizer.add(tokens)
+                    if text:
+                        self._emit(request, "text", text)
+                if done or request.length >= request.maximum_tokens:
+                    self._finish(request, detokenizer, finished=bool(done))
+
+        if batch is not None:
+            for request, detokenizer in zip(batch, detokenizers):
+                if not request.done:  # stopped by the sequence length
+                    self._finish(request, detokenizer, finished=False)
+            with self.metrics.lock:
+                self.metrics.batches_total += 1
+                self.metrics.batch_sizes[len(batch)] = (
+                    self.metrics.batch_sizes.get(len(batch), 0) + 1
+                )
+
+    def _finish(self, request, detokenizer, finished):
+        request.done = True
+        text = detokenizer.flush()
+        if text:
+            self._emit(request, "text", text)
+        end_time = time.time()
+        self._emit(
+            request,
+            "done",
+            {
+                "length": request.length,
+                "finished": finished,
+                "duration_seconds": end_time - request.start_time,
+            },
+        )
+        with self.metrics.lock:
+            self.metrics.requests_completed += 1
+            self.metrics.tokens_generated_total += request.length
+            self.metrics.queue_wait_ms.append(
+                (request.start_time - request.arrival_time) * 1e3
+            )
+            if request.first_token_time is not None:
+                self.metrics.time_to_first_token_ms.append(
+                    (request.first_token_time - request.arrival_time) * 1e3
+                )
+            self.metrics.request_latency_ms.append(
+                (end_time - request.arrival_time) * 1e3
+            )
@@ -0,0 +1,215 @@
+"""Proposers of the next tokens for speculative decoding, see stream_tokens and verify_proposals."""
+
+import torch
+
+from megatron.text_generation_sampling import sampling_probs
+from megatron.text_generation_utils import forward_model
+
+
+class SpeculativeProposer:
+    """
+    Base class of the proposers of speculative decoding. A proposer guesses the next tokens of every batch item, which
+    the model then verifies in a single forward pass. It also keeps the acceptance statistics of the generations it was
+    used in.
+    """
+
+    def __init__(self):
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.target_forwards = 0
+
+    def reset(self):
+        """Called at the start of every generation."""
+
+    def propose(
+        self,
+        context_tokens,
+        position_ids,
+        attention_mask,
+        index,
+        num_tokens,
+        start_index,
+        temperature=0.0,
+        top_k=0,
+        top_p=0.0,
+    ):
+        """
+        Proposes the tokens at positions [index, index + num_tokens) of every batch item, given the tokens before index.
+
+        context_tokens / position_ids: torch.Tensor of shape [batch, padded length]
+        attention_mask: the (causal) attention mask of the batch
+        start_index: torch.Tensor of shape [batch]; the tokens before start_index are the batch item's prompt, so they
+                     are known rather than proposed
+        temperature / top_k / top_p: the sampling parameters of the generation
+
+        returns: tuple of (torch.Tensor of shape [batch, num_tokens] with the proposed token ids; the distributions they
+                 were drawn from as a torch.Tensor of shape [batch, num_tokens, vocab_size], or None if they are
+                 deterministic)
+        """
+        raise NotImplementedError
+
+    def rollback(self, seq_len):
+        """Called after verification: only the tokens before seq_len are kept."""
+
+    def select_rows(self, index):
+        """Called when the batch is reduced to the rows in `index` (a LongTensor)."""
+
+    @staticmethod
+    def _known_tokens(proposals, context_tokens, index, start_index):
+        # replace the proposals for positions in the prompt by the prompt
+        end = index + proposals.size(1)
+        positions = torch.arange(index, end, device=proposals.device)
+        return torch.where(
+            positions.unsqueeze(0) < start_index.unsqueeze(1),
+            context_tokens[:, index:end],
+            proposals,
+        )
+
+    def record(self, num_sequences, num_proposed, num_accepted, num_generated):
+        """Records a verifying forward pass of num_sequences batch items."""
+        self.proposed_tokens += num_proposed
+        self.accepted_tokens += num_accepted
+        self.generated_tokens += num_generated
+        self.target_forwards += num_sequences
+
+    @property
+    def stats(self):
+        """Acceptance rate of the proposals, and tokens generated per sequence per verifying forward pass of the model."""
+        return {
+            "proposed_tokens": self.proposed_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.accepted_tokens / max(self.proposed_tokens, 1),
+            "tokens_per_target_forward": self.generated_tokens
+            / max(self.target_forwards, 1),
+        }
+
+
+class DraftModelProposer(SpeculativeProposer):
+    """
+    Proposes tokens by sampling from a small draft model, e.g. a small NeoX model trained with the same tokenizer.
+
+    The draft model keeps its own kv cache, which is rolled back with the model's after every verification.
+
+    draft_model: a Megatron model in inference mode with use_cache=True (not pipe parallel), with the same tokenizer and
+                 model parallel size as the model
+    """
+
+    def __init__(self, draft_model):
+        super().__init__()
+        self.model = draft_model
+        self.seq_len = 0
+
+    def reset(self):
+        self.model.module.clear_cache()
+        self.seq_len = 0
+
+    def propose(
+        self,
+        context_tokens,
+        position_ids,
+        attention_mask,
+        index,
+        num_tokens,
+        start_index,
+        temperature=0.0,
+        top_k=0,
+        top_p=0.0,
+    ):
+        # forward all tokens the draft model has not seen yet
+        tokens = context_tokens[:, self.seq_len : index]
+        positions = position_ids[:, self.seq_len : index]
+        proposals, probs = [], []
+        for i in range(num_tokens):
+            logits = forward_model(self.model, (tokens, positions, attention_mask))
+            q = sampling_probs(logits[:, -1], temperature, top_k, top_p)
+            proposal = self._known_tokens(
+                torch.multinomial(q, num_samples=1),
+                context_tokens,
+                index + i,
+                start_index,
+            )
+            proposals.append(proposal)
+            probs.append(q)
+            tokens = proposal
+            positions = position_ids[:, index + i : index + i + 1]
+        # the last proposal is not forwarded
+        self.seq_len = index + num_tokens - 1
+        return torch.cat(proposals, dim=1), torch.stack(probs, dim=1)
+
+    def rollback(self, seq_len):
+        if seq_len < self.seq_len:
+            self.model.module.truncate_cache(seq_len)
+            self.seq_len = seq_len
+
+    def select_rows(self, index):
+        self.model.module.select_cache_rows(index)
+
+
+class NGramProposer(SpeculativeProposer):
+    """
+    Draft-free proposer ("prompt lookup"): finds the most recent earlier occurrence of the last n tokens of a batch item
+    (trying n = max_ngram down to min_ngram) and proposes the tokens that followed it. This works well when the
+    completion copies from the prompt, e.g. for summarization, extraction or code editing. Batch items without a match
+    repeat their last token.
+
+    max_ngram / min_ngram: longest / shortest suffix to look up
+    """
+
+    def __init__(self, max_ngram=3, min_ngram=1):
+        super().__init__()
+        assert 0 < min_ngram <= max_ngram
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(
+        self,
+        context_tokens,
+        position_ids,
+        attention_mask,
+        index,
+        num_tokens,
+        start_index,
+        temperature=0.0,
+        top_k=0,
+        top_p=0.0,
+    ):
+        history = context_tokens[:, :index]
+        batch_size = history.size(0)
+        proposals = history[:, -1:].expand(batch_size, num_tokens)
+        found = torch.zeros(batch_size, dtype=torch.bool, device=history.device)
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if index <= n:
+                continue
+            # every earlier n-gram that is followed by at least one token: [batch, index - n, n]
+            ngrams = history[:, :-1].unfold(1, n, 1)
+            matches = (ngrams == history[:, -n:].unsqueeze(1)).all(dim=-1)
+            starts = torch.arange(matches.size(1), device=history.device)
+            last_match = torch.where(matches, starts, torch.full_like(starts, -1)).max(
+                dim=1
+            )[0]
+
+            # the tokens after the match, repeating the last token past the end of the history
+            continuation = (last_match + n).unsqueeze(1) + torch.arange(
+                num_tokens, device=history.device
+            )
+            continuation = history.gather(1, continuation.clamp(0, index - 1))
+            use = (last_match >= 0) & ~found
+            proposals = torch.where(use.unsqueeze(1), continuation, proposals)
+            found = found | use
+        return self._known_tokens(proposals, context_tokens, index, start_index), None
+
+
+def get_speculative_proposer(neox_args, draft_model=None):
+    """
+    Returns the proposer selected by neox_args.speculative_decoding ("draft" needs the draft model, see
+    setup_draft_model), or None.
+    """
+    if neox_args.speculative_decoding == "draft":
+        assert (
+            draft_model is not None
+        ), "speculative decoding with a draft model needs the draft model"
+        return DraftModelProposer(draft_model)
+    elif neox_args.speculative_decoding == "ngram":
+        return NGramProposer()
+    return None
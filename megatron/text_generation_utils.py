@@ -16,7 +16,9 @@
 
 """Utilities for generating text."""
 
+import contextlib
 import copy
+import glob
 import json
 import os
 import time
@@ -27,21 +29,31 @@ import torch.nn.functional as F
 
 from megatron import print_rank_0
 from megatron import mpu
+from megatron.model.kv_cache import PromptCache, StaticKVCache
+from megatron.model.transformer import ParallelTransformerLayer
 from megatron.utils import get_ltor_masks_and_position_ids, is_mp_rank_0
+from megatron.text_generation_sampling import (
+    filter_logits,
+    sample_tokens,
+    sample_tokens_vocab_parallel,
+    sampling_probs,
+    TokenPenalties,
+    verify_proposals,
+)
 
 
 def get_batch(neox_args, context_tokens: torch.Tensor):
     """
-    Generate batch from context tokens. Attention mask and position ids are created. Returned tensors will be on CUDA.
+    Generate batch from context tokens. Attention mask and position ids are created on the device of context_tokens.
 
     neox_args: NeoXArgs.
-    context_tokens: torch tensor with dimensions [batch, context_size]
+    context_tokens: torch tensor with dimensions [batch, context_size]; context_size is the padded length of the
+                    batch, which may be shorter than neox_args.seq_length. Mask and position ids match that length.
 
-    returns: tuple of torch tensors (tokens, attention_mask, position_ids) on CUDA
+    returns: tuple of torch tensors (tokens, attention_mask, position_ids)
     """
 
-    # Move to GPU.
-    tokens = context_tokens.contiguous().cuda()
+    tokens = context_tokens.contiguous()
     # Get the attention mask and position ids.
     attention_mask, _, position_ids = get_ltor_masks_and_position_ids(
         data=tokens,
@@ -53,7 +65,7 @@ def get_batch(neox_args, context_tokens: torch.Tensor):
 
 def pad_batch(context_tokens: List[List[int]], pad_id: int, pad_len: int):
     """
-    pads context lengths in context_tokens with pad_id to equal neox_args.seq_length,
+    pads context lengths in context_tokens with pad_id to equal pad_len,
     and returns the padded batch and the new lengths.
 
     context_tokens: list of lists of tokens
@@ -74,43 +86,6 @@ def pad_batch(context_tokens: List[List[int]], pad_id: int, pad_len: int):
     return context_tokens, context_lengths
 
 
-def filter_logits(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
-    """
-    Filters the logits using top_k / top_p, filling any filtered vocab items with filter_value (defaults to -inf).
-
-    This function has been mostly taken from huggingface conversational ai code at
-    https://medium.com/huggingface/how-to-build-a-state-of-the-art-conversational-ai-with-transfer-learning-2d818ac26313
-
-    logits: torch.Tensor -> logits of megatron model.
-    top_k: integer -> integer between 0 and the models vocab size. Filters out any logits with a probability less than that of the top_kth token.
-    top_p: float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
-
-    returns: (filtered) logits"""
-
-    if top_k > 0:
-        # Remove all tokens with a probability less than the
-        # last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-
-    if top_p > 0.0:
-        # convert to 1D
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token
-        # above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-        for i in range(sorted_indices.size(0)):
-            indices_to_remove = sorted_indices[i][sorted_indices_to_remove[i]]
-            logits[i][indices_to_remove] = filter_value
-
-    return logits
-
-
 def switch(val1, val2, boolean):
     """
     replaces items in val1 with items in val2 where boolean = True
@@ -157,9 +132,13 @@ def forward_model(model, model_inputs, is_pipe_parallel=False) -> torch.Tensor:
         return logits
 
 
-def broadcast_terminate_signal(terminate_runs: int):
-    """Send signal to all workers to terminate if we've finished the process"""
-    terminate_runs_tensor = torch.cuda.LongTensor([terminate_runs])
+def broadcast_terminate_signal(terminate_runs: int, device=None):
+    """Send signal to all workers to terminate if we've finished the process (device defaults to the current cuda device)"""
+    if device is None:
+        device = torch.cuda.current_device()
+    terminate_runs_tensor = torch.tensor(
+        [terminate_runs], dtype=torch.long, device=device
+    )
     torch.distributed.broadcast(
         terminate_runs_tensor,
         mpu.get_model_parallel_src_rank(),
@@ -168,18 +147,255 @@ def broadcast_terminate_signal(terminate_runs: int):
     return terminate_runs_tensor[0].item()
 
 
-def stop_tokens_in_completion(stop_tokens, context_tokens, batch_index, current_index):
-    if stop_tokens is None:
-        return False
-    res = []
-    for token_group in stop_tokens:
-        context = context_tokens[batch_index, : current_index + 1]
-        context = context[-len(token_group) :]
-        if context.shape[0] == token_group.shape[0]:
-            res.append(all(token_group == context))
+def pad_stop_tokens(stop_tokens: List[List[int]], pad_id: int = -1):
+    """
+    Stacks stop sequences of different lengths into a single tensor, so they can be matched all at once
+    (see stop_tokens_in_completion). Sequences are right aligned and left padded with pad_id, which must not be a valid
+    token id. Empty sequences are dropped.
+
+    stop_tokens: list of lists of token ids
+
+    returns: torch.LongTensor of shape [num_stop_sequences, max_stop_sequence_length]
+    """
+    stop_tokens = [list(tokens) for tokens in stop_tokens if len(tokens) > 0]
+    max_length = max((len(tokens) for tokens in stop_tokens), default=0)
+    return torch.LongTensor(
+        [[pad_id] * (max_length - len(tokens)) + tokens for tokens in stop_tokens]
+    ).view(len(stop_tokens), max_length)
+
+
+def stop_tokens_in_completion(stop_tokens, context_tokens, current_index):
+    """
+    Checks for all batch items at once whether the tokens up to current_index end with one of the stop sequences.
+
+    The last max_stop_sequence_length tokens of every batch item are compared against all stop sequences in one
+    operation; padding positions of the stop sequences always match, and positions before the start of the context
+    never match.
+
+    stop_tokens: padded stop sequences of shape [num_stop_sequences, max_stop_sequence_length] (see pad_stop_tokens),
+                 or None
+    context_tokens: torch tensor with dimensions [batch, context_size]
+    current_index: index of the last token to be considered
+
+    returns: bool torch tensor of shape [batch], True where a stop sequence was produced
+    """
+    if stop_tokens is None or stop_tokens.numel() == 0:
+        return torch.zeros(
+            context_tokens.size(0), dtype=torch.bool, device=context_tokens.device
+        )
+    window_start = current_index + 1 - stop_tokens.size(1)
+    window = context_tokens[:, max(window_start, 0) : current_index + 1]
+    if window_start < 0:
+        window = F.pad(window, (-window_start, 0), value=-1)
+
+    # [batch, 1, max_stop_sequence_length] vs [1, num_stop_sequences, max_stop_sequence_length]
+    matches = (window.unsqueeze(1) == stop_tokens.unsqueeze(0)) | (
+        stop_tokens < 0
+    ).unsqueeze(0)
+    return matches.all(dim=-1).any(dim=-1)
+
+
+def broadcast_context_tokens(
+    neox_args,
+    context_tokens: List[List[int]],
+    maximum_tokens: int = None,
+    device=None,
+    max_length: int = None,
+):
+    """
+    Pads the prompts into a tensor and broadcasts it from the model parallel source rank, which is the only rank
+    guaranteed to hold the real prompts. Prompts are only padded up to the longest prompt plus maximum_tokens (if
+    given), as positions past that are never read.
+
+    context_tokens: unpadded list of lists of token ids
+    device: device of the returned tensors
+    max_length: maximum padded length, defaults to neox_args.seq_length
+
+    returns: tuple of torch tensors (context_tokens [batch, pad_len], token_generation_start_index [batch])
+    """
+    pad_len = max_length or neox_args.seq_length
+    if maximum_tokens is not None:
+        pad_len = min(
+            pad_len, max(len(tokens) for tokens in context_tokens) + maximum_tokens
+        )
+    pad_len = torch.tensor([pad_len], dtype=torch.long, device=device)
+    torch.distributed.broadcast(
+        pad_len,
+        mpu.get_model_parallel_src_rank(),
+        group=mpu.get_model_parallel_group(),
+    )
+    context_tokens, context_lengths = pad_batch(
+        copy.deepcopy(context_tokens),
+        pad_id=neox_args.tokenizer.eod,
+        pad_len=pad_len.item(),
+    )
+
+    # Make sure context tokens + start tokens are the same across all ranks
+    context_tokens = torch.tensor(context_tokens, dtype=torch.long, device=device)
+    token_generation_start_index = torch.tensor(
+        context_lengths, dtype=torch.long, device=device
+    )
+    torch.distributed.broadcast(
+        context_tokens,
+        mpu.get_model_parallel_src_rank(),
+        group=mpu.get_model_parallel_group(),
+    )
+    torch.distributed.broadcast(
+        token_generation_start_index,
+        mpu.get_model_parallel_src_rank(),
+        group=mpu.get_model_parallel_group(),
+    )
+    return context_tokens, token_generation_start_index
+
+
+def get_prompt_cache(neox_args, model):
+    """
+    Returns the PromptCache of the model, created on first use with a budget of neox_args.prompt_cache_size_mb.
+
+    Returns None if the budget is 0, or with pipeline parallelism, where the model derives the position ids from the
+    tokens and the suffix of a restored prompt can't be forwarded at its positions.
+    """
+    if not neox_args.prompt_cache_size_mb or neox_args.is_pipe_parallel:
+        return None
+    if getattr(model, "prompt_cache", None) is None:
+        model.prompt_cache = PromptCache(int(neox_args.prompt_cache_size_mb * 2 ** 20))
+    return model.prompt_cache
+
+
+def _transformer_layers(model):
+    return [
+        m for m in model.module.modules() if isinstance(m, ParallelTransformerLayer)
+    ]
+
+
+def restore_prompt_prefix(prompt_cache, model, context_tokens):
+    """
+    Restores the keys / values of the longest prefix of the prompts (context_tokens, [b, n]) held by prompt_cache into
+    the `layer_past` of the model's layers, which must have been cleared.
+
+    returns: the number of restored positions, which are not to be forwarded again
+    """
+    layers = _transformer_layers(model)
+    length, key_values = prompt_cache.restore(context_tokens.tolist())
+    for layer, layer_past in zip(layers, key_values):
+        if layer.attention.static_kv_cache:
+            if type(layer.layer_past) is not layer.attention.kv_cache_class:
+                layer.layer_past = layer.attention.kv_cache_class(
+                    layer.attention.max_seq_len
+                )
+            layer.layer_past.reset()
+            layer.layer_past.update(layer_past[0], layer_past[1])
         else:
-            res.append(False)
-    return any(res)
+            layer.layer_past = layer_past
+    return length
+
+
+def store_prompt_prefix(prompt_cache, model, context_tokens):
+    """Caches the keys / values of the prompts (context_tokens, [b, n]) after their prefill in prompt_cache."""
+    key_values = []
+    for layer in _transformer_layers(model):
+        layer_past = layer.layer_past
+        if isinstance(layer_past, StaticKVCache):
+            layer_past = layer_past.cached()
+        key_values.append(layer_past)
+    prompt_cache.store(context_tokens.tolist(), key_values)
+
+
+@contextlib.contextmanager
+def logits_for_all_positions(model):
+    """Temporarily computes logits for every position of a model in `inference_mode(last_position_only=True)`."""
+    modules = [
+        m
+        for m in model.module.modules()
+        if getattr(m, "last_position_only", False) is True
+    ]
+    for m in modules:
+        m.last_position_only = False
+    try:
+        yield
+    finally:
+        for m in modules:
+            m.last_position_only = True
+
+
+def speculative_decoding_step(
+    model,
+    proposer,
+    context_tokens,
+    position_ids,
+    attention_mask,
+    token_index_to_generate,
+    token_generation_start_index,
+    state_is_done,
+    num_speculative_tokens,
+    temperature=0.0,
+    top_k=0,
+    top_p=0.0,
+):
+    """
+    Generates the tokens from token_index_to_generate onwards with speculative decoding: the proposer proposes
+    num_speculative_tokens tokens, which the model verifies in a single cached forward pass (see verify_proposals). The
+    kv caches of the model (and proposer) are then rolled back to the accepted tokens.
+
+    The kv cache must hold all positions before token_index_to_generate - 1, the position of the last token.
+
+    returns: list of torch.Tensor of shape [batch], the tokens for positions token_index_to_generate,
+             token_index_to_generate + 1, ... (at least one)
+    """
+    index = token_index_to_generate
+    k = num_speculative_tokens
+    proposals, proposal_probs = proposer.propose(
+        context_tokens,
+        position_ids,
+        attention_mask,
+        index,
+        k,
+        token_generation_start_index,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+    )
+
+    # forward the last token and the proposals: [b, k + 1, vocab_size]
+    model_inputs = (
+        torch.cat((context_tokens[:, index - 1 : index], proposals), dim=1),
+        position_ids[:, index - 1 : index + k],
+        attention_mask,
+    )
+    with logits_for_all_positions(model):
+        logits = forward_model(model, model_inputs)
+    target_probs = sampling_probs(logits, temperature, top_k, top_p)
+    if proposal_probs is not None and proposal_probs.size(-1) != logits.size(-1):
+        # the padded vocab sizes of the draft model and the model may differ
+        vocab_size = logits.size(-1)
+        proposal_probs = F.pad(
+            proposal_probs[..., :vocab_size],
+            (0, max(vocab_size - proposal_probs.size(-1), 0)),
+        )
+
+    # prompt tokens and batch items that are done don't hold back the others
+    known = (
+        torch.arange(index, index + k, device=proposals.device).unsqueeze(0)
+        < token_generation_start_index.unsqueeze(1)
+    ) | state_is_done.bool().unsqueeze(1)
+    tokens, num_accepted = verify_proposals(
+        proposals, target_probs, proposal_probs, accepted=known
+    )
+    num_kept = tokens.size(1) - 1
+
+    # only keep the cached keys / values of the last token and the proposals that were kept
+    model.module.truncate_cache(index + num_kept)
+    proposer.rollback(index + num_kept)
+
+    generating = (token_generation_start_index <= index) & ~state_is_done.bool()
+    num_sequences = generating.sum().item()
+    proposer.record(
+        num_sequences,
+        num_proposed=k * num_sequences,
+        num_accepted=num_accepted[generating].sum().item(),
+        num_generated=(num_kept + 1) * num_sequences,
+    )
+    return list(tokens.t())
 
 
 def stream_tokens(
@@ -193,6 +409,14 @@ def stream_tokens(
     top_k: int = 0,
     top_p: float = 0.0,
     stop_tokens=None,
+    repetition_penalty: float = 1.0,
+    presence_penalty: float = 0.0,
+    prompt_cache: PromptCache = None,
+    proposer=None,
+    num_speculative_tokens: int = 4,
+    compact_threshold: float = None,
+    sliding_window: int = None,
+    num_sink_tokens: int = 0,
 ):
     """
     iterator producing text completions
@@ -211,6 +435,28 @@ def stream_tokens(
     top_k (default 0): integer -> integer between 0 and the models vocab size. Filters out any logits with a probability less than that of the top_kth token.
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
+    repetition_penalty (default 1.0): float -> divides positive (multiplies negative) logits of tokens already in the context or completion; 1.0 disables it.
+    presence_penalty (default 0.0): float -> subtracted from the logits of tokens already in the context or completion; 0.0 disables it.
+    prompt_cache (optional): PromptCache from which the longest cached prefix of the prompts is restored (rather than
+                             prefilled) and to which the prefilled prompts are added; ignored if recompute is true
+    proposer (optional): SpeculativeProposer (see megatron.text_generation_speculative) -> decode with speculative
+                         decoding: the proposer proposes num_speculative_tokens tokens, which the model verifies in one
+                         forward pass. The tokens are distributed as without speculative decoding. Needs the kv cache,
+                         and can't be combined with the repetition / presence penalties or pipeline parallelism.
+    num_speculative_tokens (default 4): number of tokens proposed per forward pass of the model
+    compact_threshold (optional): float in (0, 1] -> once this fraction of the batch items still being decoded is done,
+                                  they are dropped from the batch (tokens, position ids, kv caches), so that they no
+                                  longer cost forward passes. The yielded tensors keep the original batch order.
+    sliding_window (optional): int -> generate past neox_args.seq_length (up to maximum_tokens, which is then
+                               required) with the kv cache holding only the first num_sink_tokens positions and the
+                               most recent sliding_window ones. Once the cache is full, the oldest positions after the
+                               sink tokens are evicted in place (an eighth of the window at a time, so the copy is
+                               amortized), keeping memory and the cost per token bounded. The positions of the cached
+                               tokens are their indices in the cache, so only rotary, AliBi, relative or no position
+                               embeddings are supported; prompts have to fit in the cache.
+    num_sink_tokens (default 0): number of leading positions never evicted with a sliding_window; a few "attention
+                                 sink" tokens keep the attention of models trained without a window stable
+                                 (https://arxiv.org/abs/2309.17453)
     yields: (
                 tokens (completions from model),
                 token_generation_start_index (token index per batch item for the first generated token),
@@ -226,36 +472,55 @@ def stream_tokens(
 
     model.eval()
 
-    # pad batch in order to allow conversion to tensor
-    context_tokens, context_lengths = pad_batch(
-        copy.deepcopy(context_tokens),
-        pad_id=neox_args.tokenizer.eod,
-        pad_len=neox_args.seq_length,
-    )
+    if sliding_window is not None:
+        cache_size = num_sink_tokens + sliding_window
+        assert (
+            not recompute and proposer is None and not neox_args.is_pipe_parallel
+        ), "sliding window generation needs the kv cache, and supports neither speculative decoding nor pipeline parallelism"
+        assert neox_args.pos_emb in [
+            "rotary",
+            "alibi",
+            "rpe",
+            "none",
+        ], "sliding window generation needs relative position embeddings"
+        assert (
+            maximum_tokens is not None
+        ), "sliding window generation needs maximum_tokens"
+        assert (
+            0 < sliding_window and cache_size <= neox_args.seq_length
+        ), "the sliding window and sink tokens have to fit in the sequence length"
+        if max(len(tokens) for tokens in context_tokens) > cache_size:
+            raise ValueError(
+                "context_length is bigger than the sliding window and sink tokens"
+            )
 
-    # convert to tensor and broadcast
-    context_tokens = torch.cuda.LongTensor(context_tokens)
+    device = next(model.module.parameters()).device
+    context_tokens, token_generation_start_index = broadcast_context_tokens(
+        neox_args,
+        context_tokens,
+        maximum_tokens,
+        device=device,
+        max_length=None
+        if sliding_window is None
+        else max(len(tokens) for tokens in context_tokens) + maximum_tokens,
+    )
     if stop_tokens:
         if len(stop_tokens) > 0 and type(stop_tokens[0]) is not list:
             stop_tokens = [stop_tokens]
-        for i in range(0, len(stop_tokens)):
-            stop_tokens[i] = torch.cuda.LongTensor(stop_tokens[i])
-
-    # Make sure context tokens + start tokens are the same across all ranks
-    token_generation_start_index = torch.cuda.LongTensor(context_lengths)
-    torch.distributed.broadcast(
-        context_tokens,
-        mpu.get_model_parallel_src_rank(),
-        group=mpu.get_model_parallel_group(),
-    )
-    torch.distributed.broadcast(
-        token_generation_start_index,
-        mpu.get_model_parallel_src_rank(),
-        group=mpu.get_model_parallel_group(),
-    )
+        stop_tokens = pad_stop_tokens(stop_tokens).to(device)
 
     # get attention mask / position ids
-    context_tokens, attention_mask, position_ids = get_batch(neox_args, context_tokens)
+    if sliding_window is None:
+        context_tokens, attention_mask, position_ids = get_batch(
+            neox_args, context_tokens
+        )
+    else:
+        # the model only ever attends over the cache, so the mask only needs to cover its positions. The position ids
+        # (token indices) are not read by relative position embeddings, which take the positions from the cache.
+        _, attention_mask, _ = get_batch(neox_args, context_tokens[:, :cache_size])
+        position_ids = torch.arange(
+            context_tokens.size(1), device=context_tokens.device
+        ).expand_as(context_tokens)
 
     # set variables
     eos_token_id = eos_token_id or neox_args.tokenizer.eod
@@ -273,28 +538,107 @@ def stream_tokens(
         - 1,  # never generate more than the model's sequence length
         token_index_to_generate + maximum_tokens - 1,
     )
+    if sliding_window is not None:
+        # generation is only bounded by maximum_tokens
+        last_token_index_to_generate = min(
+            context_tokens.size(1) - 1, token_index_to_generate + maximum_tokens - 1
+        )
+        # number of positions in the kv cache, and evicted at a time once it is full
+        cache_len = 0
+        num_evicted = max(1, sliding_window // 8)
 
     with torch.no_grad():
         # initialize generation variables
-        state_is_done = torch.zeros([batch_size]).byte().cuda()
-        token_generation_end_index = torch.ones([batch_size]).long().cuda() * (-1)
+        state_is_done = torch.zeros([batch_size], dtype=torch.uint8, device=device)
+        token_generation_end_index = torch.full(
+            [batch_size], -1, dtype=torch.long, device=device
+        )
+
+        penalties = None
+        if repetition_penalty != 1.0 or presence_penalty != 0.0:
+            penalties = TokenPenalties(
+                batch_size,
+                neox_args.padded_vocab_size,
+                repetition_penalty=repetition_penalty,
+                presence_penalty=presence_penalty,
+                device=context_tokens.device,
+            )
+            # count the (unpadded) context tokens
+            penalties.update(
+                context_tokens,
+                mask=position_ids < token_generation_start_index.unsqueeze(1),
+            )
+
+        if proposer is not None:
+            assert (
+                not recompute and not neox_args.is_pipe_parallel and penalties is None
+            ), "speculative decoding needs the kv cache, and supports neither pipeline parallelism nor penalties"
+            assert (
+                not neox_args.vocab_parallel_sampling
+            ), "speculative decoding needs the gathered logits"
+            proposer.reset()
+        speculative_tokens = []
+
+        assert compact_threshold is None or 0 < compact_threshold <= 1
+        # once finished batch items are dropped: the original batch row of every remaining batch item, and the
+        # yielded (tokens, start index, end index, is done) of the original batch
+        rows, full_batch = None, None
 
         while token_index_to_generate <= last_token_index_to_generate:
-            if recompute:  # recompute all tokens
-                model_inputs = (
+            num_proposals = min(
+                num_speculative_tokens,
+                last_token_index_to_generate - token_index_to_generate,
+            )
+            if speculative_tokens:
+                # generated by the last speculative decoding step
+                generated_tokens = speculative_tokens.pop(0)
+                logits = None
+            elif (
+                proposer is not None
+                and token_index_to_generate > first_token_index_to_generate
+                and num_proposals > 0
+            ):
+                speculative_tokens = speculative_decoding_step(
+                    model,
+                    proposer,
                     context_tokens,
                     position_ids,
                     attention_mask,
+                    token_index_to_generate,
+                    token_generation_start_index,
+                    state_is_done,
+                    num_proposals,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                )
+                generated_tokens = speculative_tokens.pop(0)
+                logits = None  # the tokens are already sampled
+            elif recompute:  # recompute all tokens up to the one to be generated
+                model_inputs = (
+                    context_tokens[:, :token_index_to_generate],
+                    position_ids[:, :token_index_to_generate],
+                    attention_mask[
+                        ..., :token_index_to_generate, :token_index_to_generate
+                    ],
                 )
                 logits = forward_model(model, model_inputs, neox_args.is_pipe_parallel)
                 if logits is not None:  # if pipe parallel, not all ranks return logits
                     generated_token_logits = logits[
-                        :, token_index_to_generate - 1, :
+                        :, -1, :
                     ]  # [bs, seq, vocab_size] -> [bs, vocab_size]
             else:  # use kv cache
                 if token_index_to_generate == first_token_index_to_generate:
-                    tokens_to_use = context_tokens[:, :token_index_to_generate]
-                    positions_to_use = position_ids[:, :token_index_to_generate]
+                    # prefill the prompts, or only the part of them after a prefix restored from the prompt cache
+                    restored = 0
+                    if prompt_cache is not None:
+                        restored = restore_prompt_prefix(
+                            prompt_cache,
+                            model,
+                            context_tokens[:, :token_index_to_generate],
+                        )
+                    tokens_to_use = context_tokens[:, restored:token_index_to_generate]
+                    positions_to_use = position_ids[:, restored:token_index_to_generate]
                 else:
                     tokens_to_use = context_tokens[:, token_index_to_generate - 1].view(
                         batch_size, -1
@@ -302,6 +646,16 @@ def stream_tokens(
                     positions_to_use = position_ids[
                         :, token_index_to_generate - 1
                     ].view(batch_size, -1)
+                    if sliding_window is not None and cache_len == cache_size:
+                        model.module.evict_cache(num_sink_tokens, num_evicted)
+                        cache_len -= num_evicted
+                if sliding_window is not None:
+                    # the prefill fills the cache up to the shortest prompt, every decoding step adds one position
+                    cache_len = (
+                        token_index_to_generate
+                        if token_index_to_generate == first_token_index_to_generate
+                        else cache_len + 1
+                    )
 
                 model_inputs = (
                     tokens_to_use,  # input_ids
@@ -314,24 +668,47 @@ def stream_tokens(
                     generated_token_logits = (
                         logits[:, -1].view(batch_size, -1).contiguous()
                     )  # [bs, seq, vocab_size] -> [bs, vocab_size]
+                if (
+                    prompt_cache is not None
+                    and token_index_to_generate == first_token_index_to_generate
+                ):
+                    store_prompt_prefix(
+                        prompt_cache,
+                        model,
+                        context_tokens[:, :token_index_to_generate],
+                    )
 
             if logits is not None:
+                # with inference_mode(parallel_output=True), every model parallel rank holds a slice of the vocab
+                vocab_parallel = (
+                    generated_token_logits.size(-1) != neox_args.padded_vocab_size
+                )
+                vocab_start_index = (
+                    mpu.get_model_parallel_rank() * generated_token_logits.size(-1)
+                    if vocab_parallel
+                    else 0
+                )
+                if penalties is not None:
+                    generated_token_logits = penalties(
+                        generated_token_logits, vocab_start_index
+                    )
                 # sample token id of the to be generated token
-                if temperature == 0.0 and top_k == 0 and top_p == 0.0:
-                    generated_tokens = torch.argmax(
-                        generated_token_logits, dim=-1
-                    ).view(-1)
+                if vocab_parallel:
+                    generated_tokens = sample_tokens_vocab_parallel(
+                        generated_token_logits,
+                        vocab_start_index,
+                        group=mpu.get_model_parallel_group(),
+                        temperature=temperature,
+                        top_k=top_k,
+                        top_p=top_p,
+                    )
                 else:
-                    generated_token_logits = generated_token_logits.float()
-                    if temperature > 0.0:
-                        generated_token_logits /= temperature
-                    generated_token_logits = filter_logits(
-                        generated_token_logits, top_k=top_k, top_p=top_p
+                    generated_tokens = sample_tokens(
+                        generated_token_logits,
+                        temperature=temperature,
+                        top_k=top_k,
+                        top_p=top_p,
                     )
-                    next_token_log_probs = F.softmax(generated_token_logits, dim=-1)
-                    generated_tokens = torch.multinomial(
-                        next_token_log_probs, num_samples=1
-                    ).view(-1)
 
             if neox_args.is_pipe_parallel:
                 # broadcast generated tokens to pipe parallel group
@@ -339,7 +716,7 @@ def stream_tokens(
                 generated_tokens = (
                     generated_tokens
                     if logits is not None
-                    else torch.zeros(batch_size, dtype=torch.long).cuda()
+                    else torch.zeros(batch_size, dtype=torch.long, device=device)
                 )
                 torch.distributed.broadcast(
                     tensor=generated_tokens,
@@ -358,6 +735,8 @@ def stream_tokens(
                 generated_tokens,
                 state_started,
             )
+            if penalties is not None:
+                penalties.update(generated_tokens, mask=state_started)
 
             # determine if state has finished for each batch item
             state_done = (
@@ -365,11 +744,13 @@ def stream_tokens(
             ).byte() & state_started.byte()  # check which batch items produce an eos_token in the current iteration
             state_just_finished = (state_done & ~state_is_done).bool()
             state_is_done = state_is_done | state_done
-            stop_tokens_produced = torch.zeros_like(state_is_done)
-            for batch_idx, ctx in enumerate(context_tokens):
-                stop_tokens_produced[batch_idx] = stop_tokens_in_completion(
-                    stop_tokens, context_tokens, batch_idx, token_index_to_generate
-                )
+            # only batch items that have started generating can produce a stop sequence
+            stop_tokens_produced = (
+                stop_tokens_in_completion(
+                    stop_tokens, context_tokens, token_index_to_generate
+                ).byte()
+                & state_started.byte()
+            )
             state_is_done = state_is_done | stop_tokens_produced
 
             token_generation_end_index[
@@ -378,10 +759,344 @@ def stream_tokens(
 
             token_index_to_generate += 1
 
-            yield context_tokens, token_generation_start_index, token_generation_end_index, state_is_done.bool()
+            if full_batch is None:
+                yield context_tokens, token_generation_start_index, token_generation_end_index, state_is_done.bool()
+            else:
+                # write the remaining batch items back to their original rows
+                full_tokens, full_start_index, full_end_index, full_is_done = full_batch
+                full_tokens[rows, token_index_to_generate - 1] = context_tokens[
+                    :, token_index_to_generate - 1
+                ]
+                full_end_index[rows] = token_generation_end_index
+                full_is_done[rows] = state_is_done
+                yield full_tokens, full_start_index, full_end_index, full_is_done.bool()
             if torch.all(state_is_done):
                 break
 
+            # drop finished batch items (all ranks agree on state_is_done, as they do on the generated tokens); not
+            # while tokens generated for the whole batch by speculative decoding are pending
+            if compact_threshold is not None and not speculative_tokens:
+                num_done = state_is_done.sum().item()
+                if num_done > 0 and num_done >= compact_threshold * batch_size:
+                    if full_batch is None:
+                        rows = torch.arange(batch_size, device=context_tokens.device)
+                        full_batch = (
+                            context_tokens.clone(),
+                            token_generation_start_index,
+                            token_generation_end_index.clone(),
+                            state_is_done.clone(),
+                        )
+                    keep = (state_is_done == 0).nonzero().view(-1)
+                    rows = rows[keep]
+                    context_tokens = context_tokens[keep]
+                    position_ids = position_ids[keep]
+                    if attention_mask.size(0) > 1:
+                        attention_mask = attention_mask[keep]
+                    token_generation_start_index = token_generation_start_index[keep]
+                    token_generation_end_index = token_generation_end_index[keep]
+                    state_is_done = state_is_done[keep]
+                    if not recompute:
+                        model.module.select_cache_rows(keep)
+                    if penalties is not None:
+                        penalties.select_rows(keep)
+                    if proposer is not None:
+                        proposer.select_rows(keep)
+                    batch_size = keep.numel()
+
+
+def stream_generated_tokens(
+    neox_args, model, context_tokens: List[List[int]], **kwargs
+):
+    """
+    iterator producing only the tokens generated at each step of stream_tokens, rather than the whole batch of tokens.
+
+    Only the new token and done flag of every batch item are copied to the cpu at each step, so the cost per step does
+    not grow with the length of the completion. Use an incremental detokenizer
+    (`neox_args.tokenizer.incremental_detokenizer()`) to turn the tokens into text as they are generated.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model.
+    context_tokens: the prompt to complete; unpadded list of lists of tokens ids
+    kwargs: generation parameters (eos_token_id, maximum_tokens, recompute, temperature, ...), see stream_tokens
+
+    yields: (
+                new_tokens (list with a list of newly generated token ids per batch item; empty if the batch item has
+                            not started generating yet, or is done),
+                is_done (list with a flag per batch item indicating whether an eod token or stop sequence was generated)
+            )
+    """
+    last_end_index = None
+    for tokens, _, end_index, is_done in stream_tokens(
+        neox_args=neox_args, model=model, context_tokens=context_tokens, **kwargs
+    ):
+        if last_end_index is None:
+            last_end_index = torch.full_like(end_index, -1)
+        # at most one token per batch item is generated per step, at end_index
+        has_new_token = end_index > last_end_index
+        new_token = tokens.gather(1, end_index.clamp(min=0).unsqueeze(1)).view(-1)
+        last_end_index = end_index.clone()
+
+        new_token, has_new_token, is_done = (
+            t.cpu().tolist() for t in (new_token, has_new_token, is_done)
+        )
+        yield [[t] if new else [] for t, new in zip(new_token, has_new_token)], is_done
+
+
+def beam_search(
+    neox_args,
+    model,
+    context_tokens: List[List[int]],
+    num_beams: int,
+    eos_token_id: int = None,
+    maximum_tokens: int = None,
+    length_penalty: float = 1.0,
+    early_stopping: bool = True,
+    stop_tokens=None,
+    num_return_sequences: int = 1,
+):
+    """
+    Batched beam search: the num_beams beams of every prompt are extra batch rows, and each step reorders the kv cache
+    of every layer with a single index_select (see select_cache_rows) rather than forwarding the beams again.
+
+    Each step scores the 2 * num_beams best continuations of every prompt at once. Continuations ending in
+    eos_token_id or a stop sequence among the best num_beams become finished hypotheses, the best num_beams others
+    continue as the beams. Hypotheses are ranked by their log probability divided by
+    (number of generated tokens) ** length_penalty.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model in `inference_mode(use_cache=True)`.
+    context_tokens: the prompts to complete; unpadded list of lists of token ids
+    num_beams: number of beams per prompt
+    eos_token_id: end of text token at which a hypothesis is finished
+    maximum_tokens: maximum number of tokens to be generated per prompt
+    length_penalty (default 1.0): float -> exponent of the length normalization; > 0.0 favours longer hypotheses,
+                                  0.0 ranks them by their log probability
+    early_stopping (default True): stop a prompt once it has num_beams finished hypotheses; False also waits until
+                                   no beam can improve on the finished hypotheses at its current length
+    stop_tokens (optional): stop sequences finishing a hypothesis, see stream_tokens
+    num_return_sequences (default 1): number of hypotheses returned per prompt, at most num_beams
+
+    returns: tuple of torch tensors (
+                tokens [batch, num_return_sequences, pad_len] (prompts and completions),
+                token_generation_start_index [batch] (token index of the first generated token),
+                token_generation_end_index [batch, num_return_sequences] (token index of the last generated token, not
+                                                                          counting eos_token_id / the stop sequence),
+                is_done [batch, num_return_sequences] (whether the hypothesis ended in eos_token_id or a stop sequence),
+                scores [batch, num_return_sequences] (length normalized log probabilities, best first)
+            )
+    """
+    assert (
+        not neox_args.is_pipe_parallel and not neox_args.vocab_parallel_sampling
+    ), "beam search supports neither pipeline parallelism nor vocab-parallel sampling"
+    assert 1 <= num_return_sequences <= num_beams
+    model.eval()
+
+    device = next(model.module.parameters()).device
+    context_tokens, token_generation_start_index = broadcast_context_tokens(
+        neox_args, context_tokens, maximum_tokens, device=device
+    )
+    attention_mask, _, position_ids = get_ltor_masks_and_position_ids(
+        data=context_tokens,
+        eod_token=neox_args.tokenizer.eod,
+        eod_mask_loss=neox_args.eod_mask_loss,
+    )
+    if stop_tokens:
+        if len(stop_tokens) > 0 and type(stop_tokens[0]) is not list:
+            stop_tokens = [stop_tokens]
+        stop_tokens = pad_stop_tokens(stop_tokens).to(device)
+
+    eos_token_id = eos_token_id or neox_args.tokenizer.eod
+    batch_size, pad_len = context_tokens.shape
+    maximum_tokens = maximum_tokens or (
+        neox_args.seq_length - token_generation_start_index.max().item() - 1
+    )
+    token_index_to_generate = token_generation_start_index.min().item()
+    first_token_index_to_generate = token_index_to_generate
+    last_token_index_to_generate = min(neox_args.seq_length, pad_len) - 1
+
+    batch_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * num_beams
+    beam_range = torch.arange(num_beams, device=device).expand(batch_size, -1)
+    candidate_rank = torch.arange(2 * num_beams, device=device)
+    # the num_beams best finished hypotheses of every prompt, -inf where there are fewer
+    finished_scores = torch.full((batch_size, num_beams), -float("Inf"), device=device)
+    finished_tokens = context_tokens.unsqueeze(1).repeat(1, num_beams, 1)
+    finished_end_index = torch.full_like(finished_scores, -1, dtype=torch.long)
+    finished_is_done = torch.zeros_like(finished_scores, dtype=torch.bool)
+    prompt_is_done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def add_hypotheses(is_new, scores, tokens, end_index, is_done):
+        # keeps the num_beams best of the finished and new ([batch, n]) hypotheses of every prompt
+        nonlocal finished_scores, finished_tokens, finished_end_index, finished_is_done
+        scores = torch.cat(
+            (finished_scores, scores.masked_fill(~is_new, -float("Inf"))), dim=1
+        )
+        finished_scores, best = torch.topk(scores, num_beams, dim=1)
+        finished_tokens = torch.cat((finished_tokens, tokens), dim=1).gather(
+            1, best.unsqueeze(-1).expand(-1, -1, pad_len)
+        )
+        finished_end_index = torch.cat(
+            (finished_end_index, end_index.expand_as(is_new)), dim=1
+        ).gather(1, best)
+        finished_is_done = torch.cat(
+            (finished_is_done, torch.full_like(is_new, is_done)), dim=1
+        ).gather(1, best)
+
+    def add_beams(mask):
+        # adds the current beams of the prompts in mask ([batch]) as hypotheses ending at the last generated token
+        num_generated = token_index_to_generate - token_generation_start_index + 1
+        add_hypotheses(
+            mask.unsqueeze(1) & (beam_scores > -float("Inf")),
+            beam_scores
+            / num_generated.clamp(min=1).float().unsqueeze(1) ** length_penalty,
+            context_tokens.view(batch_size, num_beams, pad_len),
+            torch.full_like(beam_scores, token_index_to_generate, dtype=torch.long),
+            False,
+        )
+
+    with torch.no_grad():
+        # prefill every prompt once, then copy its kv cache to its beams
+        model.module.clear_cache()
+        logits = forward_model(
+            model,
+            (
+                context_tokens[:, :token_index_to_generate],
+                position_ids[:, :token_index_to_generate],
+                attention_mask,
+            ),
+        )
+        beam_rows = torch.arange(batch_size, device=device).repeat_interleave(num_beams)
+        model.module.select_cache_rows(beam_rows)
+        context_tokens = context_tokens[beam_rows]
+        position_ids = position_ids[beam_rows]
+        log_probs = F.log_softmax(logits[:, -1].float(), dim=-1)[beam_rows]
+        vocab_size = log_probs.size(-1)
+        # the beams of a prompt start out identical, so only the first one is expanded
+        beam_scores = torch.zeros(batch_size, num_beams, device=device)
+        beam_scores[:, 1:] = -float("Inf")
+
+        while token_index_to_generate <= last_token_index_to_generate:
+            if token_index_to_generate > first_token_index_to_generate:
+                logits = forward_model(
+                    model,
+                    (
+                        context_tokens[
+                            :, token_index_to_generate - 1 : token_index_to_generate
+                        ],
+                        position_ids[
+                            :, token_index_to_generate - 1 : token_index_to_generate
+                        ],
+                        attention_mask,
+                    ),
+                )
+                log_probs = F.log_softmax(logits[:, -1].float(), dim=-1)
+
+            # the 2 * num_beams best continuations of every prompt, over all its beams at once: [batch, 2 * num_beams]
+            candidate_scores, candidates = torch.topk(
+                (beam_scores.view(-1, 1) + log_probs).view(batch_size, -1),
+                2 * num_beams,
+                dim=1,
+            )
+            candidate_beams = torch.div(candidates, vocab_size, rounding_mode="floor")
+            candidate_tokens = candidates % vocab_size
+            candidate_rows = batch_offsets + candidate_beams
+
+            is_finished = candidate_tokens == eos_token_id
+            if stop_tokens is not None and stop_tokens.numel() > 0:
+                window_start = max(token_index_to_generate + 1 - stop_tokens.size(1), 0)
+                window = torch.cat(
+                    (
+                        context_tokens[
+                            candidate_rows.view(-1),
+                            window_start:token_index_to_generate,
+                        ],
+                        candidate_tokens.view(-1, 1),
+                    ),
+                    dim=1,
+                )
+                is_finished |= stop_tokens_in_completion(
+                    stop_tokens, window, window.size(1) - 1
+                ).view(batch_size, -1)
+
+            # prompts still reading their context, and finished prompts, keep their beams as they are
+            is_active = (
+                token_generation_start_index <= token_index_to_generate
+            ) & ~prompt_is_done
+
+            # finished hypotheses among the best num_beams continuations
+            is_new = is_finished & (candidate_rank < num_beams)
+            is_new &= is_active.unsqueeze(1)
+            if is_new.any():
+                num_generated = token_index_to_generate - token_generation_start_index
+                add_hypotheses(
+                    is_new,
+                    candidate_scores
+                    / (num_generated + 1).float().unsqueeze(1) ** length_penalty,
+                    context_tokens[candidate_rows.view(-1)].view(
+                        batch_size, -1, pad_len
+                    ),
+                    (token_index_to_generate - 1) + torch.zeros_like(candidates),
+                    True,
+                )
+
+            # the best num_beams continuations that didn't finish are the next beams
+            next_scores, next_candidates = torch.topk(
+                candidate_scores.masked_fill(is_finished, -float("Inf")),
+                num_beams,
+                dim=1,
+            )
+            next_beams = torch.where(
+                is_active.unsqueeze(1),
+                candidate_beams.gather(1, next_candidates),
+                beam_range,
+            )
+            beam_scores = torch.where(is_active.unsqueeze(1), next_scores, beam_scores)
+            beam_index = (batch_offsets + next_beams).view(-1)
+
+            context_tokens = context_tokens.index_select(0, beam_index)
+            context_tokens[:, token_index_to_generate] = torch.where(
+                is_active.repeat_interleave(num_beams),
+                candidate_tokens.gather(1, next_candidates).view(-1),
+                context_tokens[:, token_index_to_generate],
+            )
+            model.module.select_cache_rows(beam_index)
+
+            # prompts at their maximum length finish with their beams
+            num_generated = token_index_to_generate - token_generation_start_index + 1
+            at_maximum = is_active & (num_generated >= maximum_tokens)
+            num_finished = (finished_scores > -float("Inf")).sum(dim=1)
+            if early_stopping:
+                can_stop = num_finished >= num_beams
+            else:
+                best_score = (
+                    beam_scores.max(dim=1).values
+                    / num_generated.clamp(min=1).float() ** length_penalty
+                )
+                can_stop = (num_finished >= num_beams) & (
+                    finished_scores[:, -1] >= best_score
+                )
+            can_stop |= torch.all(beam_scores == -float("Inf"), dim=1)
+            at_maximum &= ~can_stop
+            if at_maximum.any():
+                add_beams(at_maximum)
+            prompt_is_done |= is_active & (at_maximum | can_stop)
+
+            if torch.all(prompt_is_done):
+                break
+            token_index_to_generate += 1
+        else:
+            # out of sequence length
+            token_index_to_generate -= 1
+            add_beams(~prompt_is_done)
+
+    model.module.clear_cache()
+    return (
+        finished_tokens[:, :num_return_sequences],
+        token_generation_start_index,
+        finished_end_index[:, :num_return_sequences],
+        finished_is_done[:, :num_return_sequences],
+        finished_scores[:, :num_return_sequences],
+    )
+
 
 def generate_samples_from_prompt(
     neox_args,
@@ -394,6 +1109,15 @@ def generate_samples_from_prompt(
     top_k: int = 0,
     top_p: float = 0.0,
     stop_tokens=None,
+    batch_size: int = 1,
+    repetition_penalty: float = 1.0,
+    presence_penalty: float = 0.0,
+    proposer=None,
+    num_speculative_tokens: int = 4,
+    num_beams: int = 1,
+    length_penalty: float = 1.0,
+    early_stopping: bool = True,
+    on_batch_done=None,
 ):
     """
     Generates samples from raw text and returns them in a dictionary.
@@ -411,6 +1135,20 @@ def generate_samples_from_prompt(
     top_k (default 0): integer -> integer between 0 and the models vocab size. Filters out any logits with a probability less than that of the top_kth token.
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
+    repetition_penalty (default 1.0): float -> divides positive (multiplies negative) logits of tokens already in the context or completion; 1.0 disables it.
+    presence_penalty (default 0.0): float -> subtracted from the logits of tokens already in the context or completion; 0.0 disables it.
+    proposer (optional): SpeculativeProposer -> speculative decoding, see stream_tokens
+    num_speculative_tokens (default 4): number of tokens proposed per forward pass of the model with speculative decoding
+    num_beams (default 1): completes each prompt with beam search over this many beams if > 1, rather than sampling;
+                           see beam_search. Ignores temperature / top_k / top_p, the penalties and the proposer.
+    length_penalty (default 1.0): exponent of the length normalization of the beams' scores, see beam_search
+    early_stopping (default True): stop beam search once num_beams hypotheses are finished, see beam_search
+
+    batch_size (default 1): number of prompts completed together in one call to stream_tokens. Prompts are sorted by token
+                            length before batching so that batch items start generating at similar positions.
+                            Results are returned in the order of `text`.
+    on_batch_done (optional): function called on model parallel rank 0 with the indices in `text` and the dicts (see
+                              returns) of the prompts of every batch as soon as the batch is done, e.g. to write them
 
     returns: List[dict] -> a list of dicts containing the following fields:
         - 'context' (the input)
@@ -418,10 +1156,17 @@ def generate_samples_from_prompt(
         - 'length' (the length of the completion in number of tokens)
         - 'finished':
         - 'message': a messaged associated with the generation procedure, can be a warning or error
-        - 'duration_seconds': duration of the generation in seconds
+        - 'duration_seconds': duration of the generation in seconds (of the batch the prompt was generated in)
+        - 'prompt_cache' (only with neox_args.prompt_cache_size_mb > 0): the hit / miss counters of the prompt cache
+                         after the batch the prompt was generated in, see PromptCache.stats
+        - 'speculative_decoding' (only with a proposer): the acceptance rate of the proposals and the tokens generated per
+                                 forward pass of the model so far, see SpeculativeProposer.stats
+        - 'beam_score' (only with num_beams > 1): the length normalized log probability of the completion
 
     """
     eos_token_id = eos_token_id or neox_args.tokenizer.eod
+    # prompts sharing a prefix with previous prompts (e.g. a few-shot preamble) only prefill the rest
+    prompt_cache = None if recompute else get_prompt_cache(neox_args, model)
 
     # type check
     assert any(
@@ -429,64 +1174,122 @@ def generate_samples_from_prompt(
     ), "Text should be in string or list form"
     if isinstance(text, str):
         text = [text]
+    assert batch_size > 0, "batch_size must be > 0"
+    assert num_beams == 1 or not recompute, "beam search needs the kv cache"
+
+    # tokenize on all ranks, so that all ranks agree on the batches and the number of generation steps
+    all_context_tokens = []
+    for raw_text in text:
+        if raw_text == "":
+            context_tokens = [eos_token_id]
+        else:
+            context_tokens = neox_args.tokenizer.tokenize(raw_text)
+        context_length = len(context_tokens)
+
+        if context_length >= (neox_args.seq_length // 2):
+            print_rank_0(
+                "\nWarning! Context length",
+                context_length,
+                "\nPlease give smaller context (e.g. half of the "
+                "max sequence length)!",
+            )
+        all_context_tokens.append(context_tokens)
 
-    input_count = len(text)
-    input_pos = 0
+    # group prompts of similar length into batches
+    sorted_indices = sorted(
+        range(len(text)), key=lambda idx: len(all_context_tokens[idx])
+    )
+    batches = [
+        sorted_indices[i : i + batch_size]
+        for i in range(0, len(sorted_indices), batch_size)
+    ]
+    batch_pos = 0
 
     # generate completions
-    generated_texts = []
+    generated_texts = [None] * len(text)
+    generation_start_time = time.time()
     while True:
         model.module.clear_cache()  # clear kv cache between batches
 
         start_time = time.time()
-        # Tokenize text, and check whether we should terminate process
+        # check whether we should terminate process
         terminate_runs = 0
-        if input_pos == input_count:
+        if batch_pos == len(batches):
             terminate_runs = 1
         else:
-            raw_text = text[input_pos]
-            input_pos += 1
+            batch_indices = batches[batch_pos]
+            batch_pos += 1
 
-            if raw_text == "":
-                context_tokens = [eos_token_id]
-            else:
-                context_tokens = neox_args.tokenizer.tokenize(raw_text)
-            context_length = len(context_tokens)
-
-            if context_length >= (neox_args.seq_length // 2):
+        terminate_runs = broadcast_terminate_signal(
+            terminate_runs, device=next(model.module.parameters()).device
+        )
+        if terminate_runs == 1:
+            if is_mp_rank_0():
+                seconds = time.time() - generation_start_time
+                num_tokens = sum(data["length"] for data in generated_texts)
                 print_rank_0(
-                    "\nWarning! Context length",
-                    context_length,
-                    "\nPlease give smaller context (e.g. half of the "
-                    "max sequence length)!",
+                    f"Generated {num_tokens} tokens for {len(text)} prompts in {seconds:.2f} seconds "
+                    f"({num_tokens / max(seconds, 1e-9):.1f} tokens/sec)"
                 )
-        if not is_mp_rank_0():
-            context_tokens = neox_args.tokenizer.tokenize("EMPTY TEXT")
-            context_length = len(context_tokens)
-            terminate_runs = 0
-
-        terminate_runs = broadcast_terminate_signal(terminate_runs)
-        if terminate_runs == 1:
-            return generated_texts
-
-        for (
-            batch_context_tokens,
-            batch_token_generation_start_index,
-            batch_token_generation_end_index,
-            is_done,
-        ) in stream_tokens(
-            neox_args=neox_args,
-            model=model,
-            context_tokens=[context_tokens],
-            eos_token_id=eos_token_id,
-            maximum_tokens=maximum_tokens,
-            recompute=recompute,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-            stop_tokens=stop_tokens,
-        ):
-            pass  # finish generation and use all results below
+            return generated_texts if is_mp_rank_0() else []
+
+        context_lengths = [len(all_context_tokens[idx]) for idx in batch_indices]
+        # stream_tokens counts maximum_tokens from the shortest context in the batch;
+        # extend it so that every batch item can generate maximum_tokens of its own
+        batch_maximum_tokens = maximum_tokens
+        if maximum_tokens is not None:
+            batch_maximum_tokens += max(context_lengths) - min(context_lengths)
+
+        if num_beams > 1:
+            (
+                batch_context_tokens,
+                batch_token_generation_start_index,
+                batch_token_generation_end_index,
+                is_done,
+                beam_scores,
+            ) = beam_search(
+                neox_args=neox_args,
+                model=model,
+                context_tokens=[all_context_tokens[idx] for idx in batch_indices],
+                num_beams=num_beams,
+                eos_token_id=eos_token_id,
+                maximum_tokens=maximum_tokens,
+                length_penalty=length_penalty,
+                early_stopping=early_stopping,
+                stop_tokens=stop_tokens,
+            )
+            # the best hypothesis of every prompt
+            batch_context_tokens = batch_context_tokens[:, 0]
+            batch_token_generation_end_index = batch_token_generation_end_index[:, 0]
+            is_done = is_done[:, 0]
+            beam_scores = dict(zip(batch_indices, beam_scores[:, 0].tolist()))
+        else:
+            for (
+                batch_context_tokens,
+                batch_token_generation_start_index,
+                batch_token_generation_end_index,
+                is_done,
+            ) in stream_tokens(
+                neox_args=neox_args,
+                model=model,
+                context_tokens=[all_context_tokens[idx] for idx in batch_indices],
+                eos_token_id=eos_token_id,
+                maximum_tokens=batch_maximum_tokens,
+                recompute=recompute,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                stop_tokens=stop_tokens,
+                repetition_penalty=repetition_penalty,
+                presence_penalty=presence_penalty,
+                prompt_cache=prompt_cache,
+                proposer=proposer,
+                num_speculative_tokens=num_speculative_tokens,
+                compact_threshold=neox_args.compact_finished_threshold,
+                sliding_window=neox_args.sliding_window_tokens,
+                num_sink_tokens=neox_args.sliding_window_sink_tokens,
+            ):
+                pass  # finish generation and use all results below
 
         batch_context_tokens = batch_context_tokens.cpu().numpy().tolist()
         batch_token_generation_start_index = (
@@ -497,12 +1300,20 @@ def generate_samples_from_prompt(
         )
         batch_is_done = is_done.cpu().numpy().tolist()
 
-        for tokens, start_index, end_index, is_done in zip(
+        for idx, tokens, start_index, end_index, is_done in zip(
+            batch_indices,
             batch_context_tokens,
             batch_token_generation_start_index,
             batch_token_generation_end_index,
             batch_is_done,
         ):
+            if (
+                maximum_tokens is not None
+                and end_index - start_index + 1 >= maximum_tokens
+            ):
+                # shorter batch items start generating earlier and may run past maximum_tokens while longer ones catch up
+                end_index = start_index + maximum_tokens - 1
+                is_done = False
 
             if end_index >= start_index:
                 generated_tokens = tokens[start_index : end_index + 1]
@@ -519,16 +1330,24 @@ def generate_samples_from_prompt(
                 message = "WARNING: text generation did not start; try different batching or adjust parameters"
             if is_mp_rank_0():
                 data = {
-                    "context": raw_text,
+                    "context": text[idx],
                     "text": generated_text,
                     "length": len(generated_tokens),
                     "finished": is_done,
                     "message": message,
                     "duration_seconds": float(time.time() - start_time),
                 }
-                generated_texts.append(data)
-
-    return generated_texts
+                if prompt_cache is not None:
+                    data["prompt_cache"] = prompt_cache.stats
+                if proposer is not None:
+                    data["speculative_decoding"] = proposer.stats
+                if num_beams > 1:
+                    data["beam_score"] = beam_scores[idx]
+                generated_texts[idx] = data
+        if on_batch_done is not None and is_mp_rank_0():
+            on_batch_done(
+                batch_indices, [generated_texts[idx] for idx in batch_indices]
+            )
 
 
 def generate_samples_input_from_file(
@@ -542,6 +1361,15 @@ def generate_samples_input_from_file(
     temperature: float = 0.0,
     top_k: int = 0,
     top_p: float = 0.0,
+    batch_size: int = 1,
+    repetition_penalty: float = 1.0,
+    presence_penalty: float = 0.0,
+    proposer=None,
+    num_speculative_tokens: int = 4,
+    num_beams: int = 1,
+    length_penalty: float = 1.0,
+    early_stopping: bool = True,
+    shard_across_data_parallel: bool = False,
 ):
     """
     Generates samples from an input file and writes them to an output file.
@@ -564,7 +1392,16 @@ def generate_samples_input_from_file(
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
 
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
+    repetition_penalty (default 1.0): float -> divides positive (multiplies negative) logits of tokens already in the context or completion; 1.0 disables it.
+    presence_penalty (default 0.0): float -> subtracted from the logits of tokens already in the context or completion; 0.0 disables it.
+    proposer / num_speculative_tokens (optional): speculative decoding, see generate_samples_from_prompt
+    num_beams / length_penalty / early_stopping (optional): beam search, see generate_samples_from_prompt
 
+    batch_size (default 1): number of prompts completed together, see generate_samples_from_prompt
+
+    shard_across_data_parallel (default False): splits the prompts across the data parallel groups, which stream their
+                                                completions to shards of output_file and skip the prompts already
+                                                completed there, see generate_samples_sharded
 
     returns: List[dict] -> a list of dicts containing the following fields:
         - 'context' (the input)
@@ -573,6 +1410,7 @@ def generate_samples_input_from_file(
         - 'finished':
         - 'message': a messaged associated with the generation procedure, can be a warning or error
         - 'duration_seconds': duration of the generation in seconds
+        - 'prompt_id' (only with shard_across_data_parallel): the index of the prompt among the input file's prompts
     """
     # Read the sample file
     print_rank_0(
@@ -586,16 +1424,39 @@ def generate_samples_input_from_file(
         "generate_samples_input_from_file() prompts loaded: {}".format(len(prompts))
     )
 
-    if is_mp_rank_0():
-        if output_file is None:
-            output_file = str(input_file) + ".output.jsonl"
-            print_rank_0(
-                "generate_samples_input_from_file() setting default output file to {}".format(
-                    output_file
-                )
+    if output_file is None:
+        output_file = str(input_file) + ".output.jsonl"
+        print_rank_0(
+            "generate_samples_input_from_file() setting default output file to {}".format(
+                output_file
             )
+        )
 
     print_rank_0("generate_samples_input_from_file() generating...")
+    if shard_across_data_parallel:
+        generated_texts = generate_samples_sharded(
+            neox_args=neox_args,
+            model=model,
+            prompts=prompts,
+            output_file=output_file,
+            eos_token_id=eos_token_id,
+            maximum_tokens=maximum_tokens,
+            recompute=recompute,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            batch_size=batch_size,
+            repetition_penalty=repetition_penalty,
+            presence_penalty=presence_penalty,
+            proposer=proposer,
+            num_speculative_tokens=num_speculative_tokens,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            early_stopping=early_stopping,
+        )
+        print_rank_0("generate_samples_input_from_file() done")
+        return generated_texts
+
     generated_texts = generate_samples_from_prompt(
         neox_args=neox_args,
         model=model,
@@ -606,6 +1467,14 @@ def generate_samples_input_from_file(
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
+        batch_size=batch_size,
+        repetition_penalty=repetition_penalty,
+        presence_penalty=presence_penalty,
+        proposer=proposer,
+        num_speculative_tokens=num_speculative_tokens,
+        num_beams=num_beams,
+        length_penalty=length_penalty,
+        early_stopping=early_stopping,
     )
 
     if is_mp_rank_0():
@@ -616,6 +1485,108 @@ def generate_samples_input_from_file(
     return generated_texts
 
 
+def read_records(jsonl_file):
+    """Returns the records of a jsonl file, skipping lines that an interrupted run left incomplete."""
+    records = []
+    with open(jsonl_file, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def read_shard_records(output_file):
+    """Returns the records of the shards of output_file (see generate_samples_sharded) by prompt id."""
+    records = {}
+    for shard_file in sorted(glob.glob(f"{output_file}.shard_*.jsonl")):
+        for record in read_records(shard_file):
+            records.setdefault(record["prompt_id"], record)
+    return records
+
+
+def generate_samples_sharded(
+    neox_args, model, prompts: List[str], output_file, batch_size: int = 1, **kwargs
+):
+    """
+    Offline generation across data parallel groups: every data parallel group completes every
+    data_parallel_world_size-th prompt and appends each batch of completions (with their 'prompt_id', the index in
+    prompts) to its shard, output_file.shard_XXXXX.jsonl, as soon as it is done. Prompts completed in any shard by an
+    earlier run are skipped. Once all groups are done, rank 0 merges the shards into output_file in prompt order.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model
+    prompts: the prompts, whose order has to be the same in restarted runs
+    output_file: file the merged records are written to
+    batch_size (default 1): number of prompts completed together, see generate_samples_from_prompt
+    kwargs: generation parameters (eos_token_id, maximum_tokens, recompute, temperature, ...), see
+            generate_samples_from_prompt
+
+    returns: List[dict] -> the records of all prompts in order on rank 0 (see generate_samples_from_prompt), an empty
+             list on other ranks
+    """
+    dp_rank = mpu.get_data_parallel_rank()
+    dp_world_size = mpu.get_data_parallel_world_size()
+    shard_file = f"{output_file}.shard_{dp_rank:05d}.jsonl"
+    # one writer per data parallel group
+    is_writer = is_mp_rank_0() and (
+        not neox_args.is_pipe_parallel or mpu.get_pipe_parallel_rank() == 0
+    )
+
+    # all ranks read the completed prompts before the writers rewrite their shards without incomplete lines
+    completed = read_shard_records(output_file)
+    torch.distributed.barrier()
+    if is_writer and os.path.exists(shard_file):
+        shard_records = read_records(shard_file)
+        with open(shard_file, "w") as f:
+            for record in shard_records:
+                f.write(json.dumps(record) + "\n")
+
+    pending = [
+        idx
+        for idx in range(dp_rank, len(prompts), dp_world_size)
+        if idx not in completed
+    ]
+    print_rank_0(
+        f"generate_samples_sharded() {len(completed)} of {len(prompts)} prompts completed, {len(pending)} pending in "
+        f"data parallel rank 0's shard"
+    )
+
+    def write_batch(batch_indices, batch_records):
+        if is_writer:
+            with open(shard_file, "a") as f:
+                for idx, record in zip(batch_indices, batch_records):
+                    f.write(json.dumps(dict(record, prompt_id=pending[idx])) + "\n")
+
+    generate_samples_from_prompt(
+        neox_args=neox_args,
+        model=model,
+        text=[prompts[idx] for idx in pending],
+        batch_size=batch_size,
+        on_batch_done=write_batch,
+        **kwargs,
+    )
+
+    torch.distributed.barrier()
+    if torch.distributed.get_rank() != 0:
+        return []
+    records = read_shard_records(output_file)
+    missing = [idx for idx in range(len(prompts)) if idx not in records]
+    assert (
+        not missing
+    ), f"prompts {missing[:10]} are missing from the shards of {output_file}"
+    generated_texts = [records[idx] for idx in range(len(prompts))]
+    with open(output_file, "w") as f_out:
+        for item in generated_texts:
+            f_out.write(json.dumps(item) + "\n")
+    print(
+        f"generate_samples_sharded() merged {len(generated_texts)} records into {output_file}",
+        flush=True,
+    )
+    return generated_texts
+
+
 def generate_samples_unconditional(
     neox_args,
     model,
@@ -627,6 +1598,14 @@ def generate_samples_unconditional(
     temperature: float = 0.0,
     top_k: int = 0,
     top_p: float = 0.0,
+    batch_size: int = 1,
+    repetition_penalty: float = 1.0,
+    presence_penalty: float = 0.0,
+    proposer=None,
+    num_speculative_tokens: int = 4,
+    num_beams: int = 1,
+    length_penalty: float = 1.0,
+    early_stopping: bool = True,
 ):
     """
     Generates samples unconditionially (no prompt) and yields them in a dictionary.
@@ -648,6 +1627,12 @@ def generate_samples_unconditional(
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
 
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
+    repetition_penalty (default 1.0): float -> divides positive (multiplies negative) logits of tokens already in the context or completion; 1.0 disables it.
+    presence_penalty (default 0.0): float -> subtracted from the logits of tokens already in the context or completion; 0.0 disables it.
+    proposer / num_speculative_tokens (optional): speculative decoding, see generate_samples_from_prompt
+    num_beams / length_penalty / early_stopping (optional): beam search, see generate_samples_from_prompt
+
+    batch_size (default 1): number of prompts completed together, see generate_samples_from_prompt
 
     yields: dict containing the following fields:
         - 'context' (the input)
@@ -670,6 +1655,14 @@ def generate_samples_unconditional(
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
+        batch_size=batch_size,
+        repetition_penalty=repetition_penalty,
+        presence_penalty=presence_penalty,
+        proposer=proposer,
+        num_speculative_tokens=num_speculative_tokens,
+        num_beams=num_beams,
+        length_penalty=length_penalty,
+        early_stopping=early_stopping,
     )
 
     if is_mp_rank_0():
@@ -690,6 +1683,10 @@ def generate_samples_interactive(
     temperature: float = 0.0,
     top_k: int = 0,
     top_p: float = 0.0,
+    repetition_penalty: float = 1.0,
+    presence_penalty: float = 0.0,
+    proposer=None,
+    num_speculative_tokens: int = 4,
 ):
     """
     Generates samples unconditionially (no prompt) and yields them in a dictionary.
@@ -707,6 +1704,9 @@ def generate_samples_interactive(
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
 
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
+    repetition_penalty (default 1.0): float -> divides positive (multiplies negative) logits of tokens already in the context or completion; 1.0 disables it.
+    presence_penalty (default 0.0): float -> subtracted from the logits of tokens already in the context or completion; 0.0 disables it.
+    proposer / num_speculative_tokens (optional): speculative decoding, see generate_samples_from_prompt
 
     yields: dict containing the following fields:
         - 'context' (the input)
@@ -729,7 +1729,15 @@ def generate_samples_interactive(
             if len(context_tokens) == 0:
                 context_tokens = [neox_args.tokenizer.eod]
             context_length = len(context_tokens)
-            if context_length >= (neox_args.seq_length - 1):
+            max_context_length = neox_args.seq_length - 1
+            if neox_args.sliding_window_tokens is not None:
+                # the completion can run past the sequence length, as long as the prompt fits in the cache
+                max_context_length = (
+                    neox_args.sliding_window_sink_tokens
+                    + neox_args.sliding_window_tokens
+                    + 1
+                )
+            if context_length >= max_context_length:
                 print_rank_0(
                     "\nContext length"
                     + str(context_length)
@@ -740,15 +1748,18 @@ def generate_samples_interactive(
             context_tokens = neox_args.tokenizer.tokenize("EMPTY TEXT")
             context_length = len(context_tokens)
 
-        terminate_runs = broadcast_terminate_signal(terminate_runs)
+        terminate_runs = broadcast_terminate_signal(
+            terminate_runs, device=next(model.module.parameters()).device
+        )
         if terminate_runs == 1:
             return
-        for (
-            batch_context_tokens,
-            batch_token_generation_start_index,
-            batch_token_generation_end_index,
-            is_done,
-        ) in stream_tokens(
+
+        # print the completion as it is generated, detokenizing only the new tokens
+        is_printing_rank = torch.distributed.get_rank() == 0
+        detokenizer = neox_args.tokenizer.incremental_detokenizer()
+        if is_printing_rank:
+            print("Generated Text: ", end="", flush=True)
+        for new_tokens, is_done in stream_generated_tokens(
             neox_args=neox_args,
             model=model,
             context_tokens=[context_tokens],
@@ -758,19 +1769,16 @@ def generate_samples_interactive(
             temperature=temperature,
             top_k=top_k,
             top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            presence_penalty=presence_penalty,
+            proposer=proposer,
+            num_speculative_tokens=num_speculative_tokens,
+            sliding_window=neox_args.sliding_window_tokens,
+            num_sink_tokens=neox_args.sliding_window_sink_tokens,
         ):
-            if mpu.get_model_parallel_rank() == 0:
-                generated_tokens = (
-                    batch_context_tokens[0]
-                    .cpu()
-                    .numpy()
-                    .tolist()[
-                        batch_token_generation_start_index[0]
-                        .item() : batch_token_generation_end_index[0]
-                        .item() + 1
-                    ]
-                )
-                generated_text = neox_args.tokenizer.detokenize(generated_tokens)
-                print_rank_0("Generated Text: " + generated_text)
+            if is_printing_rank:
+                print(detokenizer.add(new_tokens[0]), end="", flush=True)
+        if is_printing_rank:
+            print(detokenizer.flush(), flush=True)
         if torch.distributed.is_initialized() and torch.distributed.get_rank() == 0:
             _ = input("\n<press enter to continue>")
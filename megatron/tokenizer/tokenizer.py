@@ -17,6 +17,7 @@
 
 """Megatron tokenizers."""
 
+import codecs
 from abc import ABC
 from abc import abstractmethod
 
@@ -113,6 +114,10 @@ class AbstractTokenizer(ABC):
             "detokenizer is not implemented for {} " "tokenizer".format(self.name)
         )
 
+    def incremental_detokenizer(self):
+        """Returns a new IncrementalDetokenizer, to detokenize a stream of generated token ids."""
+        return IncrementalDetokenizer(self.detokenize)
+
     @property
     def cls(self):
         raise NotImplementedError(
@@ -144,6 +149,77 @@ class AbstractTokenizer(ABC):
         )
 
 
+class IncrementalDetokenizer:
+    """
+    Detokenizes a stream of token ids, returning only the text added by the new tokens.
+
+    Only a short window of tokens is decoded at every step: the tokens added since text was last returned, plus the
+    tokens of the previous step as context (the text of a token may depend on its neighbours, e.g. leading spaces).
+    Text ending in an incomplete utf-8 byte sequence (decoded to the replacement character) is held back until the
+    sequence is completed by the next tokens.
+
+    detokenize: function mapping a list of token ids to text
+    """
+
+    def __init__(self, detokenize):
+        self.detokenize = detokenize
+        self.token_ids = []
+        self.prefix_offset = 0  # start of the decoded window
+        self.read_offset = 0  # the text of the tokens before read_offset was returned
+
+    def add(self, token_ids: List[int]) -> str:
+        """Adds new token ids; returns the new text (which may be empty)."""
+        self.token_ids.extend(token_ids)
+        prefix_text = self.detokenize(
+            self.token_ids[self.prefix_offset : self.read_offset]
+        )
+        text = self.detokenize(self.token_ids[self.prefix_offset :])
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+
+        # drop the tokens that are no longer needed as context
+        del self.token_ids[: self.read_offset]
+        self.prefix_offset, self.read_offset = 0, len(self.token_ids)
+        return text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        """Returns any held back text, with incomplete utf-8 byte sequences replaced."""
+        prefix_text = self.detokenize(
+            self.token_ids[self.prefix_offset : self.read_offset]
+        )
+        text = self.detokenize(self.token_ids[self.prefix_offset :])
+        del self.token_ids[: self.read_offset]
+        self.prefix_offset, self.read_offset = 0, len(self.token_ids)
+        return text[len(prefix_text) :]
+
+
+class ByteLevelIncrementalDetokenizer:
+    """
+    IncrementalDetokenizer for byte level BPE vocabularies: every new token is mapped to its bytes, which are decoded by
+    an incremental utf-8 decoder that holds back incomplete byte sequences. The cost per token is constant.
+
+    decoder: dict from token id to (byte level) token text
+    byte_decoder: dict from byte level characters to byte values
+    errors: how to handle invalid utf-8, see bytes.decode
+    """
+
+    def __init__(self, decoder, byte_decoder, errors="replace"):
+        self.decoder = decoder
+        self.byte_decoder = byte_decoder
+        self.utf8_decoder = codecs.getincrementaldecoder("utf-8")(errors=errors)
+
+    def add(self, token_ids: List[int]) -> str:
+        """Adds new token ids; returns the new text (which may be empty)."""
+        data = bytes(
+            self.byte_decoder[c] for token in token_ids for c in self.decoder[token]
+        )
+        return self.utf8_decoder.decode(data)
+
+    def flush(self) -> str:
+        """Returns any held back text, with incomplete utf-8 byte sequences replaced."""
+        return self.utf8_decoder.decode(b"", final=True)
+
+
 class _GPT2BPETokenizer(AbstractTokenizer):
     """Original GPT2 BPE tokenizer."""
 
@@ -174,6 +250,13 @@ class _GPT2BPETokenizer(AbstractTokenizer):
     def detokenize(self, token_ids):
         return self.tokenizer.decode(token_ids)
 
+    def incremental_detokenizer(self):
+        return ByteLevelIncrementalDetokenizer(
+            self.tokenizer.decoder,
+            self.tokenizer.byte_decoder,
+            errors=self.tokenizer.errors,
+        )
+
     @property
     def eod(self):
         return self.eod_id
@@ -43,7 +43,18 @@ from megatron.model import (
     SoftEmbedding,
     get_params_for_weight_decay_optimization,
 )
-from megatron.checkpointing import load_checkpoint, save_checkpoint
+from megatron.model.layer_streaming import (
+    build_layers_without_weights,
+    get_streaming_model,
+)
+from megatron.model.utils import InferenceEngine, SequentialWrapper
+from megatron.checkpointing import (
+    find_mmap_weights,
+    load_checkpoint,
+    load_checkpoint_weights,
+    save_checkpoint,
+    stream_checkpoint_weights,
+)
 from megatron.data.data_utils import build_train_valid_test_data_iterators
 from megatron.initialize import initialize_megatron
 from megatron.learning_rates import AnnealingLR
@@ -54,7 +65,7 @@ from megatron.utils import (
     get_total_params,
     CharCounter,
 )
-from megatron.model.gpt2_model import cross_entropy
+from megatron.model.gpt2_model import cross_entropy, pipe_models_on_cpu
 from eval_tasks import run_eval_harness
 
 
@@ -449,6 +460,76 @@ def setup_model_and_optimizer(neox_args, use_cache=False, iteration=None):
     return model, optimizer, lr_scheduler
 
 
+def setup_model_for_cpu_inference(neox_args, use_cache=False, iteration=None):
+    """Setup the model for inference on cpu, without a deepspeed engine, and load its checkpoint weights."""
+    assert (
+        not neox_args.is_pipe_parallel
+    ), "cpu inference runs the sequential model, without pipeline parallelism"
+    if neox_args.load is not None and find_mmap_weights(neox_args, iteration):
+        # the weights are memory mapped from the checkpoint, so the model's own are freed as it is built
+        print_rank_0("building GPT2 model without weights ...")
+        layers, _, _ = build_layers_without_weights(neox_args, use_cache=use_cache)
+        model = SequentialWrapper(
+            layers, 0, None, parent_class_name=GPT2ModelPipe.__name__
+        )
+    else:
+        with pipe_models_on_cpu():
+            model = get_model(neox_args=neox_args, use_cache=use_cache)
+    model = InferenceEngine(model.to(neox_args.params_dtype))
+
+    if neox_args.load is not None:
+        neox_args.iteration = load_checkpoint_weights(
+            neox_args=neox_args, model=model.module, iteration=iteration
+        )
+        print_rank_0(f"Loaded checkpoint weights of iteration {neox_args.iteration}")
+    else:
+        neox_args.iteration = 0
+    model.total_params = get_total_params(model.module)
+    print_rank_0(f' > total params: {"{:,}".format(model.total_params)}')
+
+    model.eval()
+    return model
+
+
+def setup_model_for_layer_streaming(neox_args, use_cache=False, iteration=None):
+    """
+    Setup the model for inference streaming its layers' weights from the pipeline parallel checkpoint in
+    neox_args.load, without a deepspeed engine, on neox_args.inference_device.
+    """
+    assert (
+        not neox_args.is_pipe_parallel
+    ), "layer streaming runs the sequential model, without pipeline parallelism"
+    assert not (neox_args.soft_prompt_tuning or {}).get(
+        "enabled", False
+    ), "layer streaming does not support soft prompt tuning"
+    assert (
+        neox_args.weight_quantization is None
+    ), "layer streaming does not support weight quantization"
+    device = (
+        torch.device("cpu")
+        if neox_args.inference_device == "cpu"
+        else torch.device("cuda", torch.cuda.current_device())
+    )
+    model, num_params = get_streaming_model(neox_args=neox_args, use_cache=use_cache)
+    model = InferenceEngine(model.to(device=device, dtype=neox_args.params_dtype))
+    total_params = torch.tensor(
+        [num_params if mpu.get_data_parallel_rank() == 0 else 0], device=device
+    )
+    torch.distributed.all_reduce(total_params)
+    model.total_params = total_params.item()
+    print_rank_0(f' > total params: {"{:,}".format(model.total_params)}')
+
+    neox_args.iteration = stream_checkpoint_weights(
+        neox_args=neox_args, model=model.module, iteration=iteration
+    )
+    print_rank_0(
+        f"Streaming the weights of {len(model.module.layer_files)} layers from iteration {neox_args.iteration}"
+    )
+
+    model.eval()
+    return model
+
+
 def backward_step(neox_args, timers, optimizer, model, loss):
     """Backward step."""
 
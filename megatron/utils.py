@@ -388,7 +388,7 @@ def get_total_params(model):
     else:
         params = 0
 
-    total_n_parameters = torch.tensor([params]).cuda(torch.cuda.current_device())
+    total_n_parameters = torch.tensor([params], device=next(model.parameters()).device)
     torch.distributed.all_reduce(total_n_parameters)
     total_n_parameters = total_n_parameters.item()
     return total_n_parameters
@@ -409,7 +409,11 @@ def setup_for_inference_or_eval(
 
     from megatron.neox_arguments import NeoXArgs
     from megatron.initialize import initialize_megatron
-    from megatron.training import setup_model_and_optimizer
+    from megatron.training import (
+        setup_model_and_optimizer,
+        setup_model_for_cpu_inference,
+        setup_model_for_layer_streaming,
+    )
 
     _overwrite_values = {
         "checkpoint_activations": False,
@@ -426,21 +430,124 @@ def setup_for_inference_or_eval(
     if neox_args.load is None:
         raise ValueError("`load` parameter must be supplied to load a model`")
 
-    # initialize megatron
-    initialize_megatron(neox_args)
+    if neox_args.layer_streaming:
+        # the sequential model, whose layers load their weights from the files of a pipeline parallel checkpoint
+        neox_args.update_value("pipe_parallel_size", 0)
+        neox_args.update_value("is_pipe_parallel", False)
+
+    if neox_args.inference_device == "cpu":
+        # the sequential model on a gloo process group, without fused (cuda) kernels, in bf16 or fp32
+        cpu_values = {
+            "distributed_backend": "gloo",
+            "use_cpu_initialization": True,
+            "scaled_upper_triang_masked_softmax_fusion": False,
+            "scaled_masked_softmax_fusion": False,
+            "precision": "bfloat16"
+            if neox_args.precision in ["fp16", "bfloat16"]
+            else "fp32",
+            # gloo has no bf16 collectives
+            "fp32_allreduce": True,
+            "pipe_parallel_size": 0,
+            "is_pipe_parallel": False,
+        }
+        for key, value in cpu_values.items():
+            neox_args.update_value(key, value)
+        if neox_args.inference_threads is not None:
+            torch.set_num_threads(neox_args.inference_threads)
+
+        initialize_megatron(neox_args, allow_no_cuda=True)
+        setup_model = (
+            setup_model_for_layer_streaming
+            if neox_args.layer_streaming
+            else setup_model_for_cpu_inference
+        )
+        model = setup_model(
+            neox_args=neox_args,
+            use_cache=use_cache,
+            iteration=neox_args.iteration,
+        )
+    elif neox_args.layer_streaming:
+        initialize_megatron(neox_args)
+        model = setup_model_for_layer_streaming(
+            neox_args=neox_args,
+            use_cache=use_cache,
+            iteration=neox_args.iteration,
+        )
+    else:
+        # initialize megatron
+        initialize_megatron(neox_args)
 
-    # set up model and load checkpoint.
-    model, _, _ = setup_model_and_optimizer(
-        neox_args=neox_args,
-        use_cache=use_cache,
-        iteration=neox_args.iteration,
-    )  # we use setup_model_and_optimizer instead of get_model in order to initialize deepspeed
+        # set up model and load checkpoint.
+        model, _, _ = setup_model_and_optimizer(
+            neox_args=neox_args,
+            use_cache=use_cache,
+            iteration=neox_args.iteration,
+        )  # we use setup_model_and_optimizer instead of get_model in order to initialize deepspeed
     print_rank_0("Finished loading model")
 
+    if neox_args.weight_quantization == "int8":
+        bytes_before, bytes_after = mpu.quantize_weights_int8(
+            model, group_size=neox_args.weight_quantization_group_size
+        )
+        print_rank_0(
+            f"Quantized weights to int8: {bytes_before / 2**20:.1f} MiB -> {bytes_after / 2**20:.1f} MiB per model "
+            f"parallel rank"
+        )
+
     model.module.inference_mode(use_cache=use_cache)
     return model, neox_args
 
 
+def setup_draft_model(neox_args):
+    """
+    Initializes the draft model of speculative decoding from neox_args.speculative_draft_config, after the model was
+    set up with setup_for_inference_or_eval. The draft model uses the model's tokenizer and parallelism, and is put in
+    inference mode with the kv cache.
+
+    neox_args: NeoXArgs of the model
+    """
+
+    from megatron.neox_arguments import NeoXArgs
+    from megatron.training import setup_model_and_optimizer
+
+    assert (
+        neox_args.speculative_draft_config
+    ), "speculative_draft_config must be supplied for a draft model"
+    overwrite_values = {
+        "checkpoint_activations": False,
+        "partition_activations": False,
+        "no_load_optim": True,
+        "zero_optimization": None,
+    }
+    # the draft model shares the model parallel group and the tokenizer of the model
+    for key in [
+        "model_parallel_size",
+        "pipe_parallel_size",
+        "tokenizer_type",
+        "vocab_file",
+        "merge_file",
+        "precision",
+    ]:
+        overwrite_values[key] = getattr(neox_args, key)
+    draft_args = NeoXArgs.from_ymls(
+        neox_args.speculative_draft_config, overwrite_values=overwrite_values
+    )
+    draft_args.configure_distributed_args()
+    draft_args.build_tokenizer()
+    if draft_args.load is None:
+        raise ValueError("the draft model config must supply `load`")
+
+    draft_model, _, _ = setup_model_and_optimizer(
+        neox_args=draft_args,
+        use_cache=True,
+        iteration=draft_args.iteration,
+    )
+    print_rank_0("Finished loading draft model")
+
+    draft_model.module.inference_mode(use_cache=True, last_position_only=True)
+    return draft_model
+
+
 class CharCounter:
     """
     Wraps the data_iterator to count the number of characters in a batch
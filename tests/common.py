@@ -52,8 +52,11 @@ def count_gpus():
     if _num_gpus is None:
         import subprocess
 
-        nvidia_smi = subprocess.check_output(["nvidia-smi", "--list-gpus"])
-        _num_gpus = len(nvidia_smi.decode("utf-8").strip().split("\n"))
+        try:
+            nvidia_smi = subprocess.check_output(["nvidia-smi", "--list-gpus"])
+            _num_gpus = len(nvidia_smi.decode("utf-8").strip().split("\n"))
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            _num_gpus = 0
     return _num_gpus
 
 
@@ -202,10 +205,9 @@ def distributed_test(world_size=2, backend="nccl"):
         def run_func_decorator(*func_args, **func_kwargs):
             """Entry point for @distributed_test()."""
 
-            gpus = count_gpus()
-
             if isinstance(world_size, int):
-                if gpus < world_size:
+                # gloo tests run on cpu
+                if backend != "gloo" and count_gpus() < world_size:
                     pytest.mark.skip(
                         reason=f"at least {world_size} GPUs are required to run this test"
                     )
@@ -266,6 +268,81 @@ def model_setup(yaml_list=None, param_dict=None, clear_data=True):
     return model, optimizer, lr_scheduler, args_loaded
 
 
+def cpu_model_setup(**overwrite):
+    """
+    Builds a tiny, randomly initialized GPT2ModelPipe on cpu, model parallel across the gloo world (unless a smaller
+    model_parallel_size is given, which leaves the rest to data parallelism), for inference tests.
+    Returns the sequential model wrapped like a deepspeed engine (exposing it as `module`) and the NeoXArgs.
+    """
+    from deepspeed.runtime.pipe.topology import PipeModelDataParallelTopology
+    from megatron import mpu
+    from megatron.neox_arguments import NeoXArgs
+    from megatron.model import GPT2ModelPipe
+    from megatron.model.gpt2_model import pipe_models_on_cpu
+    from megatron.model.utils import InferenceEngine
+
+    world_size = torch.distributed.get_world_size()
+    config = dict(BASE_CONFIG)
+    config.update(
+        {
+            "num_layers": 2,
+            "hidden_size": 64,
+            "num_attention_heads": 4,
+            "seq_length": 48,
+            "max_position_embeddings": 48,
+            "precision": "fp32",
+            "fp16": None,
+            "attention_dropout": 0.0,
+            "hidden_dropout": 0.0,
+            "checkpoint_activations": False,
+            "partition_activations": False,
+            "use_cpu_initialization": True,
+            "tokenizer_type": "CharLevelTokenizer",
+            "pipe_parallel_size": 0,
+            "model_parallel_size": world_size,
+            "global_num_gpus": world_size,
+        }
+    )
+    config.update(overwrite)
+    neox_args = NeoXArgs.from_dict(config)
+    neox_args.build_tokenizer()
+
+    model_parallel_size = neox_args.model_parallel_size
+    topology = PipeModelDataParallelTopology(
+        num_pp=1, num_mp=model_parallel_size, num_dp=world_size // model_parallel_size
+    )
+    mpu.destroy_model_parallel()
+    mpu.initialize_model_parallel(
+        model_parallel_size,
+        topology=topology,
+        fp32_allreduce=neox_args.fp32_allreduce,
+    )
+    torch.manual_seed(1234)
+    with pipe_models_on_cpu():
+        model = GPT2ModelPipe(
+            neox_args, num_tokentypes=0, parallel_output=False, topology=topology
+        ).to_sequential()
+    model.eval()
+    return InferenceEngine(model), neox_args
+
+
+def greedy_reference(model, neox_args, context_tokens, maximum_tokens):
+    """Greedy completion recomputing the full sequence at every step (no kv cache)."""
+    tokens, generated = list(context_tokens), []
+    while len(generated) < maximum_tokens and len(tokens) < neox_args.seq_length:
+        n = len(tokens)
+        attention_mask = torch.tril(torch.ones(1, 1, n, n)) < 0.5
+        logits = model.module(
+            (torch.tensor([tokens]), torch.arange(n).unsqueeze(0), attention_mask)
+        )
+        token = logits[0, -1].argmax().item()
+        if token == neox_args.tokenizer.eod:
+            break
+        generated.append(token)
+        tokens.append(token)
+    return generated
+
+
 def bounded_product(sequence, n=None, seed=None):
     """
     Returns a shuffled, bounded cartesian product of the input sequence.
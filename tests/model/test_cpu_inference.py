@@ -0,0 +1,134 @@
+"""
+Tests for inference on cpu: generation without cuda, and loading checkpoint weights into a model without a deepspeed
+engine
+"""
+
+import os
+
+import pytest
+import torch
+
+from tests.common import distributed_test, cpu_model_setup, greedy_reference
+
+
+@pytest.mark.cpu
+def test_generate_samples_on_cpu():
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import generate_samples_from_prompt
+
+        model, neox_args = cpu_model_setup(pos_emb="rotary")
+        prompts = ["the quick brown fox", "jumps over"]
+        model.module.inference_mode(use_cache=False)
+        expected = [
+            greedy_reference(
+                model,
+                neox_args,
+                [int(t) for t in neox_args.tokenizer.tokenize(prompt)],
+                maximum_tokens=8,
+            )
+            for prompt in prompts
+        ]
+
+        model.module.inference_mode(use_cache=True)
+        results = generate_samples_from_prompt(
+            neox_args, model, prompts, maximum_tokens=8, batch_size=2
+        )
+        if torch.distributed.get_rank() == 0:
+            assert [result["text"] for result in results] == [
+                neox_args.tokenizer.detokenize(tokens) for tokens in expected
+            ]
+        else:
+            assert results == []
+
+        # so does a bf16 model, whose model parallel collectives run in fp32 (gloo has no bf16)
+        model, neox_args = cpu_model_setup(
+            pos_emb="rotary", precision="bfloat16", fp32_allreduce=True
+        )
+        model.module.to(neox_args.params_dtype)
+        model.module.inference_mode(use_cache=True)
+        results = generate_samples_from_prompt(
+            neox_args, model, prompts, maximum_tokens=8, batch_size=2
+        )
+        if torch.distributed.get_rank() == 0:
+            assert all(0 < result["length"] <= 8 for result in results)
+
+    wrapper()
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("pipe_checkpoint", [False, True])
+def test_load_checkpoint_weights(tmp_path, pipe_checkpoint):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron import mpu
+        from megatron.checkpointing import load_checkpoint_weights
+
+        model, neox_args = cpu_model_setup(load=str(tmp_path))
+        model.module.inference_mode(use_cache=False)
+        tokens = torch.tensor(
+            [[int(t) for t in neox_args.tokenizer.tokenize("the quick brown fox")]]
+        )
+        n = tokens.size(1)
+        model_inputs = (
+            tokens,
+            torch.arange(n).unsqueeze(0),
+            torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+        )
+        expected = model.module(model_inputs)
+
+        # the files deepspeed saves for sequential and pipeline parallel models
+        mp_rank = mpu.get_model_parallel_rank()
+        checkpoint_dir = os.path.join(tmp_path, "global_step7")
+        state_dict = {"iteration": 7, "args": {"num_layers": 2}, "module": None}
+        if pipe_checkpoint:
+            for idx, layer in enumerate(model.module.sequential):
+                if layer.state_dict():
+                    torch.save(
+                        layer.state_dict(),
+                        os.path.join(
+                            checkpoint_dir,
+                            f"layer_{idx:02d}-model_{mp_rank:02d}-model_states.pt",
+                        ),
+                    )
+        else:
+            state_dict["module"] = model.module.state_dict()
+        if torch.distributed.get_rank() == 0:
+            with open(os.path.join(tmp_path, "latest"), "w") as f:
+                f.write("global_step7")
+        if not pipe_checkpoint or mp_rank == 0:
+            torch.save(
+                state_dict,
+                os.path.join(checkpoint_dir, f"mp_rank_{mp_rank:02d}_model_states.pt"),
+            )
+        torch.distributed.barrier()
+
+        with torch.no_grad():
+            for p in model.parameters():
+                p.zero_()
+        assert not torch.allclose(model.module(model_inputs), expected)
+        assert load_checkpoint_weights(neox_args, model.module) == 7
+        assert torch.equal(model.module(model_inputs), expected)
+
+        with pytest.raises(ValueError):
+            load_checkpoint_weights(neox_args, model.module, iteration=8)
+
+    os.makedirs(tmp_path / "global_step7")
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_pipe_models_on_cpu_is_scoped_to_construction():
+    from deepspeed.pipe import PipelineModule
+    from megatron.model import GPT2ModelPipe
+    from megatron.model.gpt2_model import pipe_models_on_cpu
+
+    assert "to" not in vars(GPT2ModelPipe)
+    to = PipelineModule.to
+    with pipe_models_on_cpu():
+        assert PipelineModule.to is not to
+    assert PipelineModule.to is to
+    with pytest.raises(RuntimeError):
+        with pipe_models_on_cpu():
+            raise RuntimeError
+    assert PipelineModule.to is to
@@ -0,0 +1,74 @@
+"""
+Tests for the inference settings of the model (`inference_mode` / `train_mode`), on a tiny model on cpu
+"""
+
+import pytest
+import torch
+
+from tests.common import distributed_test, cpu_model_setup
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("no_weight_tying", [True, False])
+def test_last_position_only_logits(no_weight_tying):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        model, neox_args = cpu_model_setup(no_weight_tying=no_weight_tying)
+        tokens = torch.randint(0, 256, (2, 10))
+        model_inputs = (
+            tokens,
+            torch.arange(10).unsqueeze(0).expand_as(tokens),
+            torch.tril(torch.ones(1, 1, 10, 10)) < 0.5,
+        )
+
+        model.module.inference_mode(use_cache=False)
+        logits = model.module(model_inputs)
+        assert logits.shape[:2] == (2, 10)
+
+        model.module.inference_mode(use_cache=False, last_position_only=True)
+        last_logits = model.module(model_inputs)
+        assert last_logits.shape == (2, 1, logits.size(-1))
+        assert torch.allclose(last_logits, logits[:, -1:], atol=1e-5)
+
+        # training always returns logits for every position
+        model.module.train_mode()
+        assert model.module(model_inputs).shape[:2] == (2, 10)
+
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_parallel_output_logits():
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        model, neox_args = cpu_model_setup(
+            no_weight_tying=True, output_layer_parallelism="column"
+        )
+        tokens = torch.randint(0, 256, (2, 10))
+        model_inputs = (
+            tokens,
+            torch.arange(10).unsqueeze(0).expand_as(tokens),
+            torch.tril(torch.ones(1, 1, 10, 10)) < 0.5,
+        )
+
+        model.module.inference_mode(use_cache=False, last_position_only=True)
+        logits = model.module(model_inputs)
+        assert logits.size(-1) == neox_args.padded_vocab_size
+
+        # every model parallel rank keeps its slice of the vocab
+        model.module.inference_mode(
+            use_cache=False, last_position_only=True, parallel_output=True
+        )
+        local_logits = model.module(model_inputs)
+        local_vocab_size = (
+            neox_args.padded_vocab_size // torch.distributed.get_world_size()
+        )
+        rank = torch.distributed.get_rank()
+        assert local_logits.size(-1) == local_vocab_size
+        assert torch.allclose(
+            local_logits,
+            logits[..., rank * local_vocab_size : (rank + 1) * local_vocab_size],
+            atol=1e-5,
+        )
+
+    wrapper()
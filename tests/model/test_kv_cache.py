@@ -0,0 +1,559 @@
+"""
+Tests for the key / value caches used in incremental decoding
+"""
+
+import pytest
+import torch
+
+from megatron.model.kv_cache import (
+    BlockAllocator,
+    Int8KVCache,
+    PagedKVCache,
+    PagedKVCacheManager,
+    PromptCache,
+    StaticKVCache,
+)
+from tests.common import distributed_test, cpu_model_setup
+
+
+def _kv(sq, b=2, np=4, hn=8):
+    return torch.randn(sq, b, np, hn), torch.randn(sq, b, np, hn)
+
+
+@pytest.mark.cpu
+def test_static_kv_cache_matches_concatenation():
+    cache = StaticKVCache(max_seq_len=16)
+    key, value = _kv(5)
+    k, v = cache.update(key, value)
+    assert cache.seq_len == 5
+    assert torch.equal(k, key) and torch.equal(v, value)
+
+    keys, values = [key], [value]
+    for _ in range(3):
+        key, value = _kv(1)
+        keys.append(key)
+        values.append(value)
+        k, v = cache.update(key, value)
+
+    assert cache.seq_len == 8
+    assert torch.equal(k, torch.cat(keys)) and torch.equal(v, torch.cat(values))
+    assert cache.numel() == torch.stack((k, v)).numel()
+
+
+@pytest.mark.cpu
+def test_static_kv_cache_reset_reuses_buffer():
+    cache = StaticKVCache(max_seq_len=8)
+    cache.update(*_kv(4))
+    buffer = cache.buffer
+
+    cache.reset()
+    assert cache.seq_len == 0 and cache.numel() == 0
+
+    key, value = _kv(3)
+    k, v = cache.update(key, value)
+    assert cache.buffer is buffer
+    assert torch.equal(k, key) and torch.equal(v, value)
+
+    # a different batch size reallocates on the next generation
+    cache.reset()
+    cache.update(*_kv(2, b=3))
+    assert cache.buffer is not buffer
+    assert cache.buffer.shape == (2, 8, 3, 4, 8)
+
+
+@pytest.mark.cpu
+def test_static_kv_cache_overflow():
+    cache = StaticKVCache(max_seq_len=4)
+    cache.update(*_kv(4))
+    with pytest.raises(AssertionError):
+        cache.update(*_kv(1))
+
+
+@pytest.mark.cpu
+def test_int8_kv_cache_matches_static():
+    torch.manual_seed(0)
+    static, int8 = StaticKVCache(max_seq_len=16), Int8KVCache(max_seq_len=16)
+    for sq in [5, 1, 1, 3]:
+        key, value = _kv(sq)
+        key[:, 0, 1] = 0.0
+        static.update(key, value)
+        k, v = int8.update(key, value)
+    assert int8.buffer.dtype == torch.int8 and int8.scale.shape == (2, 16, 2, 4, 1)
+
+    def check():
+        # rounding is off by at most half a step of each position's and head's scale
+        expected = static.cached()
+        assert int8.seq_len == static.seq_len
+        error = (int8.cached() - expected).abs()
+        assert torch.all(error <= int8.scale[:, : int8.seq_len] / 2 + 1e-6)
+        assert torch.all(int8.cached()[expected == 0] == 0.0)
+
+    check()
+    assert torch.equal(torch.stack((k, v)), int8.cached())
+    assert int8.nbytes() == 2 * 16 * 2 * 4 * (8 + 4)
+    assert int8.nbytes() < 0.4 * static.nbytes()
+
+    for cache in [static, int8]:
+        cache.evict(2, 3)
+        cache.select_rows(torch.tensor([1, 0]))
+    check()
+    for cache in [static, int8]:
+        cache.append_rows(cache.zero_rows(1, cache.seq_len))
+        cache.update(*_kv(1, b=3))
+    assert int8.cached().shape == (2, 8, 3, 4, 8)
+    assert torch.all(int8.cached()[:, :7, 2] == 0.0)
+
+
+@pytest.mark.cpu
+def test_block_allocator_refcounts():
+    allocator = BlockAllocator(num_blocks=3)
+    a, b = allocator.allocate(), allocator.allocate()
+    assert (a, b) == (0, 1) and allocator.num_free_blocks == 1
+
+    allocator.incref(a)
+    allocator.free(a)
+    assert allocator.num_free_blocks == 1  # still referenced once
+    allocator.free(a)
+    assert allocator.num_free_blocks == 2
+
+    with pytest.raises(AssertionError):
+        allocator.incref(a)
+    allocator.allocate(), allocator.allocate()
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+
+
+@pytest.mark.cpu
+def test_paged_kv_cache_fits_more_sequences():
+    # the memory of a static cache for 4 rows of seq_length 64 ...
+    num_slots, seq_length, block_size = 4, 64, 8
+    manager = PagedKVCacheManager(num_slots * seq_length // block_size, block_size)
+
+    # ... holds 14 completions of 16 tokens of a shared 32 token prompt
+    manager.add_sequence("prompt")
+    manager.prepare(["prompt"], 32)
+    num_sequences = 0
+    while manager.can_append(["prompt"], 16):
+        manager.fork("prompt", num_sequences)
+        manager.prepare([num_sequences], 16)
+        num_sequences += 1
+    assert num_sequences == 14
+    assert manager.allocator.num_free_blocks == 0
+
+    # and 3 times as many unrelated sequences of mixed lengths up to half the seq_length
+    for seq_id in list(manager.block_tables):
+        manager.free_sequence(seq_id)
+    assert manager.allocator.num_free_blocks == manager.num_blocks
+    lengths = [5, 32, 17, 9, 24, 3, 30, 12]
+    num_sequences = 0
+    while True:
+        manager.add_sequence(num_sequences)
+        length = lengths[num_sequences % len(lengths)]
+        if not manager.can_append([num_sequences], length):
+            break
+        manager.prepare([num_sequences], length)
+        num_sequences += 1
+    assert num_sequences >= 3 * num_slots
+
+
+@pytest.mark.cpu
+def test_paged_kv_cache_matches_concatenation():
+    torch.manual_seed(0)
+    manager = PagedKVCacheManager(num_blocks=16, block_size=4)
+    cache = PagedKVCache(manager)
+    expected = {}
+
+    def forward(seq_ids, sq):
+        manager.prepare(seq_ids, sq)
+        key, value = _kv(sq, b=len(seq_ids))
+        cache.write(key, value)
+        for row, seq_id in enumerate(seq_ids):
+            k, v = expected.get(seq_id, (key[:0, row], value[:0, row]))
+            expected[seq_id] = (
+                torch.cat((k, key[:, row])),
+                torch.cat((v, value[:, row])),
+            )
+
+    # prompts are forwarded one at a time, "c" shares the (partially filled) blocks of "a"
+    for seq_id, prompt_len in [("a", 6), ("b", 3)]:
+        manager.add_sequence(seq_id)
+        forward([seq_id], prompt_len)
+    manager.fork("a", "c")
+    expected["c"] = expected["a"]
+    assert manager.block_tables["c"] == manager.block_tables["a"]
+
+    for _ in range(5):
+        forward(["a", "b", "c"], 1)
+        keys, values = cache.gather()
+        mask = cache.attention_mask
+        assert keys.shape[:2] == (manager.max_length, 3)
+        for row, seq_id in enumerate(["a", "b", "c"]):
+            seq_len = manager.seq_lens[seq_id]
+            assert torch.equal(keys[:seq_len, row], expected[seq_id][0])
+            assert torch.equal(values[:seq_len, row], expected[seq_id][1])
+            assert mask[row, 0, 0].tolist() == [
+                i >= seq_len for i in range(manager.max_length)
+            ]
+
+    # the shared full block is still shared, the partially filled one was copied on write
+    assert manager.block_tables["a"][0] == manager.block_tables["c"][0]
+    assert manager.block_tables["a"][1] != manager.block_tables["c"][1]
+
+    for seq_id in ["a", "b", "c"]:
+        manager.free_sequence(seq_id)
+    assert manager.allocator.num_free_blocks == manager.num_blocks
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("pos_emb", ["rotary", "alibi"])
+def test_paged_kv_cache_attention(pos_emb):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.model.transformer import ParallelTransformerLayer
+        from megatron.text_generation_utils import forward_model
+
+        model, neox_args = cpu_model_setup(pos_emb=pos_emb)
+        model.module.inference_mode(use_cache=False)
+        layers = [
+            m for m in model.module.modules() if isinstance(m, ParallelTransformerLayer)
+        ]
+        torch.manual_seed(0)
+        prompt_lengths, decode_steps = [7, 3, 12], 4
+        sequences = [
+            torch.randint(0, 256, (n + decode_steps,)).tolist() for n in prompt_lengths
+        ]
+
+        def reference_logits(tokens):
+            n = len(tokens)
+            model_inputs = (
+                torch.tensor([tokens]),
+                torch.arange(n).unsqueeze(0),
+                torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+            )
+            return forward_model(model, model_inputs)[0, -1]
+
+        # logits of every prefix without caching
+        expected = [
+            {n: reference_logits(tokens[:n]) for n in range(1, len(tokens) + 1)}
+            for tokens in sequences
+        ]
+
+        model.module.inference_mode(use_cache=True)
+        manager = PagedKVCacheManager(num_blocks=16, block_size=4)
+        for layer in layers:
+            layer.layer_past = PagedKVCache(manager)
+
+        def paged_logits(seq_ids, tokens):
+            manager.prepare(seq_ids, tokens.size(1))
+            model_inputs = (tokens, manager.position_ids, manager.attention_mask)
+            return forward_model(model, model_inputs)[:, -1]
+
+        # prefill the prompts separately, then decode them as one batch of ragged rows
+        for seq_id, n in enumerate(prompt_lengths):
+            manager.add_sequence(seq_id)
+            logits = paged_logits([seq_id], torch.tensor([sequences[seq_id][:n]]))
+            assert torch.allclose(logits[0], expected[seq_id][n], atol=1e-4)
+        for step in range(decode_steps):
+            new_tokens = [
+                tokens[n + step] for tokens, n in zip(sequences, prompt_lengths)
+            ]
+            logits = paged_logits([0, 1, 2], torch.tensor(new_tokens).unsqueeze(1))
+            for seq_id, n in enumerate(prompt_lengths):
+                assert torch.allclose(
+                    logits[seq_id], expected[seq_id][n + step + 1], atol=1e-4
+                )
+        with pytest.raises(ValueError):
+            model.module.truncate_cache(4)
+        with pytest.raises(ValueError):
+            model.module.select_cache_rows(torch.tensor([0]))
+
+        for layer in layers:
+            layer.layer_past = None
+
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_paged_kv_cache_type_falls_back_to_static():
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.model import transformer
+        from megatron.text_generation_utils import forward_model
+
+        model, neox_args = cpu_model_setup(pos_emb="rotary", kv_cache_type="paged")
+        model.module.inference_mode(use_cache=True)
+        tokens = torch.randint(0, 256, (1, 4))
+        model_inputs = (
+            tokens,
+            torch.arange(4).unsqueeze(0),
+            torch.tril(torch.ones(1, 1, 4, 4)) < 0.5,
+        )
+        transformer._warned_paged_kv_cache_fallback = False
+        # outside the continuous batching scheduler, the layers cache in static caches, and the first one warns
+        with pytest.warns(UserWarning, match="paged") as record:
+            forward_model(model, model_inputs)
+        assert len(record) == 1
+        assert all(
+            isinstance(m.layer_past, StaticKVCache)
+            for m in model.module.modules()
+            if isinstance(m, transformer.ParallelTransformerLayer)
+        )
+        model.module.clear_cache()
+
+    wrapper()
+
+
+def _prompt_key_values(tokens, num_layers=2):
+    # stand-in keys / values that identify their token, [2, len(tokens), b=1, np, hn] per layer
+    kv = (
+        torch.tensor(tokens, dtype=torch.float)
+        .view(1, -1, 1, 1, 1)
+        .expand(2, -1, 1, 2, 4)
+    )
+    return [kv + layer for layer in range(num_layers)]
+
+
+@pytest.mark.cpu
+def test_prompt_cache_restores_longest_prefix():
+    cache = PromptCache(max_bytes=2 ** 20, block_size=4)
+    preamble = list(range(100, 110))
+    cache.store([preamble + [1, 2, 3]], _prompt_key_values(preamble + [1, 2, 3]))
+    cache.store([preamble + [7]], _prompt_key_values(preamble + [7]))
+    assert len(cache.entries) == 2
+
+    # shares the preamble and [1, 2] with the first prompt
+    length, key_values = cache.restore([preamble + [1, 2, 9, 9]])
+    assert length == 12
+    expected = _prompt_key_values(preamble + [1, 2])
+    assert len(key_values) == 2
+    assert all(torch.equal(kv, e) for kv, e in zip(key_values, expected))
+
+    # the last token is always left to be forwarded, and all rows restore the same number of positions
+    assert cache.restore([preamble + [7]])[0] == 10
+    assert cache.restore([preamble + [1, 2, 3, 4], preamble + [5]])[0] == 10
+
+    # prompts sharing less than a block are misses
+    assert cache.restore([preamble[:3] + [0] * 8]) == (0, [])
+    assert cache.stats["hits"] == 4 and cache.stats["misses"] == 1
+
+    # prompts already held by an entry are not stored again
+    cache.store([preamble + [1]], _prompt_key_values(preamble + [1]))
+    assert len(cache.entries) == 2
+
+
+@pytest.mark.cpu
+def test_prompt_cache_lru_eviction():
+    prompts = [[i] * 8 for i in range(4)]
+    entry_bytes = 2 * 2 * 8 * 2 * 4 * 4  # layers * k/v * tokens * np * hn * fp32
+    cache = PromptCache(max_bytes=3 * entry_bytes, block_size=4)
+    for tokens in prompts[:3]:
+        cache.store([tokens], _prompt_key_values(tokens))
+    assert cache.nbytes == 3 * entry_bytes
+
+    cache.restore([prompts[0] + [0]])  # prompts[1] is now the least recently used
+    cache.store([prompts[3]], _prompt_key_values(prompts[3]))
+    assert cache.nbytes == 3 * entry_bytes
+    assert [cache.lookup(tokens)[1] for tokens in prompts] == [8, 0, 8, 8]
+
+    cache.clear()
+    assert cache.nbytes == 0 and not cache.index
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("kv_cache_type", ["dynamic", "static"])
+def test_prompt_cache_prefill(kv_cache_type):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import (
+            forward_model,
+            restore_prompt_prefix,
+            store_prompt_prefix,
+        )
+
+        model, neox_args = cpu_model_setup(
+            pos_emb="rotary", kv_cache_type=kv_cache_type
+        )
+        torch.manual_seed(0)
+        preamble = torch.randint(0, 256, (1, 20))
+        prompts = [
+            torch.cat(
+                (preamble, torch.tensor([[first]]), torch.randint(0, 256, (1, n))), 1
+            )
+            for first, n in [(1, 4), (2, 8), (3, 6)]
+        ]
+
+        def prefill(tokens, start=0):
+            n = tokens.size(1)
+            model_inputs = (
+                tokens[:, start:],
+                torch.arange(start, n).unsqueeze(0),
+                torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+            )
+            return forward_model(model, model_inputs)[:, -1]
+
+        model.module.inference_mode(use_cache=True)
+        cache = PromptCache(max_bytes=2 ** 20)
+        expected = []
+        for i, tokens in enumerate(prompts):
+            model.module.clear_cache()
+            expected.append(prefill(tokens))
+            if i < 2:
+                store_prompt_prefix(cache, model, tokens)
+
+        # cached prompts only forward their last token, a new prompt sharing the preamble only its own tokens
+        for tokens, logits, n in zip(prompts, expected, [24, 28, 20]):
+            model.module.clear_cache()
+            restored = restore_prompt_prefix(cache, model, tokens)
+            assert restored == n
+            assert torch.allclose(prefill(tokens, restored), logits, atol=1e-5)
+        model.module.clear_cache()
+
+    wrapper()
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("kv_cache_type", ["dynamic", "static"])
+def test_select_cache_rows(kv_cache_type):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import forward_model
+
+        model, neox_args = cpu_model_setup(
+            pos_emb="rotary", kv_cache_type=kv_cache_type
+        )
+        torch.manual_seed(0)
+        tokens = torch.randint(0, 256, (4, 16))
+        n = tokens.size(1)
+        attention_mask = torch.tril(torch.ones(1, 1, n, n)) < 0.5
+        position_ids = torch.arange(n).unsqueeze(0).expand(4, n)
+
+        def decode(rows, start, end):
+            return [
+                forward_model(
+                    model,
+                    (
+                        tokens[rows, i : i + 1],
+                        position_ids[rows, i : i + 1],
+                        attention_mask,
+                    ),
+                )[:, -1]
+                for i in range(start, end)
+            ]
+
+        model.module.inference_mode(use_cache=True)
+        model.module.clear_cache()
+        forward_model(model, (tokens[:, :8], position_ids[:, :8], attention_mask))
+        expected = decode(slice(None), 8, n)
+
+        # drop rows 1 and 2 half way through decoding
+        model.module.clear_cache()
+        forward_model(model, (tokens[:, :8], position_ids[:, :8], attention_mask))
+        decode(slice(None), 8, 12)
+        rows = torch.tensor([0, 3])
+        model.module.select_cache_rows(rows)
+        for logits, full in zip(decode(rows, 12, n), expected[4:]):
+            assert torch.allclose(logits, full[rows], atol=1e-5)
+        model.module.clear_cache()
+
+    wrapper()
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "kv_cache_type,pos_emb",
+    [
+        ("dynamic", "rotary"),
+        ("static", "rotary"),
+        ("static", "alibi"),
+        ("int8", "rotary"),
+    ],
+)
+def test_evict_cache(kv_cache_type, pos_emb):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import forward_model
+
+        # with a single layer, the cached keys / values of a token don't depend on the tokens before it
+        model, neox_args = cpu_model_setup(
+            pos_emb=pos_emb,
+            rotary_pct=0.5,
+            kv_cache_type=kv_cache_type,
+            num_layers=1,
+        )
+        torch.manual_seed(0)
+        tokens = torch.randint(0, 256, (2, 24))
+        attention_mask = torch.tril(torch.ones(1, 1, 24, 24)) < 0.5
+
+        def positions(n):
+            return torch.arange(n).unsqueeze(0).expand(2, n)
+
+        # int8 keys / values are only accurate to their quantization
+        atol = 0.01 if kv_cache_type == "int8" else 1e-4
+
+        # keep 4 sink positions, evict the next 8
+        kept = torch.cat((tokens[:, :4], tokens[:, 12:]), dim=1)
+        model.module.inference_mode(use_cache=False)
+        expected = forward_model(
+            model, (kept, positions(16), attention_mask[..., :16, :16])
+        )
+
+        model.module.inference_mode(use_cache=True)
+        model.module.clear_cache()
+        forward_model(model, (tokens[:, :20], positions(20), attention_mask))
+        model.module.evict_cache(4, 8)
+        # the remaining tokens decode as if the evicted ones had never been there
+        for i in range(20, 24):
+            logits = forward_model(
+                model,
+                (tokens[:, i : i + 1], positions(i - 8 + 1)[:, -1:], attention_mask),
+            )
+            assert torch.allclose(logits[:, -1], expected[:, i - 8], atol=atol)
+        model.module.clear_cache()
+
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_int8_kv_cache_decoding():
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import forward_model
+        from megatron.model.transformer import ParallelTransformerLayer
+
+        model, neox_args = cpu_model_setup(pos_emb="rotary", kv_cache_type="int8")
+        torch.manual_seed(0)
+        tokens = torch.randint(0, 256, (2, 20))
+        n = tokens.size(1)
+        attention_mask = torch.tril(torch.ones(1, 1, n, n)) < 0.5
+        position_ids = torch.arange(n).unsqueeze(0)
+
+        model.module.inference_mode(use_cache=False)
+        expected = forward_model(model, (tokens, position_ids, attention_mask))
+
+        # prefill 12 tokens, then decode the others one at a time on the int8 cache
+        model.module.inference_mode(use_cache=True)
+        model.module.clear_cache()
+        logits = [
+            forward_model(model, (tokens[:, :12], position_ids[:, :12], attention_mask))
+        ]
+        for i in range(12, n):
+            logits.append(
+                forward_model(
+                    model,
+                    (tokens[:, i : i + 1], position_ids[:, i : i + 1], attention_mask),
+                )
+            )
+        logits = torch.cat(logits, dim=1)
+        assert torch.allclose(logits, expected, atol=0.01)
+        assert (logits.argmax(-1) == expected.argmax(-1)).float().mean() > 0.9
+
+        caches = [
+            m.layer_past
+            for m in model.module.modules()
+            if isinstance(m, ParallelTransformerLayer)
+        ]
+        assert caches and all(isinstance(c, Int8KVCache) for c in caches)
+        assert all(c.buffer.dtype == torch.int8 and c.seq_len == n for c in caches)
+        model.module.clear_cache()
+
+    wrapper()
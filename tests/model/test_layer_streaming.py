@@ -0,0 +1,113 @@
+"""
+Tests for layer streaming inference: a model whose layers load their weights from the files of a pipeline parallel
+checkpoint when they run, against the same model with all weights loaded, on cpu
+"""
+
+import os
+
+import pytest
+import torch
+
+from tests.common import distributed_test, cpu_model_setup
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("no_weight_tying", [False, True])
+def test_layer_streaming_matches_loaded_model(tmp_path, no_weight_tying):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron import mpu
+        from megatron.checkpointing import stream_checkpoint_weights
+        from megatron.model.layer_streaming import get_streaming_model
+        from megatron.model.utils import InferenceEngine
+        from megatron.text_generation_utils import generate_samples_from_prompt
+
+        run_dir = tmp_path / f"world_size_{torch.distributed.get_world_size()}"
+        model, neox_args = cpu_model_setup(
+            load=str(run_dir),
+            pos_emb="rotary",
+            no_weight_tying=no_weight_tying,
+            inference_device="cpu",
+        )
+        tokens = torch.tensor(
+            [[int(t) for t in neox_args.tokenizer.tokenize("the quick brown fox")]]
+        )
+        n = tokens.size(1)
+        model_inputs = (
+            tokens,
+            torch.arange(n).unsqueeze(0),
+            torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+        )
+        model.module.inference_mode(use_cache=False)
+        expected = model.module(model_inputs)
+        model.module.inference_mode(use_cache=True)
+        prompts = ["the quick brown fox", "jumps"]
+        expected_samples = generate_samples_from_prompt(
+            neox_args, model, prompts, maximum_tokens=6, batch_size=2
+        )
+
+        # the files deepspeed saves for a pipeline parallel model
+        mp_rank = mpu.get_model_parallel_rank()
+        checkpoint_dir = os.path.join(run_dir, "global_step3")
+        if torch.distributed.get_rank() == 0:
+            os.makedirs(checkpoint_dir)
+            with open(os.path.join(run_dir, "latest"), "w") as f:
+                f.write("global_step3")
+        torch.distributed.barrier()
+        for idx, layer in enumerate(model.module.sequential):
+            if layer.state_dict():
+                torch.save(
+                    layer.state_dict(),
+                    os.path.join(
+                        checkpoint_dir,
+                        f"layer_{idx:02d}-model_{mp_rank:02d}-model_states.pt",
+                    ),
+                )
+        if mp_rank == 0:
+            torch.save(
+                {"iteration": 3, "module": None},
+                os.path.join(checkpoint_dir, "mp_rank_00_model_states.pt"),
+            )
+        torch.distributed.barrier()
+
+        for resident_layers in [0, 2]:
+            neox_args.update_value("layer_streaming_resident_layers", resident_layers)
+            streamed, num_params = get_streaming_model(neox_args, parallel_output=False)
+            assert num_params == sum(p.nelement() for p in model.parameters())
+            assert all(p.numel() == 0 for p in streamed.parameters())
+            assert stream_checkpoint_weights(neox_args, streamed) == 3
+            streamed = InferenceEngine(streamed).eval()
+
+            streamed.module.inference_mode(use_cache=False)
+            for _ in range(2):
+                assert torch.equal(streamed.module(model_inputs), expected)
+            layer_files = sorted(streamed.module.layer_files)
+            kept = set(layer_files[:resident_layers]) | (
+                set() if no_weight_tying else {0}
+            )
+            for idx in layer_files:
+                released = all(
+                    p.numel() == 0 for p in streamed.module.sequential[idx].parameters()
+                )
+                assert released == (idx not in kept)
+            stats = streamed.module.stats
+            assert stats["layers_loaded"] == 2 * len(layer_files) - len(kept)
+            assert stats["bytes_loaded"] > 0
+
+            streamed.module.inference_mode(use_cache=True)
+            samples = generate_samples_from_prompt(
+                neox_args, streamed, prompts, maximum_tokens=6, batch_size=2
+            )
+            assert [s["text"] for s in samples] == [s["text"] for s in expected_samples]
+
+        # the weights of a sequential model's checkpoint are all in one file
+        if mp_rank == 0:
+            torch.save(
+                {"iteration": 3, "module": model.module.state_dict()},
+                os.path.join(checkpoint_dir, "mp_rank_00_model_states.pt"),
+            )
+        torch.distributed.barrier()
+        with pytest.raises(ValueError):
+            stream_checkpoint_weights(neox_args, get_streaming_model(neox_args)[0])
+
+    wrapper()
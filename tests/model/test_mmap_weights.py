@@ -0,0 +1,111 @@
+"""
+Tests for the memory mapped weights format: saving and mapping tensors, and loading checkpoint weights exported to it
+into a model built without weights, on cpu
+"""
+
+import os
+
+import pytest
+import torch
+
+from tests.common import distributed_test, cpu_model_setup
+
+
+@pytest.mark.cpu
+def test_save_and_load_mmap_weights(tmp_path):
+    from megatron.checkpointing import (
+        MMAP_WEIGHTS_ALIGNMENT,
+        load_mmap_weights,
+        save_mmap_weights,
+    )
+
+    state_dict = {
+        "float32": torch.randn(3, 5),
+        "bfloat16": torch.randn(7).bfloat16(),
+        "float16": torch.randn(2, 3, 4).half(),
+        "int64": torch.tensor(11),
+        "bool": torch.tensor([True, False, True]),
+        "empty": torch.zeros(0, 4),
+        "transposed": torch.randn(4, 6).t(),
+    }
+    filename = str(tmp_path / "weights.bin")
+    save_mmap_weights(filename, state_dict, metadata={"iteration": 3})
+
+    tensors, metadata = load_mmap_weights(filename)
+    assert metadata == {"iteration": 3}
+    assert list(tensors) == list(state_dict)
+    for name, tensor in state_dict.items():
+        assert tensors[name].dtype == tensor.dtype
+        assert torch.equal(tensors[name], tensor)
+        if tensor.numel() > 0:
+            assert tensors[name].data_ptr() % MMAP_WEIGHTS_ALIGNMENT == 0
+
+    # the tensors map the file rather than holding a copy of it
+    with open(filename, "r+b") as f:
+        f.seek(os.path.getsize(filename) - 4 * 6 * 4)
+        f.write(torch.ones(6, 4).numpy().tobytes())
+    assert torch.equal(tensors["transposed"], torch.ones(6, 4))
+
+    with pytest.raises(ValueError):
+        save_mmap_weights(filename, {"complex": torch.zeros(2, dtype=torch.cfloat)})
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("precision", ["fp32", "bfloat16"])
+def test_load_checkpoint_weights_from_mmap_weights(tmp_path, precision):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron import mpu
+        from megatron.checkpointing import (
+            find_mmap_weights,
+            load_checkpoint_weights,
+            save_mmap_checkpoint_weights,
+        )
+        from megatron.model.layer_streaming import build_layers_without_weights
+        from megatron.model.utils import SequentialWrapper
+
+        run_dir = tmp_path / f"world_size_{torch.distributed.get_world_size()}"
+        model, neox_args = cpu_model_setup(
+            load=str(run_dir),
+            pos_emb="rotary",
+            precision=precision,
+            fp32_allreduce=True,
+        )
+        model.module.to(neox_args.params_dtype)
+        model.module.inference_mode(use_cache=False)
+        tokens = torch.tensor(
+            [[int(t) for t in neox_args.tokenizer.tokenize("the quick brown fox")]]
+        )
+        n = tokens.size(1)
+        model_inputs = (
+            tokens,
+            torch.arange(n).unsqueeze(0),
+            torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+        )
+        expected = model.module(model_inputs)
+
+        if torch.distributed.get_rank() == 0:
+            os.makedirs(run_dir / "global_step4")
+            with open(run_dir / "latest", "w") as f:
+                f.write("global_step4")
+        torch.distributed.barrier()
+        assert find_mmap_weights(neox_args) is None
+        mmap_weights_name = save_mmap_checkpoint_weights(neox_args, model.module, 4)
+        assert find_mmap_weights(neox_args) == mmap_weights_name
+        assert mmap_weights_name.endswith(
+            f"mp_rank_{mpu.get_model_parallel_rank():02d}_model_weights.bin"
+        )
+
+        layers, _, num_params = build_layers_without_weights(
+            neox_args, parallel_output=False
+        )
+        mapped = SequentialWrapper(layers, 0, None).to(neox_args.params_dtype)
+        mapped.eval()
+        assert all(p.numel() == 0 for p in mapped.parameters())
+        assert load_checkpoint_weights(neox_args, mapped) == 4
+        assert sum(p.numel() for p in mapped.parameters()) == num_params
+        assert all(p.dtype == neox_args.params_dtype for p in mapped.parameters())
+        mapped.inference_mode(use_cache=False)
+        assert torch.equal(mapped(model_inputs), expected)
+
+    wrapper()
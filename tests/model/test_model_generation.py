@@ -20,6 +20,7 @@ PARAMS_TO_TEST = {
     ],
     "top_p,temperature,top_k": [[0.0, 0.5, 0], [0.5, 0.0, 100], [0.5, 0.5, 0]],
     "prompt": ["", "hello world"],
+    "generation_batch_size": [1, 2],
     "fp16,fp32_allreduce": [
         [
             {
@@ -89,6 +90,7 @@ def run_generate_test(param_dict, prompt):
         temperature=args_loaded.temperature,
         top_k=args_loaded.top_k,
         top_p=args_loaded.top_p,
+        batch_size=args_loaded.generation_batch_size,
     )
 
     # outputs only get generated on mp rank 0
@@ -0,0 +1,174 @@
+"""
+Tests for the precomputed rotary tables, AliBi and relative position biases, which cached decoding reads slices of
+"""
+
+import pytest
+import torch
+
+from megatron.model.positional_embeddings import (
+    AliBi,
+    RotaryEmbedding,
+    apply_rotary_pos_emb_,
+    apply_rotary_pos_emb_torch,
+)
+from tests.common import distributed_test, cpu_model_setup
+
+
+@pytest.mark.cpu
+def test_rotary_tables_are_computed_once():
+    rotary = RotaryEmbedding(16, precision=torch.float, max_seq_len=32)
+    x = torch.randn(8, 2, 4, 16)
+    cos, sin = rotary(x, seq_dim=0)
+    assert cos.shape == (8, 1, 1, 16) and rotary.cos_cached.shape[0] == 32
+    table = rotary.cos_cached
+    for seq_len in range(9, 33):
+        cos, _ = rotary(x, seq_len=seq_len)
+        assert cos.shape[0] == seq_len and cos.data_ptr() == table.data_ptr()
+    # longer sequences grow the tables
+    cos, _ = rotary(x, seq_len=40)
+    assert torch.equal(cos[:32], table)
+
+    bf16 = RotaryEmbedding(16, precision=torch.bfloat16, max_seq_len=32)
+    cos, sin = bf16(x, seq_len=4)
+    assert cos.dtype == sin.dtype == torch.bfloat16
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("rotary_ndims", [16, 4])
+def test_apply_rotary_pos_emb_in_place(rotary_ndims):
+    torch.manual_seed(0)
+    rotary = RotaryEmbedding(rotary_ndims, precision=torch.float, max_seq_len=32)
+    cos, sin = rotary(torch.empty(0), seq_len=32)
+    # query / key heads as views into the fused qkv output, [sq, b, np, 3 * hn]
+    qkv = torch.randn(5, 2, 4, 48)
+    query, key = qkv[..., :16], qkv[..., 16:32]
+    expected = [
+        torch.cat((rotated, x[..., rotary_ndims:]), dim=-1)
+        for rotated, x in zip(
+            apply_rotary_pos_emb_torch(
+                query[..., :rotary_ndims], key[..., :rotary_ndims], cos, sin, offset=7
+            ),
+            (query, key),
+        )
+    ]
+    value = qkv[..., 32:].clone()
+
+    apply_rotary_pos_emb_(
+        query[..., :rotary_ndims], key[..., :rotary_ndims], cos, sin, offset=7
+    )
+    assert torch.allclose(query, expected[0], atol=1e-6)
+    assert torch.allclose(key, expected[1], atol=1e-6)
+    assert torch.equal(qkv[..., 32:], value)
+
+
+@pytest.mark.cpu
+def test_rotary_rotate_moves_keys():
+    torch.manual_seed(0)
+    rotary = RotaryEmbedding(16, precision=torch.float, max_seq_len=32)
+    cos, sin = rotary(torch.empty(0), seq_len=32)
+    key = torch.randn(5, 2, 4, 16)
+    # keys rotated at positions [20, 25), moved 12 positions earlier
+    _, at_20 = apply_rotary_pos_emb_torch(key, key, cos, sin, offset=20)
+    _, at_8 = apply_rotary_pos_emb_torch(key, key, cos, sin, offset=8)
+    assert torch.allclose(rotary.rotate_(at_20.clone(), -12), at_8, atol=1e-5)
+    # bf16 keys are rotated in float32
+    moved = rotary.rotate_(at_20.bfloat16(), -12)
+    assert moved.dtype == torch.bfloat16
+    assert torch.allclose(moved.float(), at_8, atol=0.05)
+
+
+def alibi_reference(alibi, seq_len_q, seq_len_k):
+    # the full [np, sk, sk] bias of the last sq queries, as AliBi built it before precomputing
+    a = -torch.tril(
+        torch.arange(seq_len_k).view(seq_len_k, 1).repeat(1, seq_len_k)
+        + torch.arange(0, -seq_len_k, -1)
+    ).float()
+    a = a * alibi.slopes.view(-1, 1, 1)
+    return a[:, seq_len_k - seq_len_q :, :]
+
+
+@pytest.mark.cpu
+def test_alibi_serves_slices_of_precomputed_bias():
+    alibi = AliBi(num_heads=8, mp_size=2, mp_rank=1, max_seq_len=32)
+    for seq_len_q, seq_len_k in [(16, 16), (16, 20), (1, 20), (1, 21), (3, 32)]:
+        x = torch.randn(2, 4, seq_len_q, seq_len_k)
+        expected = x + alibi_reference(alibi, seq_len_q, seq_len_k)
+        assert torch.equal(alibi(x), expected)
+    # the bias was built once, and decoding steps only read it
+    matrix = alibi.cached_matrix
+    assert matrix.shape == (4, 32, 32)
+    alibi(torch.randn(1, 4, 1, 7))
+    assert alibi.cached_matrix is matrix
+
+    # longer sequences grow the bias
+    x = torch.randn(1, 4, 2, 40)
+    assert torch.equal(alibi(x), x + alibi_reference(alibi, 2, 40))
+    assert alibi.cached_matrix.shape == (4, 40, 40)
+
+    # explicit offsets select the rows of other query positions
+    x = torch.randn(1, 4, 2, 10)
+    assert torch.equal(alibi(x, offset=3), x + alibi_reference(alibi, 10, 10)[:, 3:5])
+
+
+@pytest.mark.cpu
+def test_relative_position_bias_serves_slices():
+    @distributed_test(world_size=[1], backend="gloo")
+    def wrapper():
+        from megatron.mpu import ParallelRelativePositionBias
+
+        _, neox_args = cpu_model_setup(pos_emb="rpe")
+        rpe = ParallelRelativePositionBias(
+            neox_args,
+            scale=2.0,
+            heads=4,
+            num_buckets=8,
+            max_distance=16,
+            max_seq_len=24,
+        )
+        full = rpe(24, 24)
+        buckets = rpe._rel_pos_bucket_cached
+        for q_len, k_len in [(1, 5), (1, 24), (4, 20)]:
+            assert torch.equal(
+                rpe(q_len, k_len), full[..., k_len - q_len : k_len, :k_len]
+            )
+        assert torch.equal(rpe(2, 6, offset=1), full[..., 1:3, :6])
+        assert rpe._rel_pos_bucket_cached is buckets
+
+    wrapper()
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "pos_emb,rotary_pct", [("rotary", 1.0), ("rotary", 0.25), ("alibi", 1), ("rpe", 1)]
+)
+def test_cached_decoding_matches_full_forward(pos_emb, rotary_pct):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import forward_model
+
+        model, neox_args = cpu_model_setup(pos_emb=pos_emb, rotary_pct=rotary_pct)
+        torch.manual_seed(0)
+        tokens = torch.randint(0, 256, (2, 20))
+        n = tokens.size(1)
+        attention_mask = torch.tril(torch.ones(1, 1, n, n)) < 0.5
+        position_ids = torch.arange(n).unsqueeze(0)
+
+        model.module.inference_mode(use_cache=False)
+        expected = forward_model(model, (tokens, position_ids, attention_mask))
+
+        # prefill 12 tokens, then decode the others one at a time
+        model.module.inference_mode(use_cache=True)
+        model.module.clear_cache()
+        logits = forward_model(
+            model, (tokens[:, :12], position_ids[:, :12], attention_mask)
+        )
+        assert torch.allclose(logits, expected[:, :12], atol=1e-4)
+        for i in range(12, n):
+            logits = forward_model(
+                model,
+                (tokens[:, i : i + 1], position_ids[:, i : i + 1], attention_mask),
+            )
+            assert torch.allclose(logits[:, 0], expected[:, i], atol=1e-4)
+        model.module.clear_cache()
+
+    wrapper()
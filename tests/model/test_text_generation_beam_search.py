@@ -0,0 +1,162 @@
+"""
+Tests for batched beam search on the kv cache, against a beam search recomputing every beam on its own, on a tiny
+randomly initialized model on cpu
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from tests.common import distributed_test, cpu_model_setup, greedy_reference
+
+
+def beam_search_reference(
+    model, context_tokens, num_beams, maximum_tokens, eos_token_id, length_penalty
+):
+    """
+    Beam search one prompt and one beam at a time without kv cache, stopping once num_beams hypotheses are finished.
+
+    returns: list of (score, generated tokens, ended in eos_token_id) of the finished hypotheses, best first
+    """
+    beams, finished = [(0.0, [])], []
+    for step in range(maximum_tokens):
+        candidates = []
+        for score, generated in beams:
+            tokens = context_tokens + generated
+            n = len(tokens)
+            logits = model.module(
+                (
+                    torch.tensor([tokens]),
+                    torch.arange(n).unsqueeze(0),
+                    torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+                )
+            )
+            log_probs = F.log_softmax(logits[0, -1].float(), dim=-1)
+            candidates += [
+                (score + log_prob, generated + [token])
+                for token, log_prob in enumerate(log_probs.tolist())
+            ]
+        candidates = sorted(candidates, key=lambda c: -c[0])[: 2 * num_beams]
+
+        beams = []
+        for rank, (score, generated) in enumerate(candidates):
+            if generated[-1] == eos_token_id:
+                if rank < num_beams:
+                    finished.append(
+                        (score / len(generated) ** length_penalty, generated[:-1], True)
+                    )
+            elif len(beams) < num_beams:
+                beams.append((score, generated))
+        if len(finished) >= num_beams:
+            break
+        if step == maximum_tokens - 1:
+            finished += [
+                (score / len(generated) ** length_penalty, generated, False)
+                for score, generated in beams
+            ]
+    return sorted(finished, key=lambda h: -h[0])[:num_beams]
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "kv_cache_type,length_penalty", [("dynamic", 1.0), ("static", 0.0)]
+)
+def test_beam_search_matches_reference(kv_cache_type, length_penalty):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import beam_search
+
+        # larger weights than the default init, so that the beams' scores are far apart
+        model, neox_args = cpu_model_setup(
+            pos_emb="rotary", kv_cache_type=kv_cache_type, init_method_std=0.3
+        )
+        contexts = [
+            [int(t) for t in neox_args.tokenizer.tokenize(p)]
+            for p in ["hello world", "abc", "the quick brown fox"]
+        ]
+        model.module.inference_mode(use_cache=False)
+        num_beams, maximum_tokens = 4, 8
+        # the token the beams generate most often, so that some hypotheses finish early
+        generated = [
+            token
+            for c in contexts
+            for _, hypothesis, _ in beam_search_reference(
+                model, c, num_beams, maximum_tokens, -1, length_penalty
+            )
+            for token in hypothesis
+        ]
+        eos_token_id = max(set(generated), key=generated.count)
+        expected = [
+            beam_search_reference(
+                model, c, num_beams, maximum_tokens, eos_token_id, length_penalty
+            )
+            for c in contexts
+        ]
+
+        model.module.inference_mode(use_cache=True, last_position_only=True)
+        tokens, start_index, end_index, is_done, scores = beam_search(
+            neox_args,
+            model,
+            contexts,
+            num_beams,
+            eos_token_id=eos_token_id,
+            maximum_tokens=maximum_tokens,
+            length_penalty=length_penalty,
+            num_return_sequences=num_beams,
+        )
+        assert tokens.shape[:2] == (3, num_beams)
+        assert any(done for hypotheses in expected for _, _, done in hypotheses)
+        for i, hypotheses in enumerate(expected):
+            assert start_index[i] == len(contexts[i])
+            assert tokens[i, 0, : len(contexts[i])].tolist() == contexts[i]
+            for j, (score, generated, done) in enumerate(hypotheses):
+                assert (
+                    tokens[i, j, start_index[i] : end_index[i, j] + 1].tolist()
+                    == generated
+                )
+                assert is_done[i, j] == done
+                assert abs(scores[i, j].item() - score) < 1e-4
+
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_beam_search_single_beam_is_greedy():
+    @distributed_test(world_size=[1], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_utils import beam_search
+
+        model, neox_args = cpu_model_setup(pos_emb="rotary")
+        contexts = [
+            [int(t) for t in neox_args.tokenizer.tokenize(p)]
+            for p in ["hello world", "abcabcabcabc"]
+        ]
+        model.module.inference_mode(use_cache=False)
+        expected = [greedy_reference(model, neox_args, c, 10) for c in contexts]
+
+        model.module.inference_mode(use_cache=True, last_position_only=True)
+        tokens, start_index, end_index, _, _ = beam_search(
+            neox_args, model, contexts, 1, maximum_tokens=10
+        )
+        for i, generated in enumerate(expected):
+            assert (
+                tokens[i, 0, start_index[i] : end_index[i, 0] + 1].tolist() == generated
+            )
+
+        # a stop sequence taken from the greedy completion finishes it there
+        stop_tokens = expected[0][3:5]
+        tokens, start_index, end_index, is_done, _ = beam_search(
+            neox_args,
+            model,
+            contexts[:1],
+            1,
+            maximum_tokens=10,
+            stop_tokens=stop_tokens,
+        )
+        assert is_done[0, 0]
+        assert (
+            tokens[0, 0, start_index[0] : end_index[0, 0] + 1].tolist()
+            == expected[0][:4]
+        )
+
+    wrapper()
@@ -0,0 +1,157 @@
+"""
+Tests for the batched top-k / top-p sampling and token penalties used in text generation
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from megatron.text_generation_sampling import (
+    filter_logits,
+    sample_tokens,
+    sample_tokens_vocab_parallel,
+    TokenPenalties,
+)
+from tests.common import distributed_test
+
+
+def filter_row(logits, top_k, top_p):
+    """Reference top-k / top-p filter of a single row of logits"""
+    logits = logits.clone()
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    if top_k > 0:
+        logits[sorted_indices[top_k:]] = -float("Inf")
+        sorted_logits[top_k:] = -float("Inf")
+    if top_p > 0.0:
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        remove = torch.zeros_like(cumulative_probs, dtype=torch.bool)
+        remove[1:] = cumulative_probs[:-1] > top_p
+        logits[sorted_indices[remove]] = -float("Inf")
+    return logits
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("top_k,top_p", [(0, 0.0), (5, 0.0), (0, 0.9), (20, 0.5)])
+def test_filter_logits_matches_reference(top_k, top_p):
+    torch.manual_seed(0)
+    logits = torch.randn(8, 100) * 3
+    expected = torch.stack([filter_row(row, top_k, top_p) for row in logits])
+    assert torch.equal(filter_logits(logits, top_k=top_k, top_p=top_p), expected)
+
+
+@pytest.mark.cpu
+def test_filter_logits_per_row_parameters():
+    torch.manual_seed(0)
+    logits = torch.randn(4, 100) * 3
+    top_k = torch.tensor([0, 3, 10, 50])
+    top_p = torch.tensor([0.8, 0.0, 0.5, 0.0])
+    expected = torch.stack(
+        [filter_row(row, k.item(), p.item()) for row, k, p in zip(logits, top_k, top_p)]
+    )
+    assert torch.equal(filter_logits(logits, top_k=top_k, top_p=top_p), expected)
+
+
+@pytest.mark.cpu
+def test_sample_tokens_per_row_greedy():
+    torch.manual_seed(0)
+    logits = torch.randn(6, 50)
+    temperature = torch.tensor([0.0, 1.0, 0.0, 0.7, 0.0, 1.0])
+    top_k = torch.tensor([0, 1, 0, 0, 0, 1])
+    tokens = sample_tokens(logits, temperature=temperature, top_k=top_k)
+    # rows 0, 2, 4 are greedy, and top_k = 1 only leaves the most likely token for rows 1 and 5
+    greedy = logits.argmax(dim=-1)
+    assert torch.equal(tokens[[0, 1, 2, 4, 5]], greedy[[0, 1, 2, 4, 5]])
+    assert torch.equal(sample_tokens(logits), greedy)
+
+
+@pytest.mark.cpu
+def test_token_penalties_match_history():
+    torch.manual_seed(0)
+    batch_size, vocab_size = 3, 20
+    history = torch.randint(0, vocab_size, (batch_size, 6))
+    penalties = TokenPenalties(
+        batch_size,
+        vocab_size,
+        repetition_penalty=torch.tensor([1.0, 1.5, 2.0]),
+        presence_penalty=0.5,
+    )
+    penalties.update(history[:, :4])
+    for i in range(4, 6):
+        penalties.update(history[:, i])
+
+    logits = torch.randn(batch_size, vocab_size)
+    expected = logits.clone()
+    for row, repetition_penalty in enumerate([1.0, 1.5, 2.0]):
+        for token in set(history[row].tolist()):
+            value = expected[row, token]
+            value = (
+                value / repetition_penalty if value > 0 else value * repetition_penalty
+            )
+            expected[row, token] = value - 0.5
+    assert torch.allclose(penalties(logits), expected)
+    assert penalties.counts.sum() == history.numel()
+
+
+@pytest.mark.cpu
+def test_token_penalties_select_rows():
+    torch.manual_seed(0)
+    history = torch.randint(0, 20, (4, 6))
+    penalties = TokenPenalties(
+        4,
+        20,
+        repetition_penalty=torch.tensor([1.0, 1.5, 2.0, 3.0]),
+        presence_penalty=0.5,
+    )
+    penalties.update(history)
+    rows = torch.tensor([1, 3])
+    expected = TokenPenalties(
+        2, 20, repetition_penalty=torch.tensor([1.5, 3.0]), presence_penalty=0.5
+    )
+    expected.update(history[rows])
+
+    penalties.select_rows(rows)
+    logits = torch.randn(2, 20)
+    assert torch.equal(penalties(logits), expected(logits))
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "temperature,top_k,top_p",
+    [
+        (0.0, 0, 0.0),
+        (1.0, 0, 0.0),
+        (0.7, 0, 0.0),
+        (1.0, 5, 0.0),
+        (1.0, 0, 0.9),
+        (0.8, 20, 0.5),
+    ],
+)
+def test_sample_tokens_vocab_parallel(temperature, top_k, top_p):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        world_size = torch.distributed.get_world_size()
+        rank = torch.distributed.get_rank()
+        # a flat distribution over a large vocab needs several rounds to gather the nucleus
+        for scale, vocab_size in [(3.0, 64), (0.1, 1024)]:
+            torch.manual_seed(0)
+            logits = scale * torch.randn(16, vocab_size)
+            local_vocab_size = vocab_size // world_size
+            local_logits = logits[
+                :, rank * local_vocab_size : (rank + 1) * local_vocab_size
+            ]
+
+            torch.manual_seed(1)
+            expected = sample_tokens(
+                logits, temperature=temperature, top_k=top_k, top_p=top_p
+            )
+            torch.manual_seed(1)
+            tokens = sample_tokens_vocab_parallel(
+                local_logits,
+                rank * local_vocab_size,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+            )
+            assert torch.equal(tokens, expected)
+
+    wrapper()
@@ -0,0 +1,87 @@
+"""
+Tests for the continuous batching scheduler, on a tiny randomly initialized model on cpu
+"""
+
+import pytest
+
+from tests.common import distributed_test, cpu_model_setup, greedy_reference
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("pos_emb", ["rotary", "alibi"])
+def test_continuous_batching_matches_unbatched(pos_emb):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_scheduler import ContinuousBatchingScheduler
+
+        model, neox_args = cpu_model_setup(pos_emb=pos_emb)
+        prompts = [
+            "hello world",
+            "a",
+            "the quick brown fox jumps",
+            "",
+            "xy",
+            "abcdefgh",
+            "longer prompt here!",
+        ]
+        contexts = [
+            [int(t) for t in neox_args.tokenizer.tokenize(p)]
+            or [neox_args.tokenizer.eod]
+            for p in prompts
+        ]
+
+        model.module.inference_mode(use_cache=False)
+        expected = [greedy_reference(model, neox_args, c, 30) for c in contexts]
+
+        model.module.inference_mode(use_cache=True)
+        scheduler = ContinuousBatchingScheduler(
+            neox_args, model, num_slots=3, maximum_tokens=30
+        )
+        for context in contexts:
+            scheduler.add_request(context)
+        results = {r["request_id"]: r for r in scheduler.run()}
+
+        assert [results[i]["tokens"] for i in range(len(prompts))] == expected
+        stats = scheduler.stats
+        assert stats["generated_tokens"] == sum(
+            len(r["tokens"]) + r["finished"] for r in results.values()
+        )
+        assert stats["tokens_per_second"] > 0
+        assert 0 < stats["slot_occupancy"] <= 1
+
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_continuous_batching_paged_kv_cache():
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_scheduler import ContinuousBatchingScheduler
+
+        # a pool of 12 blocks of 4 positions only holds one sequence of seq_length (48)
+        model, neox_args = cpu_model_setup(
+            pos_emb="rotary",
+            kv_cache_type="paged",
+            kv_cache_block_size=4,
+            kv_cache_num_blocks=12,
+        )
+        prompts = ["hello world", "a", "hello world", "the quick brown fox", "xy"]
+        contexts = [[int(t) for t in neox_args.tokenizer.tokenize(p)] for p in prompts]
+
+        model.module.inference_mode(use_cache=False)
+        expected = [greedy_reference(model, neox_args, c, 20) for c in contexts]
+
+        model.module.inference_mode(use_cache=True)
+        scheduler = ContinuousBatchingScheduler(
+            neox_args, model, num_slots=4, maximum_tokens=20
+        )
+        for context in contexts:
+            scheduler.add_request(context)
+        results = {r["request_id"]: r for r in scheduler.run()}
+
+        assert [results[i]["tokens"] for i in range(len(prompts))] == expected
+        assert scheduler.stats["preempted_sequences"] > 0
+        allocator = scheduler.manager.allocator
+        assert allocator.num_free_blocks == allocator.num_blocks
+
+    wrapper()
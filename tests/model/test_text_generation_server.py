@@ -0,0 +1,184 @@
+"""
+Tests for the generation server: completions requested over http from a local client, against greedy decoding of a
+tiny randomly initialized model on cpu
+"""
+
+import http.client
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from tests.common import distributed_test, cpu_model_setup, greedy_reference
+
+
+def post(port, data):
+    """returns the json response, or the list of server-sent events of a streaming request"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    connection.request("POST", "/completions", body=json.dumps(data))
+    response = connection.getresponse()
+    if not data.get("stream"):
+        return response.status, json.loads(response.read())
+    assert response.getheader("Content-Type") == "text/event-stream"
+    events = []
+    for line in response:
+        line = line.decode("utf-8").strip()
+        if line.startswith("data: "):
+            events.append(line[len("data: ") :])
+    return response.status, events
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    connection.request("GET", path)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.mark.cpu
+def test_generation_server():
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_server import GenerationServer
+
+        model, neox_args = cpu_model_setup(pos_emb="rotary")
+        prompts = ["the quick brown fox", "jumps", "over the lazy dog"]
+        model.module.inference_mode(use_cache=False)
+        expected = [
+            greedy_reference(
+                model,
+                neox_args,
+                [int(t) for t in neox_args.tokenizer.tokenize(prompt)],
+                maximum_tokens=6,
+            )
+            for prompt in prompts
+        ]
+        detokenize = neox_args.tokenizer.detokenize
+        model.module.inference_mode(use_cache=True)
+
+        server = GenerationServer(
+            neox_args,
+            model,
+            port=0,
+            max_batch_size=4,
+            batch_wait_ms=1000,
+            idle_poll_seconds=0.1,
+        )
+        server.start()
+
+        results, errors = {}, []
+
+        def client():
+            try:
+                # concurrent greedy requests are batched together; the sampled one has to wait for its own batch
+                requests = [
+                    (0, {"prompt": prompts[0], "maximum_tokens": 6}),
+                    (1, {"prompt": prompts[1], "maximum_tokens": 6, "stream": True}),
+                    (2, {"prompt": prompts[2], "maximum_tokens": 3}),
+                    ("sampled", {"prompt": prompts[0], "temperature": 1.0}),
+                ]
+                threads = [
+                    threading.Thread(
+                        target=lambda i, data: results.update(
+                            {i: post(server.port, data)}
+                        ),
+                        args=request,
+                    )
+                    for request in requests
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                results["bad request"] = post(server.port, {"prompt": 1})
+                results["bad top_p"] = post(
+                    server.port, {"prompt": prompts[0], "top_p": 2}
+                )
+                results["bad temperature"] = post(
+                    server.port, {"prompt": prompts[0], "temperature": "hot"}
+                )
+                results["health"] = get(server.port, "/health")
+                results["metrics"] = get(server.port, "/metrics")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                server.shutdown()
+
+        if torch.distributed.get_rank() == 0:
+            client_thread = threading.Thread(target=client)
+            client_thread.start()
+        server.run()
+        if torch.distributed.get_rank() != 0:
+            return
+        client_thread.join()
+        assert not errors, errors
+
+        status, response = results[0]
+        assert status == 200 and response["text"] == detokenize(expected[0])
+        assert response["length"] == len(expected[0])
+
+        status, events = results[1]
+        assert status == 200 and events[-1] == "[DONE]"
+        summary = json.loads(events[-2])
+        text = "".join(json.loads(event)["text"] for event in events[:-2])
+        assert text == detokenize(expected[1])
+        assert summary["length"] == len(expected[1])
+
+        status, response = results[2]
+        assert status == 200 and response["text"] == detokenize(expected[2][:3])
+        assert response["length"] == 3 and not response["finished"]
+
+        assert results["sampled"][0] == 200
+        assert results["bad request"][0] == 400
+        assert results["bad top_p"][0] == 400
+        assert results["bad temperature"][0] == 400
+        assert results["health"] == (200, {"status": "ok"})
+
+        status, metrics = results["metrics"]
+        assert status == 200
+        assert metrics["queue_depth"] == 0
+        assert metrics["requests_total"] == metrics["requests_completed"] == 4
+        assert metrics["batches_total"] == 2
+        assert metrics["batch_size_counts"] == {"1": 1, "3": 1}
+        assert (
+            metrics["tokens_generated_total"]
+            == sum(r[1]["length"] for r in [results[0], results[2], results["sampled"]])
+            + summary["length"]
+        )
+        assert metrics["time_to_first_token_ms"]["p50"] > 0
+
+    wrapper()
+
+
+@pytest.mark.cpu
+def test_parse_sampling_params():
+    from megatron.text_generation_server import parse_sampling_params
+
+    # a config whose float fields were given as ints
+    neox_args = SimpleNamespace(
+        temperature=1, top_k=0, top_p=0, repetition_penalty=1, presence_penalty=0
+    )
+    sampling = parse_sampling_params({"temperature": 0.7, "top_k": 40.0}, neox_args)
+    assert sampling == {
+        "temperature": 0.7,
+        "top_k": 40,
+        "top_p": 0.0,
+        "repetition_penalty": 1.0,
+        "presence_penalty": 0.0,
+    }
+    assert type(sampling["top_p"]) is float and type(sampling["top_k"]) is int
+
+    for data in [
+        {"temperature": "0.7"},
+        {"temperature": -1},
+        {"temperature": float("nan")},
+        {"top_k": 1.5},
+        {"top_k": True},
+        {"top_p": 1.1},
+        {"repetition_penalty": 0},
+        {"presence_penalty": None},
+    ]:
+        with pytest.raises(ValueError):
+            parse_sampling_params(data, neox_args)
@@ -0,0 +1,105 @@
+"""
+Tests for offline generation sharded across data parallel groups, with resuming from the shards of an earlier run, on
+a tiny randomly initialized model on cpu
+"""
+
+import json
+import os
+
+import pytest
+import torch
+
+from tests.common import distributed_test, cpu_model_setup, greedy_reference
+
+
+@pytest.mark.cpu
+def test_generate_samples_sharded_resumes_and_merges(tmp_path):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron import mpu
+        from megatron import text_generation_utils
+        from megatron.text_generation_utils import generate_samples_input_from_file
+
+        model, neox_args = cpu_model_setup(model_parallel_size=1)
+        world_size = torch.distributed.get_world_size()
+        assert mpu.get_data_parallel_world_size() == world_size
+        prompts = ["the quick", "brown fox", "jumps over", "the lazy", "dog"]
+        model.module.inference_mode(use_cache=False)
+        expected = [
+            neox_args.tokenizer.detokenize(
+                greedy_reference(
+                    model,
+                    neox_args,
+                    [int(t) for t in neox_args.tokenizer.tokenize(prompt)],
+                    maximum_tokens=4,
+                )
+            )
+            for prompt in prompts
+        ]
+        model.module.inference_mode(use_cache=True)
+
+        run_dir = tmp_path / f"world_size_{world_size}"
+        input_file = run_dir / "prompts.txt"
+        output_file = run_dir / "samples.jsonl"
+        if torch.distributed.get_rank() == 0:
+            os.makedirs(run_dir)
+            with open(input_file, "w") as f:
+                f.write("\n".join(prompts[:2] + [""] + prompts[2:]) + "\n")
+            # an interrupted earlier run (with another number of shards) completed prompt 1, and cut a record short
+            with open(f"{output_file}.shard_00007.jsonl", "w") as f:
+                f.write(json.dumps({"prompt_id": 1, "text": "earlier run"}) + "\n")
+                f.write('{"prompt_id": 3, "te')
+        torch.distributed.barrier()
+
+        # count the generation loop's collectives
+        terminate_signals = []
+        broadcast_terminate_signal = text_generation_utils.broadcast_terminate_signal
+
+        def count_terminate_signals(*args, **kwargs):
+            terminate_signals.append(broadcast_terminate_signal(*args, **kwargs))
+            return terminate_signals[-1]
+
+        text_generation_utils.broadcast_terminate_signal = count_terminate_signals
+        results = generate_samples_input_from_file(
+            neox_args,
+            model,
+            str(input_file),
+            output_file=str(output_file),
+            maximum_tokens=4,
+            batch_size=2,
+            shard_across_data_parallel=True,
+        )
+        text_generation_utils.broadcast_terminate_signal = broadcast_terminate_signal
+
+        # the prompts of a shard are generated in one loop, of one step per batch of 2 and a last one to terminate
+        pending = [
+            idx
+            for idx in range(mpu.get_data_parallel_rank(), len(prompts), world_size)
+            if idx != 1
+        ]
+        assert terminate_signals == [0] * ((len(pending) + 1) // 2) + [1]
+
+        for shard in range(world_size):
+            shard_ids = [
+                json.loads(line)["prompt_id"]
+                for line in open(f"{output_file}.shard_{shard:05d}.jsonl")
+            ]
+            assert sorted(shard_ids) == [
+                idx for idx in range(shard, len(prompts), world_size) if idx != 1
+            ]
+        if torch.distributed.get_rank() == 0:
+            with open(output_file) as f:
+                merged = [json.loads(line) for line in f]
+            assert merged == results
+            assert [record["prompt_id"] for record in merged] == list(
+                range(len(prompts))
+            )
+            assert [record["text"] for record in merged] == [
+                expected[0],
+                "earlier run",
+                *expected[2:],
+            ]
+        else:
+            assert results == []
+
+    wrapper()
@@ -0,0 +1,139 @@
+"""
+Tests for speculative decoding: the verification of proposed tokens and the proposers, on a tiny randomly initialized
+model on cpu
+"""
+
+import pytest
+import torch
+
+from megatron.text_generation_sampling import verify_proposals
+from tests.common import distributed_test, cpu_model_setup, greedy_reference
+
+
+@pytest.mark.cpu
+def test_verify_proposals_preserves_target_distribution():
+    torch.manual_seed(0)
+    batch_size, vocab_size = 100000, 5
+    p = torch.tensor([0.5, 0.2, 0.15, 0.1, 0.05])
+    q = torch.tensor([0.1, 0.1, 0.2, 0.3, 0.3])
+    proposals = torch.multinomial(q, batch_size, replacement=True).view(-1, 1)
+    target_probs = p.expand(batch_size, 2, vocab_size)
+    proposal_probs = q.expand(batch_size, 1, vocab_size)
+
+    # the next token is the accepted proposal, or resampled from the residual where it was rejected
+    tokens, num_accepted = verify_proposals(proposals, target_probs, proposal_probs)
+    assert tokens.shape == (batch_size, 1)
+    frequencies = torch.bincount(tokens[:, 0], minlength=vocab_size) / batch_size
+    assert torch.allclose(frequencies, p, atol=0.01)
+    acceptance_rate = num_accepted.float().mean()
+    assert abs(acceptance_rate - torch.minimum(p, q).sum()) < 0.01
+
+
+@pytest.mark.cpu
+def test_verify_proposals_greedy():
+    target = torch.tensor([[3, 1, 4, 1], [3, 1, 2, 0]])
+    target_probs = torch.nn.functional.one_hot(target, 5).float()
+    proposals = torch.tensor([[3, 1, 4], [3, 1, 4]])
+
+    # both keep the proposals accepted by all batch items, then the second takes its own next token
+    tokens, num_accepted = verify_proposals(proposals, target_probs)
+    assert num_accepted.tolist() == [3, 2]
+    assert tokens.tolist() == [[3, 1, 4], [3, 1, 2]]
+
+    # proposals accepted regardless (e.g. batch items that are done) don't hold back the others
+    accepted = torch.tensor([[False, False, False], [True, True, True]])
+    tokens, _ = verify_proposals(proposals, target_probs, accepted=accepted)
+    assert tokens.tolist() == [[3, 1, 4, 1], [3, 1, 4, 0]]
+
+
+def speculative_greedy(model, neox_args, proposer, context_tokens, maximum_tokens):
+    """Greedy completion with speculative decoding, driving speculative_decoding_step like stream_tokens does."""
+    from megatron.text_generation_utils import (
+        forward_model,
+        speculative_decoding_step,
+    )
+
+    seq_length = neox_args.seq_length
+    n = len(context_tokens)
+    tokens = torch.zeros(1, seq_length, dtype=torch.long)
+    tokens[0, :n] = torch.tensor(context_tokens)
+    position_ids = torch.arange(seq_length).unsqueeze(0)
+    attention_mask = torch.tril(torch.ones(1, 1, seq_length, seq_length)) < 0.5
+
+    model.module.clear_cache()
+    proposer.reset()
+    logits = forward_model(model, (tokens[:, :n], position_ids[:, :n], attention_mask))
+    tokens[0, n] = logits[0, -1].argmax()
+    index = n + 1
+    last_index = min(n + maximum_tokens, seq_length) - 1
+    while index <= last_index:
+        num_proposals = min(3, last_index - index)
+        if num_proposals > 0:
+            generated = speculative_decoding_step(
+                model,
+                proposer,
+                tokens,
+                position_ids,
+                attention_mask,
+                index,
+                torch.tensor([n]),
+                torch.zeros(1, dtype=torch.uint8),
+                num_proposals,
+            )
+        else:
+            model_inputs = (
+                tokens[:, index - 1 : index],
+                position_ids[:, index - 1 : index],
+                attention_mask,
+            )
+            generated = [forward_model(model, model_inputs)[:, -1].argmax(dim=-1)]
+        for token in generated:
+            tokens[:, index] = token
+            index += 1
+    generated = tokens[0, n : last_index + 1].tolist()
+    if neox_args.tokenizer.eod in generated:
+        generated = generated[: generated.index(neox_args.tokenizer.eod)]
+    return generated
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("proposer_type", ["same_draft", "small_draft", "ngram"])
+def test_speculative_decoding_matches_greedy(proposer_type):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron.text_generation_speculative import (
+            DraftModelProposer,
+            NGramProposer,
+        )
+
+        model, neox_args = cpu_model_setup(pos_emb="rotary")
+        contexts = [
+            [int(t) for t in neox_args.tokenizer.tokenize(p)]
+            for p in ["hello world", "abcabcabcabc", "the quick brown fox"]
+        ]
+        model.module.inference_mode(use_cache=False)
+        expected = [greedy_reference(model, neox_args, c, 20) for c in contexts]
+
+        if proposer_type == "ngram":
+            proposer = NGramProposer()
+        else:
+            # with the same weights the draft proposes exactly the model's tokens
+            draft_model, _ = cpu_model_setup(
+                pos_emb="rotary",
+                num_layers=2 if proposer_type == "same_draft" else 1,
+            )
+            draft_model.module.inference_mode(use_cache=True, last_position_only=True)
+            proposer = DraftModelProposer(draft_model)
+
+        model.module.inference_mode(use_cache=True, last_position_only=True)
+        for context, tokens in zip(contexts, expected):
+            assert speculative_greedy(model, neox_args, proposer, context, 20) == tokens
+
+        stats = proposer.stats
+        assert stats["proposed_tokens"] > 0
+        assert 1 <= stats["tokens_per_target_forward"] <= 4
+        if proposer_type == "same_draft":
+            assert stats["acceptance_rate"] == 1.0
+        model.module.clear_cache()
+
+    wrapper()
@@ -0,0 +1,42 @@
+"""
+Tests for the text generation helpers that run on the whole batch at once
+"""
+
+import pytest
+import torch
+
+from megatron.text_generation_utils import pad_stop_tokens, stop_tokens_in_completion
+
+
+def ends_with(tokens, stop):
+    return len(tokens) >= len(stop) and tokens[len(tokens) - len(stop) :] == stop
+
+
+@pytest.mark.cpu
+def test_pad_stop_tokens():
+    stop_tokens = pad_stop_tokens([[5], [], [1, 2, 3]])
+    assert stop_tokens.tolist() == [[-1, -1, 5], [1, 2, 3]]
+    assert pad_stop_tokens([]).shape == (0, 0)
+
+
+@pytest.mark.cpu
+def test_stop_tokens_in_completion_matches_per_row():
+    torch.manual_seed(0)
+    stops = [[3], [1, 2], [4, 0, 2, 1], [2, 2, 2]]
+    stop_tokens = pad_stop_tokens(stops)
+    context_tokens = torch.randint(0, 5, (16, 12))
+
+    for current_index in range(12):
+        expected = [
+            any(ends_with(row[: current_index + 1], stop) for stop in stops)
+            for row in context_tokens.tolist()
+        ]
+        produced = stop_tokens_in_completion(stop_tokens, context_tokens, current_index)
+        assert produced.tolist() == expected
+
+
+@pytest.mark.cpu
+def test_stop_tokens_in_completion_without_stop_tokens():
+    context_tokens = torch.zeros(3, 4, dtype=torch.long)
+    assert not stop_tokens_in_completion(None, context_tokens, 2).any()
+    assert not stop_tokens_in_completion(pad_stop_tokens([]), context_tokens, 2).any()
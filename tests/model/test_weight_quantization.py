@@ -0,0 +1,129 @@
+"""
+Tests for weight-only int8 quantization of the model parallel layers, against the fp32 model on cpu
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from megatron.mpu.quantization import Int8Weight
+from tests.common import distributed_test, cpu_model_setup
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("group_size", [None, 16])
+def test_int8_weight(group_size):
+    torch.manual_seed(0)
+    weight = torch.randn(24, 64)
+    weight[3] = 0.0
+    quantized = Int8Weight(weight, group_size=group_size)
+    assert quantized.qweight.dtype == torch.int8
+    assert quantized.scale.shape == (24, 1 if group_size is None else 4)
+
+    # symmetric rounding is off by at most half a step of the row's (group's) scale
+    dequantized = quantized.dequantize()
+    step = quantized.scale.repeat_interleave(quantized.group_size, dim=1)
+    assert torch.all((dequantized - weight).abs() <= step / 2 + 1e-6)
+    assert torch.equal(dequantized[3], torch.zeros(64))
+
+    x, bias = torch.randn(5, 2, 64), torch.randn(24)
+    assert torch.allclose(
+        quantized.linear(x, bias), F.linear(x, dequantized, bias), atol=1e-4
+    )
+    tokens = torch.tensor([[0, 3], [23, 7]])
+    assert torch.equal(quantized.embedding(tokens), F.embedding(tokens, dequantized))
+
+
+@pytest.mark.parametrize(
+    "dtype,device",
+    [
+        (torch.float16, "cuda"),
+        # cpu has no float16 matmul
+        pytest.param(torch.bfloat16, "cpu", marks=pytest.mark.cpu),
+    ],
+)
+@pytest.mark.parametrize("group_size", [None, 128])
+def test_int8_weight_half_precision_with_outliers(dtype, device, group_size):
+    if device == "cuda" and not torch.cuda.is_available():
+        pytest.skip("needs a gpu")
+    torch.manual_seed(0)
+    weight = torch.randn(256, 4096) * 0.02
+    x = torch.randn(4, 4096)
+    # outlier features, as in the activations of large models
+    x[:, :8] = 500.0
+    quantized = Int8Weight(weight.to(dtype), group_size=group_size).to(device)
+    expected = F.linear(x, quantized.dequantize(torch.float32).cpu())
+
+    output = quantized.linear(x.to(dtype).to(device)).float().cpu()
+    assert torch.isfinite(output).all()
+    assert torch.allclose(output, expected, atol=0.02 * expected.abs().max())
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("group_size", [None, 16])
+@pytest.mark.parametrize("no_weight_tying", [False, True])
+def test_quantized_model_matches_fp32(group_size, no_weight_tying):
+    @distributed_test(world_size=[1, 2], backend="gloo")
+    def wrapper():
+        from megatron import mpu
+        from megatron.text_generation_utils import forward_model
+
+        model, neox_args = cpu_model_setup(
+            pos_emb="rotary", no_weight_tying=no_weight_tying
+        )
+        model.module.inference_mode(use_cache=False)
+        text = "the quick brown fox jumps over the lazy dog, " * 4
+        tokens = torch.tensor(
+            [[int(t) for t in neox_args.tokenizer.tokenize(text)[:48]]] * 2
+        )
+        tokens[1] = tokens[1].flip(0)
+        n = tokens.size(1)
+        model_inputs = (
+            tokens,
+            torch.arange(n).unsqueeze(0),
+            torch.tril(torch.ones(1, 1, n, n)) < 0.5,
+        )
+
+        def perplexity(logits):
+            return torch.exp(
+                F.cross_entropy(
+                    logits[:, :-1].reshape(-1, logits.size(-1)),
+                    tokens[:, 1:].reshape(-1),
+                )
+            ).item()
+
+        expected = forward_model(model, model_inputs)
+        bytes_before, bytes_after = mpu.quantize_weights_int8(
+            model, group_size=group_size
+        )
+        assert bytes_after < 0.35 * bytes_before
+        layers = [
+            m
+            for m in model.modules()
+            if isinstance(
+                m,
+                (
+                    mpu.ColumnParallelLinear,
+                    mpu.RowParallelLinear,
+                    mpu.VocabParallelEmbedding,
+                ),
+            )
+        ]
+        assert layers and all(isinstance(m.weight, mpu.Int8Weight) for m in layers)
+
+        logits = forward_model(model, model_inputs)
+        assert logits.shape == expected.shape
+        assert torch.allclose(logits, expected, atol=0.05)
+        assert abs(perplexity(logits) / perplexity(expected) - 1) < 0.01
+
+        # cached decoding runs on the quantized weights too
+        model.module.inference_mode(use_cache=True)
+        model.module.clear_cache()
+        cached = forward_model(
+            model,
+            (tokens[:, :40], model_inputs[1][:, :40], model_inputs[2]),
+        )
+        assert torch.allclose(cached, logits[:, :40], atol=1e-4)
+        model.module.clear_cache()
+
+    wrapper()
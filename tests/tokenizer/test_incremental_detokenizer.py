@@ -0,0 +1,73 @@
+"""
+Tests for incremental detokenization of streamed token ids, on a tiny byte level BPE vocab trained on the fly
+"""
+
+import pytest
+
+from megatron.tokenizer.tokenizer import (
+    HFTokenizer,
+    HFGPT2Tokenizer,
+    _GPT2BPETokenizer,
+)
+
+TEXT = "hello world, héllo wörld! 日本語のテキスト 🙂🚀 naïve café"
+
+
+@pytest.fixture(scope="module")
+def vocab_dir(tmp_path_factory):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    path = tmp_path_factory.mktemp("vocab")
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    # a small vocab, so that multi-byte characters are split across tokens
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator([TEXT] * 10, trainer)
+    tokenizer.save(str(path / "tokenizer.json"))
+    tokenizer.model.save(str(path))  # vocab.json / merges.txt
+    return path
+
+
+def build(tokenizer_class, path):
+    if tokenizer_class is HFTokenizer:
+        return HFTokenizer(str(path / "tokenizer.json"))
+    if tokenizer_class is HFGPT2Tokenizer:
+        return HFGPT2Tokenizer(str(path))
+    return _GPT2BPETokenizer(str(path / "vocab.json"), str(path / "merges.txt"))
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "tokenizer_class", [HFTokenizer, HFGPT2Tokenizer, _GPT2BPETokenizer]
+)
+@pytest.mark.parametrize("step", [1, 3])
+def test_incremental_detokenizer(vocab_dir, tokenizer_class, step):
+    tokenizer = build(tokenizer_class, vocab_dir)
+    token_ids = tokenizer.tokenize("say " + TEXT + " 🙂 日本")
+    assert len(token_ids) > len(TEXT) // 2  # the text is split into small tokens
+
+    detokenizer = tokenizer.incremental_detokenizer()
+    parts = [
+        detokenizer.add(token_ids[i : i + step]) for i in range(0, len(token_ids), step)
+    ]
+    parts.append(detokenizer.flush())
+
+    assert "".join(parts) == tokenizer.detokenize(token_ids)
+    # incomplete utf-8 sequences are held back rather than emitted as replacement characters
+    assert all("�" not in part for part in parts)
+
+
+@pytest.mark.cpu
+def test_incremental_detokenizer_flushes_incomplete_text(vocab_dir):
+    tokenizer = build(HFTokenizer, vocab_dir)
+    token_ids = tokenizer.tokenize("🚀")
+    assert len(token_ids) > 1
+
+    detokenizer = tokenizer.incremental_detokenizer()
+    assert detokenizer.add(token_ids[:-1]) == ""
+    assert detokenizer.flush() == tokenizer.detokenize(token_ids[:-1])
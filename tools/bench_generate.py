@@ -0,0 +1,229 @@
+"""
+Generation benchmark of stream_tokens, to catch performance regressions in generation and the kv cache: loads the
+model of a NeoX config and sweeps batch size, prompt length, maximum_tokens, recompute (off: decode with the kv cache,
+on: recompute all tokens every step) and sampling settings. Reports one json line per setting on rank 0 with
+  - ttft_ms: the time to first token, i.e. the prompts' forward pass and the first sampled tokens,
+  - step_p50_ms / step_p99_ms: the latency of the following generation steps, each of which samples one token for
+    every batch item,
+  - tokens_per_second: all generated tokens over the time of the whole generation,
+  - peak_memory_mib: the peak allocated cuda memory of the setting, or on cpu the peak resident memory of the process
+    (which never decreases, so later settings report at least the peak of earlier ones),
+  - weights_loaded_mib / weights_wait_ms: with layer_streaming, the layer weights read from the checkpoint during
+    the generation, and the time forward passes waited for them.
+
+Prompts are random tokens, and the end of document token doesn't stop generation, so that every batch item generates
+maximum_tokens tokens. Settings whose prompt and completion don't fit into seq_length are skipped.
+
+usage:
+    checkpoint of a NeoX config (weights are randomly initialized if its `load` directory holds no checkpoint):
+        ./deepy.py tools/bench_generate.py -d configs 125M.yml local_setup.yml
+    randomly initialized model of NeoX configs, in one process, on cpu:
+        python tools/bench_generate.py --config configs/small.yml --batch-sizes 1 8 --prompt-lengths 32 512
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+import numpy as np
+import torch
+
+from megatron import print_rank_0
+from megatron.text_generation_utils import stream_tokens
+from megatron.utils import setup_for_inference_or_eval
+
+SAMPLING_SETTINGS = {
+    "greedy": dict(temperature=0.0),
+    "top_k": dict(temperature=1.0, top_k=40),
+    "top_p": dict(temperature=1.0, top_p=0.9),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--config",
+        type=str,
+        nargs="+",
+        default=None,
+        help="NeoX config files of a randomly initialized model, benchmarked in this process; "
+        "not used when launched by deepy.py",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        choices=["cpu", "cuda"],
+        default="cpu",
+        help="inference_device of the --config model",
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[32, 512])
+    parser.add_argument("--maximum-tokens", type=int, nargs="+", default=[64])
+    parser.add_argument(
+        "--recompute", type=int, nargs="+", choices=[0, 1], default=[0, 1]
+    )
+    parser.add_argument(
+        "--sampling",
+        type=str,
+        nargs="+",
+        choices=list(SAMPLING_SETTINGS),
+        default=["greedy", "top_p"],
+    )
+    parser.add_argument("--seed", type=int, default=1234)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def use_random_init_config(config_files, device):
+    """
+    Makes setup_for_inference_or_eval set up a randomly initialized model of config_files in this process, like
+    deepy.py would launch it: passes the config as --megatron_config, with a `load` directory holding no checkpoint.
+    """
+    from megatron.neox_arguments import NeoXArgs
+
+    neox_args = NeoXArgs.from_ymls(
+        config_files,
+        overwrite_values={
+            "load": tempfile.mkdtemp(),
+            "inference_device": device,
+            "model_parallel_size": 1,
+            "pipe_parallel_size": 0,
+            "global_num_gpus": 1,
+        },
+    )
+    megatron_config = neox_args.get_parent_class_value_dict(
+        *neox_args.__class__.__bases__, only_non_defaults=True
+    )
+    sys.argv += ["--megatron_config", json.dumps(megatron_config)]
+    for key, value in [
+        ("RANK", "0"),
+        ("LOCAL_RANK", "0"),
+        ("WORLD_SIZE", "1"),
+        ("MASTER_ADDR", "127.0.0.1"),
+        ("MASTER_PORT", str(neox_args.master_port)),
+    ]:
+        os.environ.setdefault(key, value)
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def peak_memory_mib(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def benchmark(neox_args, model, prompts, maximum_tokens, recompute, sampling):
+    """times one generation of prompts, see the module docstring for the returned measurements"""
+    device = next(model.module.parameters()).device
+    model.module.inference_mode(
+        use_cache=not recompute,
+        last_position_only=True,
+        parallel_output=neox_args.vocab_parallel_sampling,
+    )
+    model.module.clear_cache()
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    streaming_stats = getattr(model.module, "stats", None)
+    streaming_before = dict(streaming_stats) if streaming_stats is not None else None
+
+    synchronize()
+    step_times = [time.perf_counter()]
+    for tokens, start_index, end_index, _ in stream_tokens(
+        neox_args,
+        model,
+        prompts,
+        eos_token_id=-1,  # no token ends generation early
+        maximum_tokens=maximum_tokens,
+        recompute=recompute,
+        **SAMPLING_SETTINGS[sampling],
+    ):
+        synchronize()
+        step_times.append(time.perf_counter())
+    step_latencies = np.diff(step_times[1:]) * 1e3
+    generated = (end_index - start_index + 1).clamp(min=0).sum().item()
+
+    result = {
+        "ttft_ms": (step_times[1] - step_times[0]) * 1e3,
+        "step_p50_ms": float(np.percentile(step_latencies, 50))
+        if len(step_latencies)
+        else None,
+        "step_p99_ms": float(np.percentile(step_latencies, 99))
+        if len(step_latencies)
+        else None,
+        "tokens_per_second": generated / (step_times[-1] - step_times[0]),
+        "generated_tokens": generated,
+        "peak_memory_mib": peak_memory_mib(device),
+    }
+    if streaming_stats is not None:
+        result["weights_loaded_mib"] = (
+            streaming_stats["bytes_loaded"] - streaming_before["bytes_loaded"]
+        ) / 2 ** 20
+        result["weights_wait_ms"] = (
+            streaming_stats["load_wait_seconds"] - streaming_before["load_wait_seconds"]
+        ) * 1e3
+    return result
+
+
+def main():
+    args = get_args()
+    if args.config is not None and "--megatron_config" not in sys.argv:
+        use_random_init_config(args.config, args.device)
+    model, neox_args = setup_for_inference_or_eval(use_cache=True)
+    assert (
+        not neox_args.is_pipe_parallel
+    ), "the generation benchmark does not support pipeline parallelism"
+
+    settings = [
+        (batch_size, prompt_length, maximum_tokens, bool(recompute), sampling)
+        for batch_size in args.batch_sizes
+        for prompt_length in args.prompt_lengths
+        for maximum_tokens in args.maximum_tokens
+        for recompute in args.recompute
+        for sampling in args.sampling
+    ]
+    generator = torch.Generator().manual_seed(args.seed)
+    warmed_up = False
+    for batch_size, prompt_length, maximum_tokens, recompute, sampling in settings:
+        if prompt_length + maximum_tokens > neox_args.seq_length:
+            print_rank_0(
+                f"skipping prompt_length {prompt_length} + maximum_tokens {maximum_tokens} > seq_length "
+                f"{neox_args.seq_length}"
+            )
+            continue
+        # the same prompts on every rank
+        prompts = torch.randint(
+            neox_args.tokenizer.vocab_size,
+            (batch_size, prompt_length),
+            generator=generator,
+        ).tolist()
+        if not warmed_up:
+            benchmark(neox_args, model, prompts, maximum_tokens, recompute, sampling)
+            warmed_up = True
+        result = {
+            "batch_size": batch_size,
+            "prompt_length": prompt_length,
+            "maximum_tokens": maximum_tokens,
+            "recompute": recompute,
+            "sampling": sampling,
+        }
+        result.update(
+            benchmark(neox_args, model, prompts, maximum_tokens, recompute, sampling)
+        )
+        print_rank_0(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Generation benchmark of the int8 key / value cache against the static one: loads the model of a NeoX config and, for
+each cache type, reports as json lines on rank 0
+  - the perplexity of held-out text read through the cache (every position attends to the cached keys / values, as in
+    decoding), and its increase over the static cache,
+  - greedy generation speed and how many generated tokens agree with the static cache's,
+  - the cache memory per sequence of seq_length positions, per model parallel rank, and the batch size that fits into
+    the memory of the static cache of the benchmarked batch.
+
+The held-out documents are read from sample_input_file (one per line), and cut into up to eval_iters seq_length
+windows. The prompts are the first PROMPT_LENGTH tokens (at most half of seq_length) of the first windows, completed
+with maximum_tokens (by default half of seq_length) tokens.
+
+usage: ./deepy.py tools/bench_kv_cache.py -d configs 125M.yml local_setup.yml --sample_input_file heldout.txt
+"""
+
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+import torch
+
+from megatron import print_rank_0
+from megatron.model.kv_cache import Int8KVCache, StaticKVCache
+from megatron.model.transformer import ParallelSelfAttention
+from megatron.text_generation_utils import stream_tokens
+from megatron.utils import setup_for_inference_or_eval
+from tools.eval_quantization import evaluate_windows, heldout_windows
+
+PROMPT_LENGTH = 128
+CACHE_TYPES = {"static": StaticKVCache, "int8": Int8KVCache}
+
+
+def set_kv_cache_type(model, kv_cache_class):
+    """Makes every attention layer of model allocate a kv_cache_class on its next forward pass."""
+    for m in model.module.modules():
+        if isinstance(m, ParallelSelfAttention):
+            m.kv_cache_class = kv_cache_class
+        if hasattr(m, "layer_past"):
+            m.layer_past = None
+
+
+def cache_bytes(model):
+    return sum(
+        m.layer_past.nbytes()
+        for m in model.module.modules()
+        if isinstance(getattr(m, "layer_past", None), StaticKVCache)
+    )
+
+
+def generate(neox_args, model, prompts, maximum_tokens):
+    """greedy completions of prompts, and the generated tokens per second"""
+    model.module.clear_cache()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for tokens, start_index, end_index, _ in stream_tokens(
+        neox_args, model, prompts, maximum_tokens=maximum_tokens
+    ):
+        pass
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    completions = [
+        tokens[i, start_index[i] : end_index[i] + 1].tolist()
+        for i in range(len(prompts))
+    ]
+    return completions, sum(len(c) for c in completions) / elapsed
+
+
+def main():
+    model, neox_args = setup_for_inference_or_eval(
+        use_cache=True, overwrite_values={"kv_cache_type": "static"}
+    )
+    assert (
+        not neox_args.is_pipe_parallel
+    ), "the kv cache benchmark does not support pipeline parallelism"
+    assert neox_args.sample_input_file, "sample_input_file has to name held-out text"
+    windows = heldout_windows(neox_args, max_windows=neox_args.eval_iters)
+    batch_size = neox_args.train_micro_batch_size_per_gpu
+    prompts = windows[:batch_size, : min(PROMPT_LENGTH, neox_args.seq_length // 2)]
+    maximum_tokens = neox_args.maximum_tokens or neox_args.seq_length // 2
+
+    results, completions = {}, {}
+    for name, kv_cache_class in CACHE_TYPES.items():
+        set_kv_cache_type(model, kv_cache_class)
+
+        model.module.inference_mode(use_cache=True, last_position_only=False)
+        nll, count, _ = evaluate_windows(neox_args, model, windows, batch_size)
+        # the caches hold the last batch of windows
+        last_batch_size = windows.split(batch_size)[-1].size(0)
+        bytes_per_sequence = cache_bytes(model) / last_batch_size
+
+        model.module.inference_mode(use_cache=True, last_position_only=True)
+        completions[name], tokens_per_second = generate(
+            neox_args, model, prompts.tolist(), maximum_tokens
+        )
+        results[name] = {
+            "ppl": math.exp(nll / count),
+            "tokens_per_second": tokens_per_second,
+            "cache_mib_per_sequence": bytes_per_sequence / 2 ** 20,
+        }
+
+    static = results["static"]
+    for name, result in results.items():
+        result["ppl_increase"] = result["ppl"] / static["ppl"] - 1
+        pairs = [
+            (a, b)
+            for c, s in zip(completions[name], completions["static"])
+            for a, b in zip(c, s)
+        ]
+        result["generated_tokens_agreement"] = sum(a == b for a, b in pairs) / max(
+            len(pairs), 1
+        )
+        result["batch_size_at_static_memory"] = int(
+            batch_size
+            * static["cache_mib_per_sequence"]
+            / result["cache_mib_per_sequence"]
+        )
+    for key, value in results.items():
+        print_rank_0(json.dumps({key: value}))
+
+
+if __name__ == "__main__":
+    main()
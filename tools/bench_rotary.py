@@ -0,0 +1,135 @@
+"""
+CPU microbenchmark of applying rotary embeddings to the query / key heads of one attention layer: the in-place
+apply_rotary_pos_emb_ with the precomputed RotaryEmbedding tables against apply_rotary_pos_emb and
+apply_rotary_pos_emb_torch with the tables recomputed for every sequence length, as cached decoding did before.
+
+usage: python tools/bench_rotary.py --batch-size 4 --heads 16 --head-dim 128 --rotary-pct 0.25 --positions 128 2048
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+import torch
+
+from megatron.model.positional_embeddings import (
+    RotaryEmbedding,
+    apply_rotary_pos_emb,
+    apply_rotary_pos_emb_torch,
+    apply_rotary_pos_emb_,
+)
+
+
+def rotary_tables(dim, seq_len, dtype):
+    """cos / sin tables for seq_len positions, computed like RotaryEmbedding did on every change of seq_len"""
+    inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
+    t = torch.arange(seq_len).float()
+    emb = torch.cat([torch.einsum("i,j->ij", t, inv_freq)] * 2, dim=-1)
+    return emb.cos()[:, None, None, :].to(dtype), emb.sin()[:, None, None, :].to(dtype)
+
+
+def split_qkv(qkv, head_dim):
+    return qkv[..., :head_dim], qkv[..., head_dim : 2 * head_dim]
+
+
+def recomputed(apply_fn, qkv, head_dim, rotary_ndims, offset):
+    query, key = split_qkv(qkv, head_dim)
+    cos, sin = rotary_tables(rotary_ndims, offset + qkv.size(0), qkv.dtype)
+    query_rot, key_rot = apply_fn(
+        query[..., :rotary_ndims], key[..., :rotary_ndims], cos, sin, offset=offset
+    )
+    if rotary_ndims < head_dim:
+        query_rot = torch.cat((query_rot, query[..., rotary_ndims:]), dim=-1)
+        key_rot = torch.cat((key_rot, key[..., rotary_ndims:]), dim=-1)
+    return query_rot, key_rot
+
+
+def in_place(rotary, qkv, head_dim, rotary_ndims, offset):
+    query, key = split_qkv(qkv, head_dim)
+    cos, sin = rotary(qkv, seq_len=offset + qkv.size(0))
+    apply_rotary_pos_emb_(
+        query[..., :rotary_ndims], key[..., :rotary_ndims], cos, sin, offset=offset
+    )
+    return query, key
+
+
+def time_fn(fn, qkv, iterations, warmup=3):
+    inputs = [qkv.clone() for _ in range(warmup + iterations)]
+    for x in inputs[:warmup]:
+        fn(x)
+    start = time.perf_counter()
+    for x in inputs[warmup:]:
+        fn(x)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--heads", type=int, default=16)
+    parser.add_argument("--head-dim", type=int, default=128)
+    parser.add_argument("--rotary-pct", type=float, default=0.25)
+    parser.add_argument(
+        "--positions",
+        type=int,
+        nargs="+",
+        default=[128, 2048],
+        help="positions already in the kv cache",
+    )
+    parser.add_argument(
+        "--query-lengths", type=int, nargs="+", default=[1, 128], help="new tokens"
+    )
+    parser.add_argument("--dtype", choices=["float32", "bfloat16"], default="float32")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    dtype = getattr(torch, args.dtype)
+    rotary_ndims = int(args.head_dim * args.rotary_pct)
+    rotary = RotaryEmbedding(
+        rotary_ndims,
+        precision=dtype,
+        max_seq_len=max(args.positions) + max(args.query_lengths),
+    )
+
+    print(
+        f"{'positions':>9} {'sq':>5} {'jit (ms)':>9} {'torch (ms)':>11} {'in place (ms)':>14} {'speedup':>8}"
+    )
+    for positions in args.positions:
+        for query_length in args.query_lengths:
+            # fused qkv output of one layer, [sq, b, np, 3 * hn]
+            qkv = torch.randn(
+                query_length, args.batch_size, args.heads, 3 * args.head_dim
+            ).to(dtype)
+            timings = [
+                time_fn(
+                    lambda x: recomputed(fn, x, args.head_dim, rotary_ndims, positions),
+                    qkv,
+                    args.iterations,
+                )
+                for fn in [apply_rotary_pos_emb, apply_rotary_pos_emb_torch]
+            ]
+            timings.append(
+                time_fn(
+                    lambda x: in_place(
+                        rotary, x, args.head_dim, rotary_ndims, positions
+                    ),
+                    qkv,
+                    args.iterations,
+                )
+            )
+            print(
+                f"{positions:>9} {query_length:>5} {timings[0] * 1e3:>9.3f} {timings[1] * 1e3:>11.3f} "
+                f"{timings[2] * 1e3:>14.3f} {min(timings[:2]) / timings[2]:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
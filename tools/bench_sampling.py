@@ -0,0 +1,94 @@
+"""
+CPU microbenchmark of next-token sampling: the batched megatron.text_generation_sampling against the previous
+implementation, which applied top-p with a python loop over the batch and sorted the full vocab every step.
+
+usage: python tools/bench_sampling.py --batch-sizes 1 8 32 --vocab-size 50432 --top-k 40 --top-p 0.9
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+import torch
+import torch.nn.functional as F
+
+from megatron.text_generation_sampling import sample_tokens
+
+
+def filter_logits_loop(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
+    """filter_logits as it was before megatron.text_generation_sampling, kept here as the baseline"""
+    if top_k > 0:
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        logits[indices_to_remove] = filter_value
+
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        for i in range(sorted_indices.size(0)):
+            indices_to_remove = sorted_indices[i][sorted_indices_to_remove[i]]
+            logits[i][indices_to_remove] = filter_value
+
+    return logits
+
+
+def sample_tokens_loop(logits, temperature=0.0, top_k=0, top_p=0.0):
+    logits = logits.float()
+    if temperature > 0.0:
+        logits /= temperature
+    logits = filter_logits_loop(logits, top_k=top_k, top_p=top_p)
+    return torch.multinomial(F.softmax(logits, dim=-1), num_samples=1).view(-1)
+
+
+def time_fn(fn, logits, iterations, warmup=3, **kwargs):
+    for _ in range(warmup):
+        fn(logits.clone(), **kwargs)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(logits.clone(), **kwargs)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--vocab-size", type=int, default=50432)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=40)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    settings = [
+        dict(top_k=args.top_k, top_p=0.0),
+        dict(top_k=0, top_p=args.top_p),
+        dict(top_k=args.top_k, top_p=args.top_p),
+    ]
+    print(
+        f"{'batch':>6} {'top_k':>6} {'top_p':>6} {'loop (ms)':>10} {'batched (ms)':>13} {'speedup':>8}"
+    )
+    for batch_size in args.batch_sizes:
+        logits = torch.randn(batch_size, args.vocab_size) * 4
+        for setting in settings:
+            kwargs = dict(temperature=args.temperature, **setting)
+            loop = time_fn(sample_tokens_loop, logits, args.iterations, **kwargs)
+            batched = time_fn(sample_tokens, logits, args.iterations, **kwargs)
+            print(
+                f"{batch_size:>6} {setting['top_k']:>6} {setting['top_p']:>6} "
+                f"{loop * 1e3:>10.2f} {batched * 1e3:>13.2f} {loop / batched:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
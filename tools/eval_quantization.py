@@ -0,0 +1,107 @@
+"""
+Accuracy check of weight-only int8 quantization: loads the model of a NeoX config, evaluates it on held-out text,
+quantizes its weights with the config's weight_quantization_group_size and evaluates it again. Reports the perplexity
+of both, how often their next token predictions agree and the weight memory per model parallel rank as json lines on
+rank 0.
+
+The held-out documents are read from sample_input_file (one per line), concatenated and cut into up to eval_iters
+seq_length windows.
+
+usage: ./deepy.py tools/eval_quantization.py -d configs 125M.yml local_setup.yml --sample_input_file heldout.txt
+"""
+
+import json
+import math
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+import torch
+import torch.nn.functional as F
+
+from megatron import mpu, print_rank_0
+from megatron.text_generation_utils import forward_model
+from megatron.utils import setup_for_inference_or_eval
+
+
+def heldout_windows(neox_args, max_windows=None):
+    """the tokens of sample_input_file as [n, seq_length] windows"""
+    with open(neox_args.sample_input_file, "r", encoding="utf-8") as f:
+        documents = [line.rstrip("\n") for line in f if line.strip()]
+    tokens = []
+    for document in documents:
+        tokens += neox_args.tokenizer.tokenize(document) + [neox_args.tokenizer.eod]
+    n = len(tokens) // neox_args.seq_length
+    if max_windows is not None:
+        n = min(n, max_windows)
+    assert n > 0, "sample_input_file has to hold at least seq_length tokens"
+    return torch.tensor(tokens[: n * neox_args.seq_length]).view(n, -1)
+
+
+@torch.no_grad()
+def evaluate_windows(neox_args, model, windows, batch_size):
+    """returns the summed next token negative log likelihood, the number of predicted tokens, and the logits' argmax"""
+    n = windows.size(1)
+    device = next(model.module.parameters()).device
+    attention_mask = torch.tril(torch.ones(1, 1, n, n, device=device)) < 0.5
+    position_ids = torch.arange(n, device=device).unsqueeze(0)
+    nll, count, predictions = 0.0, 0, []
+    for batch in windows.split(batch_size):
+        tokens = batch.to(device)
+        # with the kv cache on, every batch of windows fills a fresh cache
+        model.module.clear_cache()
+        logits = forward_model(
+            model, (tokens, position_ids.expand_as(tokens), attention_mask)
+        )
+        logits = logits[:, :-1, : neox_args.tokenizer.vocab_size].float()
+        nll += F.cross_entropy(
+            logits.reshape(-1, logits.size(-1)),
+            tokens[:, 1:].reshape(-1),
+            reduction="sum",
+        ).item()
+        count += tokens[:, 1:].numel()
+        predictions.append(logits.argmax(dim=-1).cpu())
+    return nll, count, torch.cat(predictions)
+
+
+def main():
+    model, neox_args = setup_for_inference_or_eval(
+        use_cache=False, overwrite_values={"weight_quantization": None}
+    )
+    assert (
+        not neox_args.is_pipe_parallel
+    ), "the quantization accuracy check does not support pipeline parallelism"
+    assert neox_args.sample_input_file, "sample_input_file has to name held-out text"
+    model.module.inference_mode(use_cache=False)
+    windows = heldout_windows(neox_args, max_windows=neox_args.eval_iters)
+    batch_size = neox_args.train_micro_batch_size_per_gpu
+
+    results = {}
+    nll, count, reference = evaluate_windows(neox_args, model, windows, batch_size)
+    results["reference"] = {"ppl": math.exp(nll / count), "tokens": count}
+
+    bytes_before, bytes_after = mpu.quantize_weights_int8(
+        model, group_size=neox_args.weight_quantization_group_size
+    )
+    nll, count, predictions = evaluate_windows(neox_args, model, windows, batch_size)
+    results["int8"] = {
+        "ppl": math.exp(nll / count),
+        "tokens": count,
+        "group_size": neox_args.weight_quantization_group_size,
+        "top1_agreement": (predictions == reference).float().mean().item(),
+    }
+    results["int8"]["ppl_increase"] = (
+        results["int8"]["ppl"] / results["reference"]["ppl"] - 1
+    )
+    results["weight_mib_per_rank"] = {
+        "reference": bytes_before / 2 ** 20,
+        "int8": bytes_after / 2 ** 20,
+    }
+    for key, value in results.items():
+        print_rank_0(json.dumps({key: value}))
+
+
+if __name__ == "__main__":
+    main()
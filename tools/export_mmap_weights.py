@@ -0,0 +1,42 @@
+"""
+Exports the weights of a checkpoint to the read-only, memory mapped weights format of
+megatron.checkpointing.save_mmap_weights: loads the model of a NeoX config for cpu inference and writes one
+mp_rank_XX_model_weights.bin file per model parallel rank into the loaded checkpoint's directory. Inference on cpu
+(e.g. generate.py with inference_device "cpu") then memory maps the weights from these files instead of loading the
+checkpoint, so that the processes of any number of inference workers on a host share one copy of the weights in the
+page cache, and loading them reads nothing up front.
+
+The weights are saved in the dtype cpu inference runs in (bfloat16 for fp16 and bfloat16 models, else fp32), which
+the config must not change later, or every worker copies them into its own memory.
+
+usage:
+    ./deepy.py tools/export_mmap_weights.py -d configs 20B.yml local_setup.yml
+with inference_device "cpu" in the config.
+"""
+
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+from megatron import print_rank_0
+from megatron.checkpointing import save_mmap_checkpoint_weights
+from megatron.utils import setup_for_inference_or_eval
+
+
+def main():
+    model, neox_args = setup_for_inference_or_eval(use_cache=False)
+    assert (
+        neox_args.inference_device == "cpu"
+    ), "mmap weights are loaded by cpu inference, set inference_device to cpu"
+    assert (
+        neox_args.weight_quantization is None
+    ), "mmap weights hold the weights of the model without weight quantization"
+    save_mmap_checkpoint_weights(neox_args, model.module, neox_args.iteration)
+    print_rank_0(f"Exported the weights of iteration {neox_args.iteration}")
+
+
+if __name__ == "__main__":
+    main()